@@ -29,12 +29,16 @@ _C.TRAIN = CN()
 
 _C.TRAIN.resume_training = True # true, false
 _C.TRAIN.train_batch_size = 8
+_C.TRAIN.train_max_points = None # points per batch instead of train_batch_size samples
 _C.TRAIN.gradient_accumulation_steps = 1
 _C.TRAIN.num_epochs = None
 _C.TRAIN.num_train_steps =  100000
 _C.TRAIN.warmup_steps = 5000
 _C.TRAIN.log_steps = 1000
 _C.TRAIN.save_steps = 5000
+_C.TRAIN.save_async = True
+_C.TRAIN.save_keep_last = None # latest checkpoints kept, None: all
+_C.TRAIN.save_keep_every_steps = None
 
 _C.TRAIN.optim = 'adamw'
 _C.TRAIN.learning_rate = 1e-4
@@ -45,6 +49,9 @@ _C.TRAIN.weight_decay = 0.05
 _C.TRAIN.grad_norm = 5
 _C.TRAIN.n_workers = 0
 _C.TRAIN.pin_mem = True
+_C.TRAIN.prefetch_batches = 2
+_C.TRAIN.profile = False # per-phase step times
+_C.TRAIN.profile_trace_steps = None # [start, end] global steps of a torch.profiler trace
 
 # -----------------------------------------------------------------------------
 # MODEL
@@ -1,4 +1,5 @@
 import torch
+import numpy as np
 
 import jsonlines
 from filelock import FileLock
@@ -13,6 +14,20 @@ def write_to_file(filepath, data):
             outf.write(data)
 
 
+def summarize_latency(latencies):
+    '''latencies: {'cold': [...], 'warm': [...]} seconds per model call,
+    with and without warm-started denoising
+    '''
+    msgs = []
+    for mode, values in latencies.items():
+        if len(values) > 0:
+            msgs.append('%s: %.1fms x %d' % (mode, np.mean(values) * 1000, len(values)))
+    if len(latencies.get('cold', [])) > 0 and len(latencies.get('warm', [])) > 0:
+        saving = 1 - np.mean(latencies['warm']) / np.mean(latencies['cold'])
+        msgs.append('warm start saves %.1f%%' % (saving * 100))
+    return 'Model latency per step: ' + ', '.join(msgs)
+
+
 def load_checkpoint(model, ckpt_file):
     ckpt = torch.load(ckpt_file)
     state_dict = model.state_dict()
@@ -7,6 +7,7 @@ import tap
 import copy
 from pathlib import Path
 from filelock import FileLock
+import time
 
 import torch
 import numpy as np
@@ -32,7 +33,7 @@ from minidiffuser.train.train_diffusion_policy import MODEL_FACTORY
 from minidiffuser.configs.rlbench.constants import get_robot_workspace, get_rlbench_labels
 from minidiffuser.utils.robot_box import RobotBox
 from minidiffuser.train.datasets.common import gen_seq_masks
-from minidiffuser.evaluation.common import write_to_file
+from minidiffuser.evaluation.common import write_to_file, summarize_latency
 
 
 class Arguments(tap.Tap):
@@ -59,6 +60,10 @@ class Arguments(tap.Tap):
     video_resolution: int = 480
 
     num_ensembles: int = 1
+    ensemble_select: str = 'mode'  # mode, cluster, mean
+    sampler: str = None  # ddpm, ddim, dpmsolver; None uses MODEL.diffusion.sampler
+    num_inference_steps: int = None
+    warm_start: float = 0  # >0: denoise this fraction of the steps from the previous action
 
     best_disc_pos: str = 'max' # max, ens1
 
@@ -108,6 +113,10 @@ class Actioner(object):
 
         self.TABLE_HEIGHT = self.WORKSPACE['TABLE_HEIGHT']
 
+        # previous action of each running episode for warm start
+        self.prev_actions = {}
+        self.latencies = {'cold': [], 'warm': []}
+
     def _get_mask_with_label_ids(self, sem, label_ids):
         mask = sem == label_ids[0]
         for label_id in label_ids[1:]:
@@ -123,12 +132,7 @@ class Actioner(object):
             arm_links_info, keep_gripper=keep_gripper, 
             env_name='real' if self.args.real_robot else 'rlbench'
         )
-        _, robot_point_ids = robot_box.get_pc_overlap_ratio(xyz=xyz, return_indices=True)
-        robot_point_ids = np.array(list(robot_point_ids))
-        mask = np.ones((xyz.shape[0], ), dtype=bool)
-        if len(robot_point_ids) > 0:
-            mask[robot_point_ids] = False
-        return mask
+        return ~robot_box.get_pc_mask(xyz)
     
     def _rm_pc_outliers(self, xyz, rgb=None):
         # pcd = o3d.geometry.PointCloud()
@@ -293,21 +297,38 @@ class Actioner(object):
         batch = self.preprocess_obs(
             taskvar, step_id, obs_state_dict,
         )
+
+        episode_key = (taskvar, episode_id)
+        if step_id == 0:
+            self.prev_actions.pop(episode_key, None)
+        init_pos = None
+        if self.args.warm_start > 0 and episode_key in self.prev_actions:
+            init_pos = (self.prev_actions[episode_key][:3] - batch['pc_centroids']) / batch['pc_radius']
+            init_pos = torch.from_numpy(init_pos).float().unsqueeze(0)
+
+        st = time.time()
         with torch.no_grad():
-            actions = []
-            # TODO
-            for _ in range(self.args.num_ensembles):
-                action = self.model(batch)[0].data.cpu()
-                actions.append(action)
-            if len(actions) > 1:
-                # print(torch.stack(actions, 0))
-                avg_action = torch.stack(actions, 0).mean(0)
+            # all the ensembles share one encoder pass
+            actions = self.model(
+                batch, sampler=self.args.sampler, 
+                num_inference_steps=self.args.num_inference_steps,
+                num_samples=self.args.num_ensembles,
+                init_pos=init_pos, init_strength=self.args.warm_start,
+            )
+            if self.args.num_ensembles > 1 and self.args.ensemble_select == 'mean':
+                actions = actions[0].data.cpu()
+                avg_action = actions.mean(0)
                 pred_rot = torch.from_numpy(R.from_euler(
                     'xyz', np.mean([R.from_quat(x[3:-1]).as_euler('xyz') for x in actions], 0),
                 ).as_quat())
                 action = torch.cat([avg_action[:3], pred_rot, avg_action[-1:]], 0)
+            elif self.args.num_ensembles > 1:
+                action = self.model.select_hypothesis(
+                    actions, method=self.args.ensemble_select
+                )[0].data.cpu()
             else:
-                action = actions[0]
+                action = actions[0].data.cpu()
+        self.latencies['cold' if init_pos is None else 'warm'].append(time.time() - st)
         action[-1] = torch.sigmoid(action[-1]) > 0.5
         
         # action = action.data.cpu().numpy()
@@ -315,6 +336,7 @@ class Actioner(object):
         action[:3] = action[:3] * batch['pc_radius'] + batch['pc_centroids']
         # TODO: ensure the action height is above the table
         action[2] = max(action[2], self.TABLE_HEIGHT+0.005)
+        self.prev_actions[episode_key] = copy.deepcopy(action)
 
         out = {
             'action': action
@@ -407,6 +429,7 @@ def evaluate_actioner(args):
     )
 
     print("Testing Success Rate {}: {:.04f}".format(task_str, success_rate))
+    print(summarize_latency(actioner.latencies))
     write_to_file(
         outfile,
         {
@@ -41,6 +41,10 @@ class ServerArguments(tap.Tap):
     taskvar_file: str = 'assets/taskvars_train.json'
     num_demos: int = 20
     num_ensembles: int = 1
+    ensemble_select: str = 'mode'  # mode, cluster, mean
+    sampler: str = None  # ddpm, ddim, dpmsolver; None uses MODEL.diffusion.sampler
+    num_inference_steps: int = None
+    warm_start: float = 0  # >0: denoise this fraction of the steps from the previous action
 
     save_obs_outs_dir: str = None
 
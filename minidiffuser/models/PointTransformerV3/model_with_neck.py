@@ -27,7 +27,7 @@ except ImportError:
     flash_attn = None
 
 from minidiffuser.models.PointTransformerV3.serialization import encode
-from minidiffuser.train.utils.ops import pad_tensors_wgrad, gen_seq_masks
+from minidiffuser.utils.profiling import record_region
 
 class RotaryPositionEncoding3D(nn.Module):
 
@@ -35,6 +35,12 @@ class RotaryPositionEncoding3D(nn.Module):
         super().__init__()
         self.feature_dim = feature_dim
         self.pe_type = pe_type
+        div_term = torch.exp(
+            torch.arange(0, self.feature_dim // 3, 2, dtype=torch.float)
+            * (-math.log(10000.0) / (self.feature_dim // 3))
+        )
+        # not saved in the checkpoints
+        self.register_buffer("div_term", div_term, persistent=False)
 
     @torch.no_grad()
     def forward(self, XYZ):
@@ -44,13 +50,7 @@ class RotaryPositionEncoding3D(nn.Module):
         """
         npoint, _ = XYZ.shape
         x_position, y_position, z_position = XYZ[..., 0:1], XYZ[..., 1:2], XYZ[..., 2:3]
-        div_term = torch.exp(
-            torch.arange(
-                0, self.feature_dim // 3, 2, dtype=torch.float, device=XYZ.device
-            )
-            * (-math.log(10000.0) / (self.feature_dim // 3))
-        )
-        div_term = div_term.view(1, 1, -1)  # [1, 1, d//6]
+        div_term = self.div_term.float().view(1, 1, -1)  # [1, 1, d//6]
 
         sinx = torch.sin(x_position * div_term)  # [B, N, d//6]
         cosx = torch.cos(x_position * div_term)
@@ -69,6 +69,16 @@ class RotaryPositionEncoding3D(nn.Module):
         
         return cos_pos.unsqueeze(1) , sin_pos.unsqueeze(1) 
 
+    @torch.no_grad()
+    def rotation(self, XYZ):
+        """
+        The same table as forward, as one unit complex number per (2i, 2i+1) feature pair
+        @param XYZ: [N,3]
+        @return: [N, 1, d//2] complex
+        """
+        angles = XYZ.float().unsqueeze(-1) * self.div_term.float()  # [N, 3, d//6]
+        return torch.polar(torch.ones_like(angles), angles).flatten(1).unsqueeze(1)
+
 
 def embed_rotary(x, cos, sin):
     x2 = torch.stack([-x[..., 1::2], x[..., ::2]], dim=-1).reshape_as(x).contiguous()
@@ -76,6 +86,16 @@ def embed_rotary(x, cos, sin):
     return x
 
 
+def apply_rotary(x, rotation):
+    """
+    embed_rotary with the table of RotaryPositionEncoding3D.rotation: each (2i, 2i+1) pair
+    is rotated by one complex multiplication, without the stack/reshape copies.
+    x: [N, H, d], contiguous in the last dim
+    """
+    x_complex = torch.view_as_complex(x.float().unflatten(-1, (-1, 2)))
+    return torch.view_as_real(x_complex * rotation).flatten(-2).to(x.dtype)
+
+
 @torch.inference_mode()
 def offset2bincount(offset):
     return torch.diff(
@@ -389,6 +409,121 @@ class RPE(torch.nn.Module):
         return out
 
 
+def flash_varlen_attention(
+    q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, dropout_p=0.0, softmax_scale=None
+):
+    feat = flash_attn.flash_attn_varlen_func(
+        q.half(), k.half(), v.half(), cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+        dropout_p=dropout_p, softmax_scale=softmax_scale
+    )
+    return feat.to(q.dtype)
+
+
+def sdpa_varlen_attention(
+    q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, dropout_p=0.0, softmax_scale=None
+):
+    """
+    The sequences with the same (query length, key length) are gathered into one dense
+    scaled_dot_product_attention call, so nothing is padded nor masked: the attention scores
+    of a call cover its group only, never batch size x the longest sequences. The lengths
+    are read to the host once. The queries of a sequence without keys get a zero output,
+    as with flash_attn.
+    """
+    device = q.device
+    feat = q.new_zeros(q.shape[:2] + v.shape[2:])
+    if q.size(0) == 0 or k.size(0) == 0:
+        return feat
+
+    # one host sync for the lengths of all the sequences, grouped on the host
+    cu_seqlens = torch.stack([cu_seqlens_q, cu_seqlens_k], dim=1).long().cpu()
+    starts, seqlens = cu_seqlens[:-1], cu_seqlens[1:] - cu_seqlens[:-1]
+    groups, group_ids = torch.unique(seqlens, dim=0, return_inverse=True)
+
+    for g, (len_q, len_k) in enumerate(groups.tolist()):
+        if len_q == 0 or len_k == 0:
+            continue
+        seq_starts = starts[group_ids == g]
+        q_idx = (seq_starts[:, :1] + torch.arange(len_q)).flatten().to(device, non_blocking=True)
+        k_idx = (seq_starts[:, 1:] + torch.arange(len_k)).flatten().to(device, non_blocking=True)
+        # (#seqs, #heads, len, #dim)
+        q_g = q[q_idx].view(-1, len_q, *q.shape[1:]).transpose(1, 2)
+        k_g = k[k_idx].view(-1, len_k, *k.shape[1:]).transpose(1, 2)
+        v_g = v[k_idx].view(-1, len_k, *v.shape[1:]).transpose(1, 2)
+        feat_g = F.scaled_dot_product_attention(
+            q_g, k_g, v_g, dropout_p=dropout_p, scale=softmax_scale
+        )
+        feat[q_idx] = feat_g.transpose(1, 2).flatten(0, 1).to(feat.dtype)
+    return feat
+
+
+# all backends take packed sequences, q: (#q tokens, #heads, #dim), k/v: (#k tokens, #heads, #dim),
+# the queries cu_seqlens_q[i]:cu_seqlens_q[i+1] attend the keys cu_seqlens_k[i]:cu_seqlens_k[i+1]
+ATTENTION_BACKENDS = {
+    'flash': flash_varlen_attention,
+    'sdpa': sdpa_varlen_attention,
+}
+
+
+def varlen_attention(
+    q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+    dropout_p=0.0, softmax_scale=None, backend='flash'
+):
+    # flash_attn only runs on cuda, fall back to sdpa on cpu or when it is not installed
+    if backend == 'flash' and (flash_attn is None or not q.is_cuda):
+        backend = 'sdpa'
+    return ATTENTION_BACKENDS[backend](
+        q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+        dropout_p=dropout_p, softmax_scale=softmax_scale
+    )
+
+
+@torch.no_grad()
+def get_padding_plan(offset, patch_size):
+    """
+    Pad each point cloud to a multiple of patch_size (if it has more than patch_size points)
+    by repeating the points of its previous patch.
+
+    Returns:
+        pad: (#padded points, ), index of the original point at each padded position
+        unpad: (#points, ), padded position of each original point
+        cu_seqlens: (#patches + 1, ) int32, start of each patch in the padded points
+    """
+    bincount = offset2bincount(offset)
+    bincount_pad = (
+        torch.div(
+            bincount + patch_size - 1,
+            patch_size,
+            rounding_mode="trunc",
+        )
+        * patch_size
+    )
+    # only pad point when num of points larger than patch_size
+    mask_pad = bincount > patch_size
+    bincount_pad = ~mask_pad * bincount + mask_pad * bincount_pad
+    _offset = nn.functional.pad(offset, (1, 0))
+    _offset_pad = nn.functional.pad(torch.cumsum(bincount_pad, dim=0), (1, 0))
+    num_points, num_points_pad = _offset[-1].item(), _offset_pad[-1].item()
+    sample_ids = torch.arange(len(offset), device=offset.device)
+
+    unpad_batch = torch.repeat_interleave(sample_ids, bincount, output_size=num_points)
+    unpad = torch.arange(num_points, device=offset.device)
+    unpad = unpad + (_offset_pad[:-1] - _offset[:-1])[unpad_batch]
+
+    # the padded tail of a point cloud repeats the points one patch before
+    pad_batch = torch.repeat_interleave(sample_ids, bincount_pad, output_size=num_points_pad)
+    pad = torch.arange(num_points_pad, device=offset.device) - _offset_pad[:-1][pad_batch]
+    pad = pad - (pad >= bincount[pad_batch]).long() * patch_size
+    pad = pad + _offset[:-1][pad_batch]
+
+    num_patches = torch.div(bincount_pad + patch_size - 1, patch_size, rounding_mode="trunc")
+    patch_batch = torch.repeat_interleave(sample_ids, num_patches)
+    patch_starts = nn.functional.pad(torch.cumsum(num_patches, dim=0), (1, 0))
+    cu_seqlens = _offset_pad[:-1][patch_batch] + \
+        (torch.arange(len(patch_batch), device=offset.device) - patch_starts[:-1][patch_batch]) * patch_size
+    cu_seqlens = nn.functional.pad(cu_seqlens.int(), (0, 1), value=num_points_pad)
+    return pad, unpad, cu_seqlens
+
+
 class SerializedAttention(PointModule):
     def __init__(
         self,
@@ -435,16 +570,21 @@ class SerializedAttention(PointModule):
             assert (
                 upcast_softmax is False
             ), "Set upcast_softmax to False when enable Flash Attention"
-            assert flash_attn is not None, "Make sure flash_attn is installed. or set enable_flash to False"
             self.patch_size = patch_size
             self.attn_drop = attn_drop
-        else:
-            # when disable flash attention, we still don't want to use mask
+        elif enable_rpe:
+            # the relative position bias needs dense patches without mask,
             # consequently, patch size will auto set to the
             # min number of patch_size_max and number of points
             self.patch_size_max = patch_size
             self.patch_size = 0
             self.attn_drop = torch.nn.Dropout(attn_drop)
+        else:
+            # the same patches as flash attention, computed by sdpa (see varlen_attention)
+            self.patch_size = patch_size
+            self.attn_drop = attn_drop
+        # falls back to sdpa if flash_attn is not available
+        self.attn_backend = 'flash' if enable_flash else 'sdpa'
 
         self.qkv = torch.nn.Linear(channels, channels * 3, bias=qkv_bias)
         self.proj = torch.nn.Linear(channels, channels)
@@ -472,64 +612,23 @@ class SerializedAttention(PointModule):
 
     @torch.no_grad()
     def get_padding_and_inverse(self, point):
-        pad_key = "pad"
-        unpad_key = "unpad"
-        cu_seqlens_key = "cu_seqlens_key"
+        # the plan only depends on offset and patch size, shared by all the blocks of a stage
+        pad_key = f"pad_{self.patch_size}"
+        unpad_key = f"unpad_{self.patch_size}"
+        cu_seqlens_key = f"cu_seqlens_{self.patch_size}"
         if (
             pad_key not in point.keys()
             or unpad_key not in point.keys()
             or cu_seqlens_key not in point.keys()
         ):
-            offset = point.offset
-            bincount = offset2bincount(offset)
-            bincount_pad = (
-                torch.div(
-                    bincount + self.patch_size - 1,
-                    self.patch_size,
-                    rounding_mode="trunc",
-                )
-                * self.patch_size
-            )
-            # only pad point when num of points larger than patch_size
-            mask_pad = bincount > self.patch_size
-            bincount_pad = ~mask_pad * bincount + mask_pad * bincount_pad
-            _offset = nn.functional.pad(offset, (1, 0))
-            _offset_pad = nn.functional.pad(torch.cumsum(bincount_pad, dim=0), (1, 0))
-            pad = torch.arange(_offset_pad[-1], device=offset.device)
-            unpad = torch.arange(_offset[-1], device=offset.device)
-            cu_seqlens = []
-            for i in range(len(offset)):
-                unpad[_offset[i] : _offset[i + 1]] += _offset_pad[i] - _offset[i]
-                if bincount[i] != bincount_pad[i]:
-                    pad[
-                        _offset_pad[i + 1]
-                        - self.patch_size
-                        + (bincount[i] % self.patch_size) : _offset_pad[i + 1]
-                    ] = pad[
-                        _offset_pad[i + 1]
-                        - 2 * self.patch_size
-                        + (bincount[i] % self.patch_size) : _offset_pad[i + 1]
-                        - self.patch_size
-                    ]
-                pad[_offset_pad[i] : _offset_pad[i + 1]] -= _offset_pad[i] - _offset[i]
-                cu_seqlens.append(
-                    torch.arange(
-                        _offset_pad[i],
-                        _offset_pad[i + 1],
-                        step=self.patch_size,
-                        dtype=torch.int32,
-                        device=offset.device,
-                    )
-                )
+            pad, unpad, cu_seqlens = get_padding_plan(point.offset, self.patch_size)
             point[pad_key] = pad
             point[unpad_key] = unpad
-            point[cu_seqlens_key] = nn.functional.pad(
-                torch.concat(cu_seqlens), (0, 1), value=_offset_pad[-1]
-            )
+            point[cu_seqlens_key] = cu_seqlens
         return point[pad_key], point[unpad_key], point[cu_seqlens_key]
 
     def forward(self, point):
-        if not self.enable_flash:
+        if self.enable_rpe:
             self.patch_size = min(
                 offset2bincount(point.offset).min().tolist(), self.patch_size_max
             )
@@ -559,7 +658,7 @@ class SerializedAttention(PointModule):
         else:
             qkv = self.qkv(point.feat)[order]
 
-        if not self.enable_flash:
+        if self.enable_rpe:
             # encode and reshape qkv: (N', K, 3, H, C') => (3, N', H, K, C')
             q, k, v = (
                 qkv.reshape(-1, K, 3, H, C // H).permute(2, 0, 3, 1, 4).unbind(dim=0)
@@ -601,14 +700,14 @@ class SerializedAttention(PointModule):
                 ).exp()
                 q = F.normalize(q, dim=-1) * logit_scale
                 k = F.normalize(k, dim=-1)
-            qkv = torch.stack([q, k, v], dim=1)     # (N'*K, 3, H, C')
+            if self.upcast_attention:
+                q, k, v = q.float(), k.float(), v.float()
 
-            feat = flash_attn.flash_attn_varlen_qkvpacked_func(
-                qkv.half(), #.reshape(-1, 3, H, C // H),
-                cu_seqlens,
-                max_seqlen=self.patch_size,
+            feat = varlen_attention(
+                q, k, v, cu_seqlens, cu_seqlens, self.patch_size, self.patch_size,
                 dropout_p=self.attn_drop if self.training else 0,
                 softmax_scale=self.scale if not self.scaled_cosine_attn else 1,
+                backend=self.attn_backend,
             ).reshape(-1, C)
             feat = feat.to(qkv.dtype)
         feat = feat[inverse]
@@ -1188,6 +1287,7 @@ class CrossAttention(PointModule):
         self.scale = self.head_dim ** -0.5
         self.qk_norm = qk_norm
         self.enable_flash = enable_flash
+        self.attn_backend = 'flash' if enable_flash else 'sdpa'
 
         # TODO: eps should be 1 / 65530 if using fp16 (eps=1e-6)
         self.q_norm = nn.LayerNorm(self.head_dim, elementwise_affine=True, eps=1e-6) if self.qk_norm else nn.Identity()
@@ -1201,48 +1301,19 @@ class CrossAttention(PointModule):
 
         q = self.q_norm(q)
         k = self.k_norm(kv[:, 0])
-        kv = torch.stack([k, kv[:, 1]], dim=1)
 
-        if self.enable_flash:
-            cu_seqlens_q = torch.cat([torch.zeros(1).int().to(device), point.offset.int()], dim=0)
-            cu_seqlens_k = torch.cat([torch.zeros(1).int().to(device), point.context_offset.int()], dim=0)
-            max_seqlen_q = offset2bincount(point.offset).max()
-            max_seqlen_k = offset2bincount(point.context_offset).max()
+        # q: (#all points, #heads, #dim)
+        # k/v: (#all words, #heads, #dim)
+        cu_seqlens_q = torch.cat([torch.zeros(1).int().to(device), point.offset.int()], dim=0)
+        cu_seqlens_k = torch.cat([torch.zeros(1).int().to(device), point.context_offset.int()], dim=0)
+        max_seqlen_q = offset2bincount(point.offset).max()
+        max_seqlen_k = offset2bincount(point.context_offset).max()
 
-            feat = flash_attn.flash_attn_varlen_kvpacked_func(
-                q.half(), kv.half(), cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
-                dropout_p=self.attn_drop if self.training else 0,
-                softmax_scale=self.scale
-            ).reshape(-1, self.channels)
-            feat = feat.to(q.dtype)
-        else:
-            # q: (#all points, #heads, #dim)
-            # kv: (#all words, k/v, #heads, #dim)
-            # print(q.size(), kv.size())
-            npoints_in_batch = offset2bincount(point.offset).data.cpu().numpy().tolist()
-            nwords_in_batch = offset2bincount(point.context_offset).data.cpu().numpy().tolist()
-            word_padded_masks = torch.from_numpy(
-                gen_seq_masks(nwords_in_batch)
-            ).to(q.device).logical_not()
-            # print(word_padded_masks)
-
-            q_pad = pad_tensors_wgrad(
-                torch.split(q, npoints_in_batch, dim=0), npoints_in_batch
-            )
-            kv_pad = pad_tensors_wgrad(
-                torch.split(kv, nwords_in_batch), nwords_in_batch
-            )
-            # q_pad: (batch_size, #points, #heads, #dim)
-            # kv_pad: (batch_size, #words, k/v, #heads, #dim)
-            # print(q_pad.size(), kv_pad.size())
-            logits = torch.einsum('bphd,bwhd->bpwh', q_pad, kv_pad[:, :, 0]) * self.scale
-            logits.masked_fill_(word_padded_masks.unsqueeze(1).unsqueeze(-1), -1e4)
-            attn_probs = torch.softmax(logits, dim=2)
-            # print(attn_probs.size())
-            feat = torch.einsum('bpwh,bwhd->bphd', attn_probs, kv_pad[:, :, 1])
-            feat = torch.cat([ft[:npoints_in_batch[i]] for i, ft in enumerate(feat)], 0)
-            feat = feat.reshape(-1, self.channels).float()
-            # print(feat.size())
+        feat = varlen_attention(
+            q, k, kv[:, 1], cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+            dropout_p=self.attn_drop if self.training else 0,
+            softmax_scale=self.scale, backend=self.attn_backend
+        ).reshape(-1, self.channels)
 
         # ffn
         feat = self.proj(feat)
@@ -1698,6 +1769,7 @@ class QuerySupportAttention(PointModule):
         self.qk_norm = qk_norm
         self.enable_flash = enable_flash
         self.enable_rope = enable_rope
+        self.attn_backend = 'flash' if enable_flash else 'sdpa'
         
         if self.enable_rope:
             self.roper = RotaryPositionEncoding3D(self.head_dim)
@@ -1706,71 +1778,51 @@ class QuerySupportAttention(PointModule):
         self.q_norm = nn.LayerNorm(self.head_dim, elementwise_affine=True, eps=1e-6) if self.qk_norm else nn.Identity() # TODO: why not use LayerNorm
         self.k_norm = nn.LayerNorm(self.head_dim, elementwise_affine=True, eps=1e-6) if self.qk_norm else nn.Identity()
 
-    def forward(self, anchor: Point, point: Point):
-        device = point.feat.device
+    def prepare_support(self, point: Point):
+        """
+        Projected and normalized keys/values of the support points, with their sequence
+        layout for the attention kernel. They only depend on the support points, so
+        one observation reuses them for every denoising step (see PTv3withNeck.kv_cache).
+        """
+        kv = self.kv(point.feat).view(-1, 2, self.num_heads, self.head_dim)
+        # NOTE: keys are not rotary-embedded, rope is only applied to the queries
+        k = self.k_norm(kv[:, 0])
+        kv = torch.stack([k, kv[:, 1]], dim=1)
 
+        support = {
+            'kv': kv,
+            'cu_seqlens': torch.cat([torch.zeros(1).int().to(kv.device), point.offset.int()], dim=0),
+            'max_seqlen': offset2bincount(point.offset).max(),
+        }
+        return support
 
+    def forward(self, anchor: Point, point: Point, support=None):
+        device = anchor.feat.device
+
+        if support is None:
+            support = self.prepare_support(point)
 
         q = self.q(anchor.feat).view(-1, self.num_heads, self.head_dim)
-        kv = self.kv(point.feat).view(-1, 2, self.num_heads, self.head_dim)
         
         if self.enable_rope:
-        # calc 3d-rope
-
-            q_cos, q_sin = self.roper(anchor.coord)
-            k_cos, k_sin = self.roper(point.coord)
-            # apply rope at q and k, not v.
-            # print("qkv shape", q.shape, kv.shape)
-            q = embed_rotary(q, q_cos, q_sin)
-
-            # apply Film here
-            k = embed_rotary(kv[:, 0], k_cos, k_sin)
+            # calc 3d-rope, apply rope at q only
+            # the table only depends on the anchor coords, shared by the neck levels of a step
+            rope_key = f"rope_{self.head_dim}"
+            if rope_key not in anchor.keys():
+                anchor[rope_key] = self.roper.rotation(anchor.coord)
+            q = apply_rotary(q, anchor[rope_key])
             
         q = self.q_norm(q)
-        k = self.k_norm(kv[:, 0])
-        kv = torch.stack([k, kv[:, 1]], dim=1)
-
-        if self.enable_flash:
-            cu_seqlens_q = torch.cat([torch.zeros(1).int().to(device), anchor.offset.int()], dim=0)
-            cu_seqlens_k = torch.cat([torch.zeros(1).int().to(device), point.offset.int()], dim=0)
-
-            max_seqlen_q = offset2bincount(anchor.offset).max() # TODO: known
-            max_seqlen_k = offset2bincount(point.offset).max()
 
-            feat = flash_attn.flash_attn_varlen_kvpacked_func(
-                q.half(), kv.half(), cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
-                dropout_p=self.attn_drop if self.training else 0,
-                softmax_scale=self.scale
-            ).reshape(-1, self.channels)
-            feat = feat.to(q.dtype)
-        else:
-            # raise NotImplementedError
-            # q: (#all points, #heads, #dim)
-            # kv: (#all words, k/v, #heads, #dim)
-            # print(q.size(), kv.size())
-            nanchors_in_batch = offset2bincount(anchor.offset).data.cpu().numpy().tolist()
-            npoints_in_batch = offset2bincount(point.offset).data.cpu().numpy().tolist()
-
-            point_padded_masks = torch.from_numpy(
-                gen_seq_masks(npoints_in_batch)
-            ).to(q.device).logical_not()
-
-            q_pad = pad_tensors_wgrad(
-                torch.split(q, nanchors_in_batch, dim=0), nanchors_in_batch
-            )
-            kv_pad = pad_tensors_wgrad(
-                torch.split(kv, npoints_in_batch), npoints_in_batch
-            )
-            # q_pad: (batch_size, #points, #heads, #dim)
-            # kv_pad: (batch_size, #words, k/v, #heads, #dim)
-            # print(q_pad.size(), kv_pad.size())
-            logits = torch.einsum('bqhd,bkhd->bqkh', q_pad, kv_pad[:, :, 0]) * self.scale
-            logits.masked_fill_(point_padded_masks.unsqueeze(1).unsqueeze(-1), -1e4)
-            attn_probs = torch.softmax(logits, dim=2)
+        kv = support['kv']
+        cu_seqlens_q = torch.cat([torch.zeros(1).int().to(device), anchor.offset.int()], dim=0)
+        max_seqlen_q = offset2bincount(anchor.offset).max() # TODO: known
 
-            feat = torch.einsum('bqkh,bkhd->bqhd', attn_probs, kv_pad[:, :, 1])
-            feat = torch.cat([ft[:nanchors_in_batch[i]] for i, ft in enumerate(feat)], 0)
-            feat = feat.reshape(-1, self.channels).float()
+        feat = varlen_attention(
+            q, kv[:, 0], kv[:, 1], cu_seqlens_q, support['cu_seqlens'], max_seqlen_q, support['max_seqlen'],
+            dropout_p=self.attn_drop if self.training else 0,
+            softmax_scale=self.scale, backend=self.attn_backend
+        ).reshape(-1, self.channels)
 
         # ffn
         feat = self.proj(feat)
@@ -1815,14 +1867,14 @@ class NeckBlock(nn.Module):
             )
         )
 
-    def forward(self, anchor: Point, point: Point):
+    def forward(self, anchor: Point, point: Point, support=None):
 
         shortcut = anchor.feat
         # print(anchor.feat.size(), anchor.context.size())
         if self.pre_norm:
             anchor = self.norm1(anchor)
         # print(anchor.feat.size(), anchor.context.size())
-        anchor = self.attn(anchor, point)
+        anchor = self.attn(anchor, point, support=support)
         # print(anchor.feat.size(), anchor.context.size())
         anchor.feat = shortcut + anchor.feat
         if not self.pre_norm:
@@ -1891,6 +1943,8 @@ class PTv3withNeck(PointTransformerV3):
         self.shuffle_orders = shuffle_orders
         self.layer_cache = []
         self.conv_cache = []
+        self.kv_cache = []
+        self.voxel_index = []
         self.local_conv = local_conv
         print("=== enable conv cache:", local_conv)
         self.enable_rope = enable_rope
@@ -2161,39 +2215,46 @@ class PTv3withNeck(PointTransformerV3):
         2. "grid_coord": discrete coordinate after grid sampling (voxelization) or "coord" + "grid_size"
         3. "offset" or "batch": https://github.com/Pointcept/Pointcept?tab=readme-ov-file#offset
         """
-        point = Point(data_dict)
-        anchor = self.anchor_proj(Point(anchor_dict))
-        point.serialization(order=self.order, shuffle_orders=self.shuffle_orders)
-        point.sparsify()
-        # print('before', offset2bincount(point.offset))
-
-        point = self.embedding(point)
-        point = self.enc(point)
+        with record_region('encoder'):
+            point = Point(data_dict)
+            anchor = self.anchor_proj(Point(anchor_dict))
+            point.serialization(order=self.order, shuffle_orders=self.shuffle_orders)
+            point.sparsify()
+            # print('before', offset2bincount(point.offset))
+
+            point = self.embedding(point)
+            point = self.enc(point)
         # print('after', offset2bincount(point.offset))
         
 
         layer_outputs = [self._pack_point_dict(point)]
-        if self.local_conv:
-            conv = self.mid_conv(point)
-            anchor.feat = anchor.feat + self.query_from_support(anchor, conv)
+        with record_region('neck'):
+            if self.local_conv:
+                conv = self.mid_conv(point)
+                anchor.feat = anchor.feat + self.query_from_support(anchor, conv)
         
-        anchor = self.nec[0](anchor, point)
+            anchor = self.nec[0](anchor, point)
 
         if not self.cls_mode:
             if return_dec_layers:
                 for i in range(len(self.dec)):
                     for dec_block in self.dec[i]:
+                        # the decoder and neck blocks alternate, timed as separate regions
                         if type(dec_block) == CABlock:
-                            point = dec_block(point)
-                            layer_outputs.append(self._pack_point_dict(Point(point)))
+                            with record_region('decoder'):
+                                point = dec_block(point)
+                                layer_outputs.append(self._pack_point_dict(Point(point)))
                             if not self.local_conv:
-                                anchor = self.nec[i+1](anchor, point)
+                                with record_region('neck'):
+                                    anchor = self.nec[i+1](anchor, point)
                         elif type(dec_block) == ConvBlock:
-                            conv = dec_block(point)
-                            anchor.feat = anchor.feat + self.query_from_support(anchor, conv)
-                            anchor = self.nec[i+1](anchor, point)
+                            with record_region('neck'):
+                                conv = dec_block(point)
+                                anchor.feat = anchor.feat + self.query_from_support(anchor, conv)
+                                anchor = self.nec[i+1](anchor, point)
                         else:
-                            point = dec_block(point) # TODO: should change
+                            with record_region('decoder'):
+                                point = dec_block(point) # TODO: should change
 
                 return layer_outputs, anchor
             else:
@@ -2253,6 +2314,18 @@ class PTv3withNeck(PointTransformerV3):
                         else:
                             point = dec_block(point) # TODO: should change
 
+                # keys/values of the neck attention are fixed for this observation
+                for i in range(self.nec_layer_num):
+                    self.kv_cache.append(self.nec[i].attn.prepare_support(self.layer_cache[i]))
+                # so are the voxels of the local conv features
+                for conv_f in self.conv_cache:
+                    index_k = torch.cat(
+                        [conv_f.batch.unsqueeze(-1).int(), conv_f.grid_coord.int()], dim=1
+                    ).contiguous()
+                    self.voxel_index.append(
+                        VoxelHashIndex(index_k, conv_f.feat, conv_f.sparse_shape)
+                    )
+
                 return layer_outputs
             # else:
             #     for i in range(len(self.dec)):
@@ -2271,6 +2344,8 @@ class PTv3withNeck(PointTransformerV3):
     def clear_cache(self):
         self.layer_cache.clear()
         self.conv_cache.clear()
+        self.kv_cache.clear()
+        self.voxel_index.clear()
     
     @torch.inference_mode()
     def neck_inference(self, data_dict, return_dec_layers=False):
@@ -2297,22 +2372,17 @@ class PTv3withNeck(PointTransformerV3):
 
             # print(self.conv_cache[i].feat.shape)
             if self.local_conv:
-                conv_f = self.conv_cache[i]
-                anchor.grid_based_on(conv_f)
-                index_k =torch.cat(
-                [conv_f.batch.unsqueeze(-1).int(), conv_f.grid_coord.int()], dim=1
-                ).contiguous()
+                anchor.grid_based_on(self.conv_cache[i])
                 query =torch.cat(
                 [anchor.batch.unsqueeze(-1).int(), anchor.grid_coord.int()], dim=1
                 ).contiguous()
 
-
-                q_f = retrieve_aligned_features(index_k, conv_f.feat, query, conv_f.sparse_shape)
+                q_f = self.voxel_index[i].query(query)
             
                 # add local features
 
                 anchor.feat = anchor.feat + q_f
-            anchor = self.nec[i](anchor, self.layer_cache[i])
+            anchor = self.nec[i](anchor, self.layer_cache[i], support=self.kv_cache[i])
         return anchor
     
 
@@ -2373,6 +2443,60 @@ def retrieve_aligned_features(indices, features, queries, spatial_shape):
 
 
 
+class VoxelHashIndex(object):
+    """
+    Sorted-hash lookup table over the voxels of a sparse tensor, a reusable version
+    of retrieve_aligned_features for a fixed support set.
+
+    Building sorts the N support hashes once, every query is a searchsorted,
+    i.e. O(Q log N) instead of a torch.unique over N + Q hashes.
+
+    Parameters:
+        indices: Tensor[int], shape = [num_points, 4] (batch, x, y, z)
+        features: Tensor[float], shape = [num_points, feature_dim]
+        spatial_shape: tuple/list (X, Y, Z), spatial boundary
+    """
+    def __init__(self, indices, features, spatial_shape):
+        device = indices.device
+        self.spatial_shape = torch.tensor(spatial_shape, device=device)
+        self.hash_scale = torch.tensor([
+            spatial_shape[0] * spatial_shape[1] * spatial_shape[2],
+            spatial_shape[1] * spatial_shape[2],
+            spatial_shape[2],
+            1
+        ], device=device, dtype=torch.long)
+
+        indices_hash = (indices.long() * self.hash_scale).sum(dim=1)
+        self.sorted_hash, order = torch.sort(indices_hash)
+        self.features = features[order]
+
+    def query(self, queries):
+        """
+        Parameters:
+            queries: Tensor[int], shape = [num_queries, 4] (batch, x, y, z)
+
+        Returns:
+            aligned_features: Tensor[float], shape = [num_queries, feature_dim]
+                              aligned features, zeros if no match.
+        """
+        aligned_features = torch.zeros(
+            (queries.size(0), self.features.size(1)), device=self.features.device
+        )
+        if self.sorted_hash.size(0) == 0:
+            return aligned_features
+
+        queries_hash = (queries.long() * self.hash_scale).sum(dim=1)
+        valid_mask = ((queries[:, 1:] >= 0) & (queries[:, 1:] < self.spatial_shape)).all(dim=1)
+
+        pos = torch.searchsorted(self.sorted_hash, queries_hash)
+        pos = pos.clamp_(max=self.sorted_hash.size(0) - 1)
+        matched = valid_mask & (self.sorted_hash[pos] == queries_hash)
+
+        aligned_features[matched] = self.features[pos[matched]].to(aligned_features.dtype)
+        return aligned_features
+
+
+
 if __name__ == "__main__":
     # Example inputs
     indices = torch.tensor([
@@ -26,6 +26,14 @@ class BaseModel(nn.Module):
                 nparams += 1
         return nweights, nparams
 
+    @classmethod
+    def required_targets(cls, config):
+        """
+        Optional supervision targets of the datasets (e.g. 'disc_pos_probs') that the model
+        built from config reads. The datasets skip computing and collating the others.
+        """
+        return []
+
     def prepare_batch(self, batch):
         device = next(self.parameters()).device
         for k, v in batch.items():
@@ -1,12 +1,13 @@
-from scipy.spatial.transform import Rotation as R
-
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import einops
+import torch_scatter
 
 from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusers.schedulers.scheduling_ddim import DDIMScheduler
+from diffusers.schedulers.scheduling_dpmsolver_multistep import DPMSolverMultistepScheduler
 
 from minidiffuser.utils.rotation_transform import discrete_euler_to_quaternion
 from minidiffuser.models.base import BaseModel, RobotPoseEmbedding
@@ -16,6 +17,7 @@ from minidiffuser.models.PointTransformerV3.model import (
 )
 from minidiffuser.models.PointTransformerV3.model_with_neck import PTv3withNeck
 from minidiffuser.utils.action_position_utils import get_best_pos_from_disc_pos
+from minidiffuser.utils.profiling import record_region
 
 
 class SinusoidalTimestepEmbedding(torch.nn.Module):
@@ -32,6 +34,46 @@ class SinusoidalTimestepEmbedding(torch.nn.Module):
 
 
 
+def segment_attention_pool(embeds, logits, lens):
+    '''Softmax(logits)-weighted sum of embeds within each segment
+    Args:
+        embeds: (# all tokens, dim)
+        logits: (# all tokens, 1)
+        lens: LongTensor (batch, ), on the device of embeds
+    Return:
+        pooled embeds: (batch, dim)
+    '''
+    indptr = F.pad(torch.cumsum(lens, 0), (1, 0))
+    segment_ids = torch.repeat_interleave(
+        torch.arange(lens.size(0), device=lens.device), lens, output_size=embeds.size(0)
+    )
+    weights = torch_scatter.scatter_softmax(logits, segment_ids, dim=0)
+    return torch_scatter.segment_csr(weights * embeds, indptr, reduce='sum')
+
+
+def segment_max(feats, lens):
+    '''
+    Args:
+        feats: (# all points, dim)
+        lens: LongTensor (batch, ), on the device of feats
+    Return:
+        max pooled feats: (batch, dim)
+    '''
+    indptr = F.pad(torch.cumsum(lens, 0), (1, 0))
+    return torch_scatter.segment_csr(feats, indptr, reduce='max')
+
+
+def concat_by_segment(tensors, segment_ids):
+    '''Concatenate tensors and group the rows by segment id, rows of the same segment
+    keep their order (rows of tensors[0] first, then tensors[1], ...)
+    Args:
+        tensors: list of (n_i, dim)
+        segment_ids: list of LongTensor (n_i, )
+    '''
+    order = torch.sort(torch.cat(segment_ids, 0), stable=True)[1]
+    return torch.cat(tensors, 0)[order]
+
+
 class ActionHead(nn.Module):
     def __init__(
         self, reduce, pos_pred_type, rot_pred_type, hidden_size, dim_actions, 
@@ -93,13 +135,13 @@ class ActionHead(nn.Module):
         )
         
     def conditioned_rot(
-        self, point_embeds, npoints_in_batch, pos_condition
+        self, point_embeds, npoints_in_batch, pos_condition, num_samples=1
     ):
         '''
         Args:
             point_embeds: (# all points, dim)
             npoints_in_batch: (batch_size, )
-            pos_condition: (batch_size, 3)
+            pos_condition: (batch_size * num_samples, 3), laid out as (batch k)
         Return:
             pred_actions: (batch, num_steps, dim_actions)
         ''' 
@@ -107,8 +149,10 @@ class ActionHead(nn.Module):
 
 
         if self.reduce == 'max':
-            split_point_embeds = torch.split(point_embeds, npoints_in_batch)
-            pc_embeds = torch.stack([torch.max(x, 0)[0] for x in split_point_embeds], 0)
+            pc_embeds = segment_max(
+                point_embeds, torch.as_tensor(npoints_in_batch, device=point_embeds.device)
+            )
+            pc_embeds = einops.repeat(pc_embeds, 'n c -> (n k) c', k=num_samples)
             # print("pc_embeds_shape", pc_embeds.shape)
             # print("pos_condition_shape", pos_condition.shape)
             pc_embeds = torch.cat([pc_embeds, pos_condition], dim=-1)
@@ -187,43 +231,75 @@ class DiffPolicyPTV3(BaseModel):
             beta_schedule="scaled_linear",
             prediction_type="epsilon",
         )
+        # samplers used by forward_n_steps, built lazily from the training schedule
+        self.inference_noise_schedulers = {}
 
         # simply a 3 dim tensor represent the anchor identity
         self.anchor_embeding = nn.Parameter(torch.zeros(1, 3))
         self.noise_embedding = SinusoidalTimestepEmbedding(256)
 
+    @classmethod
+    def required_targets(cls, config):
+        # the position is supervised by the diffusion noise only, disc_pos_probs is never read
+        return []
+
     def prepare_ptv3_batch(self, batch):
         outs = {
             'coord': batch['pc_fts'][:, :3],
             'grid_size': self.config.action_config.voxel_size,
             'offset': batch['offset'],
-            'batch': offset2batch(batch['offset']),
+            # precomputed on the cpu by PrefetchLoader
+            'batch': batch['pc_batch_ids'] if 'pc_batch_ids' in batch else offset2batch(batch['offset']),
             'feat': batch['pc_fts'],
         }
         device = batch['pc_fts'].device
         # print("samples on device:", device)
 
-        # encode context for each point cloud
+        # encode context for each point cloud: [txt tokens, pose, step id]
         txt_embeds = self.txt_fc(batch['txt_embeds'])
-        ctx_embeds = torch.split(txt_embeds, batch['txt_lens'])
-        ctx_lens = torch.LongTensor(batch['txt_lens'])
+        ctx_lens = torch.as_tensor(batch['txt_lens'], device=device)
+        sample_ids = torch.arange(ctx_lens.size(0), device=device)
+        ctx_embeds = [txt_embeds]
+        ctx_ids = [torch.repeat_interleave(sample_ids, ctx_lens, output_size=txt_embeds.size(0))]
 
         if self.config.action_config.use_ee_pose:
-            pose_embeds = self.pose_embedding(batch['ee_poses'])
-            ctx_embeds = [torch.cat([c, e.unsqueeze(0)], dim=0) for c, e in zip(ctx_embeds, pose_embeds)]
-            ctx_lens += 1
+            ctx_embeds.append(self.pose_embedding(batch['ee_poses']))
+            ctx_ids.append(sample_ids)
+            ctx_lens = ctx_lens + 1
 
         if self.config.action_config.use_step_id:
-            step_embeds = self.stepid_embedding(batch['step_ids'])
-            ctx_embeds = [torch.cat([c, e.unsqueeze(0)], dim=0) for c, e in zip(ctx_embeds, step_embeds)]
-            ctx_lens += 1
+            ctx_embeds.append(self.stepid_embedding(batch['step_ids']))
+            ctx_ids.append(sample_ids)
+            ctx_lens = ctx_lens + 1
 
-        outs['context'] = torch.cat(ctx_embeds, 0)
-        outs['context_offset'] = torch.cumsum(ctx_lens, dim=0).to(device)
+        outs['context'] = concat_by_segment(ctx_embeds, ctx_ids)
+        outs['context_offset'] = torch.cumsum(ctx_lens, dim=0)
 
         return outs
 
     
+    def prepare_pooled_context(self, batch):
+        '''Text embeddings pooled per sample, plus pose and step id embeddings
+        Return:
+            ctx_embeds: (batch, context_channels)
+        '''
+        ctx_embeds = self.txt_fc(batch['txt_embeds'])
+        if self.config.action_config.txt_reduce == 'attn':
+            ctx_embeds = segment_attention_pool(
+                ctx_embeds, self.txt_attn_fc(batch['txt_embeds']),
+                torch.as_tensor(batch['txt_lens'], device=ctx_embeds.device)
+            )
+        
+        if self.config.action_config.use_ee_pose:
+            pose_embeds = self.pose_embedding(batch['ee_poses'])
+            ctx_embeds = ctx_embeds + pose_embeds
+
+        if self.config.action_config.use_step_id:
+            step_embeds = self.stepid_embedding(batch['step_ids'])
+            ctx_embeds = ctx_embeds + step_embeds
+
+        return ctx_embeds
+
     def prepare_noise_anchor(self, batch):
         gt_trans = batch['gt_actions'][:, :3]
         # repeat n times as mini-batch size
@@ -242,23 +318,7 @@ class DiffPolicyPTV3(BaseModel):
         )
 
         # encode context for each point cloud
-        ctx_embeds = self.txt_fc(batch['txt_embeds'])
-        if self.config.action_config.txt_reduce == 'attn':
-            txt_weights = torch.split(self.txt_attn_fc(batch['txt_embeds']), batch['txt_lens'])
-            txt_embeds = torch.split(ctx_embeds, batch['txt_lens'])
-            ctx_embeds = []
-            for txt_weight, txt_embed in zip(txt_weights, txt_embeds):
-                txt_weight = torch.softmax(txt_weight, 0)
-                ctx_embeds.append(torch.sum(txt_weight * txt_embed, 0))
-            ctx_embeds = torch.stack(ctx_embeds, 0)
-        
-        if self.config.action_config.use_ee_pose:
-            pose_embeds = self.pose_embedding(batch['ee_poses'])
-            ctx_embeds += pose_embeds
-
-        if self.config.action_config.use_step_id:
-            step_embeds = self.stepid_embedding(batch['step_ids'])
-            ctx_embeds += step_embeds
+        ctx_embeds = self.prepare_pooled_context(batch)
 
 
         context_emb = self.noise_embedding(noise_steps)
@@ -287,6 +347,53 @@ class DiffPolicyPTV3(BaseModel):
         }
         return outs
 
+    def get_inference_scheduler(self, sampler):
+        '''All samplers share the betas of position_noise_scheduler, 
+        so they run from the same epsilon-prediction checkpoint.
+            ddpm: ancestral sampling, the training scheduler itself
+            ddim: deterministic DDIM (eta=0)
+            dpmsolver: 2nd-order multistep DPM-Solver++ ODE solver
+        '''
+        if sampler not in self.inference_noise_schedulers:
+            train_config = self.position_noise_scheduler.config
+            if sampler == 'ddpm':
+                scheduler = self.position_noise_scheduler
+            elif sampler == 'ddim':
+                # trailing spacing starts at the last training timestep for few steps
+                scheduler = DDIMScheduler.from_config(
+                    train_config, timestep_spacing='trailing',
+                )
+            elif sampler == 'dpmsolver':
+                scheduler = DPMSolverMultistepScheduler.from_config(
+                    train_config, algorithm_type='dpmsolver++', solver_order=2,
+                    timestep_spacing='trailing', lower_order_final=True,
+                )
+            else:
+                raise ValueError(f'invalid sampler: {sampler}')
+            self.inference_noise_schedulers[sampler] = scheduler
+        return self.inference_noise_schedulers[sampler]
+
+    def rot_to_quaternion(self, pred_rot, ee_poses):
+        '''Convert the rotation head outputs to quaternions (no grad), on the model device
+        Args:
+            pred_rot: (batch, rot_dim) or (batch, euler_bins, 3) for euler_disc
+            ee_poses: (batch, dim), only used by euler_delta
+        '''
+        pred_rot = pred_rot.detach()
+        if self.config.action_config.rot_pred_type == 'rot6d':
+            pred_rot = self.rot_transform.ortho6d_to_quaternion(pred_rot).float()
+        elif self.config.action_config.rot_pred_type == 'euler':
+            pred_rot = pred_rot * 180
+            pred_rot = self.rot_transform.euler_to_quaternion(pred_rot).float()
+        elif self.config.action_config.rot_pred_type == 'euler_delta':
+            pred_rot = pred_rot * 180
+            cur_euler_angles = self.rot_transform.quaternion_to_euler(ee_poses[..., 3:7])
+            pred_rot = pred_rot + cur_euler_angles
+            pred_rot = self.rot_transform.euler_to_quaternion(pred_rot).float()
+        elif self.config.action_config.rot_pred_type == 'euler_disc':
+            pred_rot = torch.argmax(pred_rot, 1)
+            pred_rot = discrete_euler_to_quaternion(pred_rot, self.act_proj_head.euler_resolution).float()
+        return pred_rot
 
     def forward(self, batch: dict, compute_loss=False, **kwargs):
         '''batch data:
@@ -304,25 +411,26 @@ class DiffPolicyPTV3(BaseModel):
         if not self.training:
             return self.forward_n_steps(batch, compute_loss, **kwargs)
 
-        batch = self.prepare_batch(batch) # TODO: change here to add noise
+        with record_region('prepare_batch'):
+            batch = self.prepare_batch(batch) # TODO: change here to add noise
         
         
-        # batch = self.add_diffusion_noise(batch)
+            # batch = self.add_diffusion_noise(batch)
 
 
 
-        # print("points shape", batch['pc_fts'].shape)
+            # print("points shape", batch['pc_fts'].shape)
 
-        device = batch['pc_fts'].device
+            device = batch['pc_fts'].device
 
-        ptv3_batch = self.prepare_ptv3_batch(batch)
+            ptv3_batch = self.prepare_ptv3_batch(batch)
 
-        anchor = self.prepare_noise_anchor(batch)
+            anchor = self.prepare_noise_anchor(batch)
         
         
-        # add gussian noise 0.01
-        pos_condition = batch['gt_actions'][..., :3] + torch.randn(batch['gt_actions'][..., :3].shape, device=batch['gt_actions'].device) * 0.01
-        # in training, use noise gt_pose
+            # add gussian noise 0.01
+            pos_condition = batch['gt_actions'][..., :3] + torch.randn(batch['gt_actions'][..., :3].shape, device=batch['gt_actions'].device) * 0.01
+            # in training, use noise gt_pose
 
         point_outs, anchor_outs = self.ptv3_model.forward_train(ptv3_batch, anchor, return_dec_layers=True)
 
@@ -333,71 +441,85 @@ class DiffPolicyPTV3(BaseModel):
         # predict posi from noise
         # predict rot and openness
 
-        pred_pos = self.act_proj_head.forward_diffuse(
-            anchor_outs.feat
-        )
+        with record_region('action_head'):
+            pred_pos = self.act_proj_head.forward_diffuse(
+                anchor_outs.feat
+            )
         
-        pred_rot, pred_open = self.act_proj_head.conditioned_rot(
-            point_outs[-1].feat, batch['npoints_in_batch'], pos_condition=pos_condition
-        )
+            pred_rot, pred_open = self.act_proj_head.conditioned_rot(
+                point_outs[-1].feat, batch['npoints_in_batch'], pos_condition=pos_condition
+            )
           
 
-        action = pred_pos, pred_rot, pred_open
+            action = pred_pos, pred_rot, pred_open
 
-        if self.config.action_config.rot_pred_type == 'rot6d':
-            # no grad
-            pred_rot = self.rot_transform.matrix_to_quaternion(
-                self.rot_transform.compute_rotation_matrix_from_ortho6d(pred_rot.data.cpu())
-            ).float().to(device)
-        elif self.config.action_config.rot_pred_type == 'euler':
-            pred_rot = pred_rot * 180
-            pred_rot = self.rot_transform.euler_to_quaternion(pred_rot.data.cpu()).float().to(device)
-        elif self.config.action_config.rot_pred_type == 'euler_delta':
-            pred_rot = pred_rot * 180
-            cur_euler_angles = R.from_quat(batch['ee_poses'][..., 3:7].data.cpu()).as_euler('xyz', degrees=True)
-            pred_rot = pred_rot.data.cpu() + cur_euler_angles
-            pred_rot = self.rot_transform.euler_to_quaternion(pred_rot).float().to(device)
-        elif self.config.action_config.rot_pred_type == 'euler_disc':
-            pred_rot = torch.argmax(pred_rot, 1).data.cpu().numpy()
-            pred_rot = np.stack([discrete_euler_to_quaternion(x, self.act_proj_head.euler_resolution) for x in pred_rot], 0)
-            pred_rot = torch.from_numpy(pred_rot).to(device)
+            pred_rot = self.rot_to_quaternion(pred_rot, batch['ee_poses'])
         
         # final_pred_actions = torch.cat([pred_pos, pred_rot, pred_open.unsqueeze(-1)], dim=-1)
 
         final_pred_actions = None
         
         if compute_loss:
-            losses = self.compute_loss(
-                action, batch['gt_actions'], 
-                pos_noise=batch['gt_noise'], npoints_in_batch=batch['npoints_in_batch'])
+            with record_region('loss'):
+                losses = self.compute_loss(
+                    action, batch['gt_actions'], 
+                    pos_noise=batch['gt_noise'], npoints_in_batch=batch['npoints_in_batch'])
             return final_pred_actions, losses
         else:
             return final_pred_actions
 
     @torch.no_grad()
-    def forward_n_steps(self, batch: dict, compute_loss=False, is_dataset=False, **kwargs):
+    def forward_n_steps(
+        self, batch: dict, compute_loss=False, is_dataset=False, 
+        sampler=None, num_inference_steps=None, num_samples=1, 
+        init_pos=None, init_strength=1.0, **kwargs
+    ):
         '''batch data:
             pc_fts: (batch, npoints, dim)
             txt_embeds: (batch, txt_dim)
             # batch already concate by dataloader fetch func
+        sampler: ddpm, ddim or dpmsolver, default MODEL.diffusion.sampler
+        num_inference_steps: default MODEL.diffusion.inference_steps (total_timesteps if null)
+        num_samples: K hypotheses per observation denoised together from one encoder pass,
+            if K > 1 the actions are (batch, K, dim), see select_hypothesis
+        init_pos: (batch, 3) prior position (e.g. the previous action) to warm start from,
+            it is noised to an intermediate timestep and only the last init_strength 
+            fraction of the steps are run
         '''
         batch = self.prepare_batch(batch) # TODO: change here to add noise
 
-        self.position_noise_scheduler.set_timesteps(
-            self.config.diffusion.total_timesteps
-        )
-
-        
+        if sampler is None:
+            sampler = self.config.diffusion.get('sampler', 'ddpm')
+        if num_inference_steps is None:
+            num_inference_steps = self.config.diffusion.get('inference_steps', None) \
+                or self.config.diffusion.total_timesteps
+        noise_scheduler = self.get_inference_scheduler(sampler)
+        noise_scheduler.set_timesteps(num_inference_steps)
+        timesteps = noise_scheduler.timesteps # [inverse order]
+
+        if init_pos is not None:
+            # warm start: skip the first (1 - init_strength) of the steps
+            start_idx = min(int(len(timesteps) * (1 - init_strength)), len(timesteps) - 1)
+            timesteps = timesteps[start_idx:]
+            if hasattr(noise_scheduler, 'set_begin_index'):
+                noise_scheduler.set_begin_index(start_idx)
         
         gt_trans = batch['ee_poses'][:, :3] # borrow the shape
-        init_anchor = torch.zeros_like(gt_trans)
+        # K anchors per observation, laid out as (n k) like prepare_noise_anchor
+        gt_trans = einops.repeat(gt_trans, 'n c -> (n k) c', k=num_samples)
+        if init_pos is None:
+            init_anchor = torch.zeros_like(gt_trans)
+        else:
+            init_anchor = einops.repeat(
+                init_pos.to(gt_trans), 'n c -> (n k) c', k=num_samples
+            )
         noise = torch.randn(gt_trans.shape, device=gt_trans.device)
         noise_steps = torch.ones(
             (noise.shape[0], ),
             device=noise.device,
-        ).mul(self.position_noise_scheduler.timesteps[0]).long()
+        ).mul(timesteps[0]).long()
 
-        trans_input = self.position_noise_scheduler.add_noise(
+        trans_input = noise_scheduler.add_noise(
             init_anchor, noise, noise_steps
         )
 
@@ -419,33 +541,17 @@ class DiffPolicyPTV3(BaseModel):
         # predict posi from noise
         # predict rot and openness 
 
-        timesteps = self.position_noise_scheduler.timesteps # [inverse order]
-
 
         # encode context for each point cloud
-        ctx_embeds = self.txt_fc(batch['txt_embeds'])
-        if self.config.action_config.txt_reduce == 'attn':
-            txt_weights = torch.split(self.txt_attn_fc(batch['txt_embeds']), batch['txt_lens'])
-            txt_embeds = torch.split(ctx_embeds, batch['txt_lens'])
-            ctx_embeds = []
-            for txt_weight, txt_embed in zip(txt_weights, txt_embeds):
-                txt_weight = torch.softmax(txt_weight, 0)
-                ctx_embeds.append(torch.sum(txt_weight * txt_embed, 0))
-            ctx_embeds = torch.stack(ctx_embeds, 0)
-        
-        if self.config.action_config.use_ee_pose:
-            pose_embeds = self.pose_embedding(batch['ee_poses'])
-            ctx_embeds += pose_embeds
+        ctx_embeds = self.prepare_pooled_context(batch)
 
-        if self.config.action_config.use_step_id:
-            step_embeds = self.stepid_embedding(batch['step_ids'])
-            ctx_embeds += step_embeds
+        ctx_embeds = einops.repeat(ctx_embeds, 'n c -> (n k) c', k=num_samples)
 
         batch["trans_input"] = trans_input
         batch["gt_noise"] = noise
         batch["noise_steps"] = noise_steps
 
-        npoints_in_batch = torch.ones(batch['ee_poses'].shape[0], dtype=torch.long)
+        npoints_in_batch = torch.ones(batch['ee_poses'].shape[0], dtype=torch.long) * num_samples
         # offset is [n1, n1+n2, n1+n2+n3, ...]
         offset = torch.cumsum(torch.LongTensor(npoints_in_batch), dim=0).to(trans_input.device)
 
@@ -476,33 +582,19 @@ class DiffPolicyPTV3(BaseModel):
 
             # update coord and context
 
-            outs['coord'] = self.position_noise_scheduler.step(pred_noise, t, outs['coord']).prev_sample
+            outs['coord'] = noise_scheduler.step(pred_noise, t, outs['coord']).prev_sample
             outs['feat'] = outs['coord'].clone()
             
 
         pred_pos = outs['coord']
         
         pred_rot, pred_open = self.act_proj_head.conditioned_rot(
-            point_outs[-1].feat, batch['npoints_in_batch'], pos_condition=pred_pos
+            point_outs[-1].feat, batch['npoints_in_batch'], pos_condition=pred_pos,
+            num_samples=num_samples
         )
 
-        if self.config.action_config.rot_pred_type == 'rot6d':
-            # no grad
-            pred_rot = self.rot_transform.matrix_to_quaternion(
-                self.rot_transform.compute_rotation_matrix_from_ortho6d(pred_rot.data.cpu())
-            ).float().to(device)
-        elif self.config.action_config.rot_pred_type == 'euler':
-            pred_rot = pred_rot * 180
-            pred_rot = self.rot_transform.euler_to_quaternion(pred_rot.data.cpu()).float().to(device)
-        elif self.config.action_config.rot_pred_type == 'euler_delta':
-            pred_rot = pred_rot * 180
-            cur_euler_angles = R.from_quat(batch['ee_poses'][..., 3:7].data.cpu()).as_euler('xyz', degrees=True)
-            pred_rot = pred_rot.data.cpu() + cur_euler_angles
-            pred_rot = self.rot_transform.euler_to_quaternion(pred_rot).float().to(device)
-        elif self.config.action_config.rot_pred_type == 'euler_disc':
-            pred_rot = torch.argmax(pred_rot, 1).data.cpu().numpy()
-            pred_rot = np.stack([discrete_euler_to_quaternion(x, self.act_proj_head.euler_resolution) for x in pred_rot], 0)
-            pred_rot = torch.from_numpy(pred_rot).to(device)
+        ee_poses = einops.repeat(batch['ee_poses'], 'n c -> (n k) c', k=num_samples)
+        pred_rot = self.rot_to_quaternion(pred_rot, ee_poses)
             
         if is_dataset:
             # pred rot from gt pos
@@ -510,23 +602,10 @@ class DiffPolicyPTV3(BaseModel):
             point_outs[-1].feat, batch['npoints_in_batch'], pos_condition=gt_pos
         )
             
-            if self.config.action_config.rot_pred_type == 'rot6d':
-                # no grad
-                rot_from_gt = self.rot_transform.matrix_to_quaternion(
-                    self.rot_transform.compute_rotation_matrix_from_ortho6d(rot_from_gt.data.cpu())
-                ).float().to(device)
-            elif self.config.action_config.rot_pred_type == 'euler':
-                rot_from_gt = rot_from_gt * 180
-                rot_from_gt = self.rot_transform.euler_to_quaternion(rot_from_gt.data.cpu()).float().to(device)
-            elif self.config.action_config.rot_pred_type == 'euler_delta':
-                rot_from_gt = rot_from_gt * 180
-                cur_euler_angles = R.from_quat(batch['ee_poses'][..., 3:7].data.cpu()).as_euler('xyz', degrees=True)
-                rot_from_gt = rot_from_gt.data.cpu() + cur_euler_angles
-                rot_from_gt = self.rot_transform.euler_to_quaternion(rot_from_gt).float().to(device)
-            elif self.config.action_config.rot_pred_type == 'euler_disc':
-                rot_from_gt = torch.argmax(rot_from_gt, 1).data.cpu().numpy()
-                rot_from_gt = np.stack([discrete_euler_to_quaternion(x, self.act_proj_head.euler_resolution) for x in rot_from_gt], 0)
-                rot_from_gt = torch.from_numpy(rot_from_gt).to(device)
+            rot_from_gt = self.rot_to_quaternion(rot_from_gt, batch['ee_poses'])
+            # the same for all hypotheses of an observation
+            rot_from_gt = rot_from_gt.repeat_interleave(num_samples, dim=0)
+            open_from_gt = open_from_gt.repeat_interleave(num_samples, dim=0)
         
         
         
@@ -538,9 +617,47 @@ class DiffPolicyPTV3(BaseModel):
         else:
             final_pred_actions = torch.cat([pred_pos, pred_rot, pred_open.unsqueeze(-1)], dim=-1)
         
+        if num_samples > 1:
+            final_pred_actions = einops.rearrange(
+                final_pred_actions, '(n k) d -> n k d', k=num_samples
+            )
 
         return final_pred_actions
 
+    @torch.no_grad()
+    def select_hypothesis(self, actions, method='mode', bandwidth=None):
+        '''Reduce the hypotheses of forward_n_steps(num_samples=K) to one action per observation
+        Args:
+            actions: (batch, K, 3+4+1) position, quaternion and openness logit
+            method:
+                mode: the hypothesis with the highest gaussian kernel density of positions
+                cluster: average of the hypotheses within bandwidth of the mode
+            bandwidth: kernel width in normalized position space, default the voxel size
+        Return:
+            actions: (batch, 3+4+1)
+        '''
+        if bandwidth is None:
+            bandwidth = self.config.action_config.voxel_size
+        batch_idxs = torch.arange(actions.size(0), device=actions.device)
+
+        dists = torch.cdist(actions[..., :3], actions[..., :3]) # (batch, K, K)
+        density = torch.exp(-0.5 * (dists / bandwidth) ** 2).sum(-1)
+        mode_idxs = density.argmax(-1)
+        mode = actions[batch_idxs, mode_idxs]
+        if method == 'mode':
+            return mode
+        elif method == 'cluster':
+            members = (dists[batch_idxs, mode_idxs] <= bandwidth).float().unsqueeze(-1)
+            # q and -q are the same rotation, align them to the mode before averaging
+            quat = actions[..., 3:7]
+            sign = torch.where((quat * mode[:, None, 3:7]).sum(-1, keepdim=True) < 0, -1, 1)
+            quat = (quat * sign * members).sum(1)
+            quat = quat / quat.norm(dim=-1, keepdim=True)
+            avg_action = (actions * members).sum(1) / members.sum(1)
+            return torch.cat([avg_action[:, :3], quat, avg_action[:, 7:]], dim=-1)
+        else:
+            raise ValueError(f'invalid method: {method}')
+
     def compute_loss(self, pred_actions, tgt_actions, pos_noise, npoints_in_batch=None):
         """
         Args:
@@ -589,9 +706,7 @@ class DiffPolicyPTV3(BaseModel):
             select_mask = (rot_loss < rot_loss_).float()
             rot_loss = (select_mask * rot_loss + (1 - select_mask) * rot_loss_).mean()
         elif self.config.action_config.rot_pred_type == 'rot6d':
-            tgt_rot6d = self.rot_transform.get_ortho6d_from_rotation_matrix(
-                self.rot_transform.quaternion_to_matrix(tgt_rot.data.cpu())
-            ).float().to(device)
+            tgt_rot6d = self.rot_transform.quaternion_to_ortho6d(tgt_rot.detach()).float()
             rot_loss = F.mse_loss(pred_rot, tgt_rot6d)
         elif self.config.action_config.rot_pred_type == 'euler':
             # Automatically matching the closest angles
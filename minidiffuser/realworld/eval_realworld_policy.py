@@ -26,7 +26,7 @@ from minidiffuser.train.train_diffusion_realworld import MODEL_FACTORY
 from minidiffuser.configs.rlbench.constants import get_robot_workspace
 from minidiffuser.utils.robot_box import RobotBox
 from minidiffuser.train.datasets.common import gen_seq_masks
-from minidiffuser.evaluation.common import write_to_file
+from minidiffuser.evaluation.common import write_to_file, summarize_latency
 from minidiffuser.evaluation.eval_simple_policy import Actioner
 from minidiffuser.realworld.realworld_env import RealworldEnv, visualize_pointcloud 
 
@@ -47,6 +47,7 @@ class RealworldArguments(tap.Tap):
     wait_time: float = 0.5  # Wait time between action and next observation
     max_tries: int = 10  # Maximum number of steps per episode
     max_episodes: int = 5  # Maximum number of episodes to run
+    warm_start: float = 0  # >0: denoise this fraction of the steps from the previous action
 
 class RealworldActioner(object):
     def __init__(self, args) -> None:
@@ -84,6 +85,10 @@ class RealworldActioner(object):
         self.taskvar_instrs = json.load(open(data_cfg.taskvar_instr_file))
 
         self.TABLE_HEIGHT = self.WORKSPACE['TABLE_HEIGHT']
+
+        # previous action of the running episode for warm start
+        self.prev_action = None
+        self.latencies = {'cold': [], 'warm': []}
         
         # Set sample points parameters
         self.num_points = data_cfg.get('num_points', 4096)
@@ -282,25 +287,44 @@ class RealworldActioner(object):
         batch = self.preprocess_obs(
             taskvar, step_id, obs_state_dict,
         )
+        num_ensembles = getattr(self.args, 'num_ensembles', 1)
+        ensemble_select = getattr(self.args, 'ensemble_select', 'mode')
+
+        if step_id == 0:
+            self.prev_action = None
+        init_pos = None
+        if self.args.warm_start > 0 and self.prev_action is not None:
+            init_pos = (self.prev_action[:3] - batch['pc_centroids']) / batch['pc_radius']
+            init_pos = torch.from_numpy(init_pos).float().unsqueeze(0)
+
+        st = time.time()
         with torch.no_grad():
-            actions = []
-            for _ in range(getattr(self.args, 'num_ensembles', 1)):
-                action = self.model(batch)[0].data.cpu()
-                actions.append(action)
-            if len(actions) > 1:
-                avg_action = torch.stack(actions, 0).mean(0)
+            # all the ensembles share one encoder pass
+            actions = self.model(
+                batch, num_samples=num_ensembles,
+                init_pos=init_pos, init_strength=self.args.warm_start,
+            )
+            if num_ensembles > 1 and ensemble_select == 'mean':
+                actions = actions[0].data.cpu()
+                avg_action = actions.mean(0)
                 pred_rot = torch.from_numpy(R.from_euler(
                     'xyz', np.mean([R.from_quat(x[3:-1]).as_euler('xyz') for x in actions], 0),
                 ).as_quat())
                 action = torch.cat([avg_action[:3], pred_rot, avg_action[-1:]], 0)
+            elif num_ensembles > 1:
+                action = self.model.select_hypothesis(
+                    actions, method=ensemble_select
+                )[0].data.cpu()
             else:
-                action = actions[0]
+                action = actions[0].data.cpu()
+        self.latencies['cold' if init_pos is None else 'warm'].append(time.time() - st)
         action[-1] = torch.sigmoid(action[-1]) > 0.5
         
         action = action.numpy()
         action[:3] = action[:3] * batch['pc_radius'] + batch['pc_centroids']
         # Ensure the action height is above the table
         action[2] = max(action[2], self.TABLE_HEIGHT+0.005)
+        self.prev_action = copy.deepcopy(action)
 
         out = {
             'action': action
@@ -382,6 +406,7 @@ def main():
         import traceback
         traceback.print_exc()
     finally:
+        print(summarize_latency(actioner.latencies))
         # Ensure environment is disconnected
         if env.connected:
             env.disconnect()
@@ -0,0 +1,111 @@
+"""
+The point cloud augmentation of DPDataset._augment_pc on a collated batch of
+ptv3_collate_fn, instead of per sample in the DataLoader workers: a random rotation around
+the z-axis per sample, applied to the points, gripper poses and actions, and +-2mm noise.
+
+The batch is already normalized. The rotation commutes with the normalization (the
+centroid rotates with the points and the radius is unchanged), so rotating the normalized
+points around the origin is the same as rotating the raw points before normalizing them.
+"""
+import numpy as np
+import torch
+
+from minidiffuser.utils.rotation_transform import (
+    RotationMatrixTransform, quaternion_to_discrete_euler
+)
+
+
+def rotate_quaternion_z(quats, half_angles):
+    """Rotation around z (left product), quats: (batch, 4) xyzw, half_angles: (batch, )"""
+    x, y, z, w = quats.unbind(-1)
+    sz, cz = torch.sin(half_angles), torch.cos(half_angles)
+    return torch.stack([
+        cz * x - sz * y,
+        cz * y + sz * x,
+        cz * z + sz * w,
+        cz * w - sz * z,
+    ], -1)
+
+
+class BatchPointCloudAugmenter(object):
+    def __init__(
+            self, rot_type, aug_max_rot=45, euler_resolution=5, noise=0.002, device='cpu'
+        ):
+        """
+        aug_max_rot: degrees; noise: meters, scaled by the radius of each sample
+        device: where the batch is augmented, cpu or the training device
+        """
+        self.rot_type = rot_type
+        self.aug_max_rot = np.deg2rad(aug_max_rot)
+        self.euler_resolution = euler_resolution
+        self.noise = noise
+        self.device = torch.device(device)
+
+    def _get_rotations(self, gt_quats):
+        """The gt rotations of the actions as in DPDataset.__getitem__"""
+        if self.rot_type == 'quat':
+            return gt_quats
+        elif self.rot_type == 'euler':
+            return RotationMatrixTransform.quaternion_to_euler(gt_quats) / 180.
+        elif self.rot_type == 'euler_disc':
+            return quaternion_to_discrete_euler(gt_quats, self.euler_resolution).float()
+        elif self.rot_type == 'rot6d':
+            return RotationMatrixTransform.quaternion_to_ortho6d(gt_quats)
+        return None     # euler_delta: unchanged by a rotation around z
+
+    def __call__(self, batch):
+        """
+        batch: output of ptv3_collate_fn with the unaugmented gt quaternions of the actions
+        (gt_action_quats); the augmented tensors are moved to self.device
+        """
+        num_samples = len(batch['npoints_in_batch'])
+        # angles and rotation matrices on the cpu, so the centroids are updated without sync
+        angles = (torch.rand(num_samples, dtype=torch.float64) * 2 - 1) * self.aug_max_rot
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        zeros, ones = torch.zeros_like(cos), torch.ones_like(cos)
+        rot_mats = torch.stack([
+            cos, -sin, zeros,
+            sin, cos, zeros,
+            zeros, zeros, ones,
+        ], -1).view(num_samples, 3, 3)
+        if isinstance(batch.get('pc_centroids', None), np.ndarray):
+            batch['pc_centroids'] = np.einsum(
+                'bij,bj->bi', rot_mats.numpy(), batch['pc_centroids']
+            )
+
+        device = self.device
+        rot_mats = rot_mats.float().to(device, non_blocking=True)
+        npoints = torch.tensor(batch['npoints_in_batch'], device=device)
+        sample_idxs = torch.repeat_interleave(
+            torch.arange(num_samples, device=device), npoints,
+            output_size=sum(batch['npoints_in_batch'])
+        )
+
+        # one matmul over the points of all the samples, then the noise in normalized units
+        pc_fts = batch['pc_fts'].to(device, non_blocking=True)
+        xyz = torch.bmm(rot_mats[sample_idxs], pc_fts[:, :3].unsqueeze(-1)).squeeze(-1)
+        radius = torch.tensor(np.asarray(batch['pc_radius']), dtype=torch.float32, device=device)
+        xyz = xyz + torch.rand_like(xyz) * (self.noise / radius[sample_idxs]).unsqueeze(-1)
+        batch['pc_fts'] = torch.cat([xyz, pc_fts[:, 3:]], 1)
+
+        half_angles = (angles / 2).float().to(device, non_blocking=True)
+        ee_poses = batch['ee_poses'].to(device, non_blocking=True)
+        ee_poses = torch.cat([
+            torch.einsum('bij,bj->bi', rot_mats, ee_poses[:, :3]),
+            rotate_quaternion_z(ee_poses[:, 3:7], half_angles),
+            ee_poses[:, 7:],
+        ], 1)
+        batch['ee_poses'] = ee_poses
+
+        gt_actions = batch['gt_actions'].to(device, non_blocking=True)
+        gt_quats = rotate_quaternion_z(
+            batch['gt_action_quats'].to(device, non_blocking=True), half_angles
+        )
+        gt_rots = self._get_rotations(gt_quats)
+        if gt_rots is None:
+            gt_rots = gt_actions[:, 3:-1]
+        batch['gt_actions'] = torch.cat([
+            torch.einsum('bij,bj->bi', rot_mats, gt_actions[:, :3]), gt_rots, gt_actions[:, -1:]
+        ], 1)
+        batch['gt_action_quats'] = gt_quats
+        return batch
@@ -0,0 +1,92 @@
+"""
+Batch sampler that packs samples up to a total number of points instead of a fixed number
+of samples. The point clouds of a batch are concatenated (see ptv3_collate_fn), so the
+memory of the point transformer grows with the points of the batch, not with its samples.
+"""
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class PointBudgetBatchSampler(Sampler):
+    def __init__(
+            self, sample_npoints, max_points, shuffle=True, num_replicas=1, rank=0,
+            seed=0, drop_last=False
+        ):
+        """
+        sample_npoints: upper bound of the number of points of every sample of the dataset
+        max_points: budget of points of a batch (per rank), larger samples are batched alone
+        num_replicas, rank: DDP sharding, every rank gets the same number of batches
+        """
+        self.sample_npoints = np.asarray(sample_npoints, dtype=np.int64)
+        self.max_points = max_points
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._batches, self._batches_epoch = None, None
+        self._num_padded = 0
+
+    def set_epoch(self, epoch):
+        """Shuffles differently at every epoch, with the same order on all the ranks"""
+        self.epoch = epoch
+
+    def _pack(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.sample_npoints), generator=generator).numpy()
+        else:
+            order = np.arange(len(self.sample_npoints))
+
+        batches, batch, batch_npoints = [], [], 0
+        for idx in order:
+            npoints = self.sample_npoints[idx]
+            if len(batch) > 0 and batch_npoints + npoints > self.max_points:
+                batches.append(batch)
+                batch, batch_npoints = [], 0
+            batch.append(int(idx))
+            batch_npoints += npoints
+        if len(batch) > 0:
+            batches.append(batch)
+
+        # the same number of batches for every rank, padded with repeated batches
+        if self.drop_last:
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+            num_padded = 0
+        else:
+            num_total = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+            num_padded = num_total - len(batches)
+            batches = batches + batches[:num_padded]
+        return batches[self.rank::self.num_replicas], num_padded
+
+    def _get_batches(self):
+        if self._batches_epoch != self.epoch:
+            self._batches, self._num_padded = self._pack()
+            self._batches_epoch = self.epoch
+        return self._batches
+
+    def __iter__(self):
+        return iter(self._get_batches())
+
+    def __len__(self):
+        return len(self._get_batches())
+
+    def stats(self):
+        """Packing of the batches of this rank for the current epoch, from the point bounds"""
+        batches = self._get_batches()
+        batch_npoints = np.array([self.sample_npoints[batch].sum() for batch in batches])
+        return {
+            'num_batches': len(batches),
+            'samples_per_batch': np.mean([len(batch) for batch in batches]),
+            'points_per_batch': batch_npoints.mean(),
+            'utilization': np.mean(np.minimum(batch_npoints, self.max_points)) / self.max_points,
+            'unused_points_per_batch': np.mean(np.maximum(self.max_points - batch_npoints, 0)),
+            'num_oversized': int(np.sum(batch_npoints > self.max_points)),
+            # repeated batches over all the ranks so that they get the same number
+            'num_padded_batches': self._num_padded,
+        }
@@ -20,6 +20,15 @@ from scipy.spatial.transform import Rotation as R
 from minidiffuser.train.datasets.common import (
     pad_tensors, gen_seq_masks, random_rotate_z
 )
+from minidiffuser.train.datasets.step_index import (
+    DATA_LAYOUTS, load_step_index, step_key
+)
+from minidiffuser.train.datasets.shards import PointCloudShard
+from minidiffuser.train.datasets.step_cache import SharedStepCache
+from minidiffuser.train.datasets.prefilter import (
+    get_filter_config, get_arm_links_info, filter_point_idxs,
+    load_prefilter_config, check_prefilter_configs
+)
 from minidiffuser.configs.rlbench.constants import (
     get_rlbench_labels, get_robot_workspace
 )
@@ -40,14 +49,18 @@ class DPDataset(Dataset):
             rm_pc_outliers=False, rm_pc_outliers_neighbors=25, euler_resolution=5,
             pos_type='cont', pos_bins=50, pos_bin_size=0.01, 
             pos_heatmap_type='plain', pos_heatmap_no_robot=False,
-            aug_max_rot=45, real_robot=False, **kwargs
+            aug_max_rot=45, real_robot=False, data_layout='episode', lmdb_max_readers=126,
+            targets=None, cache_budget_gb=0, cache_dir='/dev/shm/minidiffuser_cache',
+            augment_in_batch=None, **kwargs
         ):
 
         assert instr_embed_type in ['last', 'all']
         assert xyz_shift in ['none', 'center', 'gripper']
         assert pos_type in ['cont', 'disc']
+        assert data_layout in DATA_LAYOUTS + ['shard']
         assert rot_type in ['quat', 'rot6d', 'euler', 'euler_delta', 'euler_disc']
         assert rm_robot in ['none', 'gt', 'box', 'box_keep_gripper']
+        assert augment_in_batch in [None, 'cpu', 'device']
         
         # print('dataset kwargs:', kwargs)
 
@@ -80,25 +93,48 @@ class DPDataset(Dataset):
             
         
 
+        # the LMDB environments are opened lazily by the process that reads them (see _get_lmdb_txn)
+        self.lmdb_max_readers = lmdb_max_readers
+        self.lmdb_dirs = {}
         self.lmdb_envs, self.lmdb_txns = {}, {}
+        self._lmdb_pid = None
+        self.shards = {}
         self.data_ids = []
+        prefilter_configs = {}
         for taskvar in self.taskvars:
             if not os.path.exists(os.path.join(data_dir, taskvar)):
                 print(f'{taskvar} not found in {data_dir}')
                 continue
-            self.lmdb_envs[taskvar] = lmdb.open(os.path.join(data_dir, taskvar), readonly=True)
-            self.lmdb_txns[taskvar] = self.lmdb_envs[taskvar].begin()
-            if all_step_in_batch:
-                self.data_ids.extend(
-                    [(taskvar, key) for key in self.lmdb_txns[taskvar].cursor().iternext(values=False)]
-                )
+            prefilter_configs[taskvar] = load_prefilter_config(os.path.join(data_dir, taskvar))
+            if data_layout == 'shard':
+                # memory-mapped buffers, see preprocess/convert_to_shards.py
+                self.shards[taskvar] = PointCloudShard(os.path.join(data_dir, taskvar))
+                episodes = self.shards[taskvar].episodes()
             else:
-                for key, value in self.lmdb_txns[taskvar].cursor():
-                    value = msgpack.unpackb(value)
-                    if include_last_step:
-                        self.data_ids.extend([(taskvar, key, t) for t in range(len(value['xyz']))])
+                self.lmdb_dirs[taskvar] = os.path.join(data_dir, taskvar)
+                lmdb_env = self._open_lmdb(self.lmdb_dirs[taskvar])
+            if all_step_in_batch and data_layout == 'episode':
+                with lmdb_env.begin() as txn:
+                    self.data_ids.extend(
+                        [(taskvar, key) for key in txn.cursor().iternext(values=False)]
+                    )
+            else:
+                if data_layout != 'shard':
+                    # step counts come from the sidecar index instead of decoding every episode
+                    step_index = load_step_index(
+                        self.lmdb_dirs[taskvar], lmdb_env=lmdb_env, layout=data_layout
+                    )
+                    episodes = zip(step_index['key'], step_index['num_steps'])
+                for key, num_steps in episodes:
+                    key = bytes(key)
+                    if all_step_in_batch:
+                        self.data_ids.append((taskvar, key))
+                    elif include_last_step:
+                        self.data_ids.extend([(taskvar, key, t) for t in range(num_steps)])
                     else:
-                        self.data_ids.extend([(taskvar, key, t) for t in range(len(value['xyz']) - 1)])
+                        self.data_ids.extend([(taskvar, key, t) for t in range(num_steps - 1)])
+            if data_layout != 'shard':
+                lmdb_env.close()
 
         self.num_points = num_points
         self.xyz_shift = xyz_shift
@@ -121,14 +157,122 @@ class DPDataset(Dataset):
         self.pos_bin_size = pos_bin_size
         self.pos_heatmap_type = pos_heatmap_type
         self.pos_heatmap_no_robot = pos_heatmap_no_robot
+        # optional supervision targets, only those read by the model (see BaseModel.required_targets);
+        # None keeps all the targets of pos_type
+        if targets is None:
+            targets = ['disc_pos_probs'] if pos_type == 'disc' else []
+        self.targets = targets
+        # augmentation of the collated batches in the training loop (see batch_augment.py)
+        # instead of per sample here, the targets computed from the points would not follow it
+        if augment_pc and augment_in_batch is not None:
+            assert 'disc_pos_probs' not in targets, 'disc_pos_probs needs the per-sample augmentation'
+        self.augment_in_batch = augment_in_batch
         self.real_robot = real_robot
+        self.data_layout = data_layout
 
         self.TABLE_HEIGHT = get_robot_workspace(real_robot=real_robot)['TABLE_HEIGHT']
         self.rotation_transform = RotationMatrixTransform()
 
-    def __exit__(self):
-        for lmdb_env in self.lmdb_envs.values():
-            lmdb_env.close()
+        # data written by preprocess/prefilter_policy_data.py is already filtered
+        self.filter_config = get_filter_config(
+            rm_table, self.TABLE_HEIGHT, rm_robot, rm_pc_outliers, rm_pc_outliers_neighbors,
+            real_robot
+        )
+        self.prefiltered = check_prefilter_configs(prefilter_configs, self.filter_config)
+
+        # shared-memory cache of the filtered points of each keystep, see step_cache.py.
+        # It is only read for single steps, and not when the robot boxes are needed again
+        # after sampling: otherwise its entries would be written but never read
+        cache_readable = (not all_step_in_batch) and \
+            not (pos_heatmap_no_robot and 'disc_pos_probs' in targets)
+        if cache_budget_gb > 0 and not cache_readable:
+            print('step cache disabled: not used with all_step_in_batch or pos_heatmap_no_robot')
+        if cache_budget_gb > 0 and cache_readable:
+            self.step_cache = SharedStepCache(
+                cache_dir, int(cache_budget_gb * 1024**3), config={
+                    'data_dir': os.path.abspath(data_dir), 'data_layout': data_layout,
+                    **self.filter_config,
+                }
+            )
+        else:
+            self.step_cache = None
+
+    def get_sample_npoints(self):
+        """
+        Upper bound of the number of points of every sample, for PointBudgetBatchSampler:
+        num_points per keystep, or the raw number of points of the keystep if the shards
+        store fewer (the filters only remove points).
+        """
+        step_npoints = {}   # (taskvar, episode key): points of every keystep
+        for taskvar, shard in self.shards.items():
+            for step in shard.steps:
+                step_npoints.setdefault((taskvar, bytes(step['key'])), []).append(
+                    int(step['point_end'] - step['point_start'])
+                )
+        for taskvar, lmdb_dir in self.lmdb_dirs.items():
+            step_index = load_step_index(lmdb_dir, layout=self.data_layout)
+            for key, num_steps in zip(step_index['key'], step_index['num_steps']):
+                step_npoints[(taskvar, bytes(key))] = [self.num_points] * int(num_steps)
+
+        sample_npoints = []
+        for data_id in self.data_ids:
+            npoints = np.array(step_npoints[data_id[:2]])
+            if self.same_npoints_per_example:   # sampled with replacement if fewer
+                npoints = np.full(len(npoints), self.num_points)
+            else:
+                npoints = np.minimum(npoints, self.num_points)
+            if len(data_id) == 3:
+                sample_npoints.append(npoints[data_id[2]])
+            elif self.include_last_step:
+                sample_npoints.append(npoints.sum())
+            else:
+                sample_npoints.append(npoints[:-1].sum())
+        return np.array(sample_npoints)
+
+    def _open_lmdb(self, lmdb_dir):
+        # random reads of single records: no readahead, and no lock file for read-only data
+        return lmdb.open(
+            lmdb_dir, readonly=True, lock=False, readahead=False,
+            max_readers=self.lmdb_max_readers
+        )
+
+    def _get_lmdb_txn(self, taskvar):
+        if self._lmdb_pid != os.getpid():
+            # LMDB handles must not be used across fork, forget the ones of the parent
+            self.lmdb_envs, self.lmdb_txns = {}, {}
+            self._lmdb_pid = os.getpid()
+        if taskvar not in self.lmdb_txns:
+            self.lmdb_envs[taskvar] = self._open_lmdb(self.lmdb_dirs[taskvar])
+            self.lmdb_txns[taskvar] = self.lmdb_envs[taskvar].begin()
+        return self.lmdb_txns[taskvar]
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        """DataLoader worker hook: drop the LMDB handles inherited from the main process"""
+        dataset = torch.utils.data.get_worker_info().dataset
+        dataset.lmdb_envs, dataset.lmdb_txns = {}, {}
+        dataset._lmdb_pid = os.getpid()
+
+    def close(self):
+        if self._lmdb_pid == os.getpid():
+            for txn in self.lmdb_txns.values():
+                txn.abort()
+            for lmdb_env in self.lmdb_envs.values():
+                lmdb_env.close()
+        self.lmdb_envs, self.lmdb_txns = {}, {}
+
+    def __getstate__(self):
+        # spawned workers reopen the environments themselves
+        state = self.__dict__.copy()
+        state['lmdb_envs'], state['lmdb_txns'] = {}, {}
+        state['_lmdb_pid'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def __len__(self):
         return len(self.data_ids)
@@ -148,12 +292,7 @@ class DPDataset(Dataset):
             arm_links_info, keep_gripper=keep_gripper, 
             env_name='real' if self.real_robot else 'rlbench'
         )
-        _, robot_point_ids = robot_box.get_pc_overlap_ratio(xyz=xyz, return_indices=True)
-        robot_point_ids = np.array(list(robot_point_ids))
-        mask = np.ones((xyz.shape[0], ), dtype=bool)
-        if len(robot_point_ids) > 0:
-            mask[robot_point_ids] = False
-        return mask
+        return ~robot_box.get_pc_mask(xyz)
     
     def _rm_pc_outliers(self, xyz, rgb=None, return_idxs=False):
         # pcd = o3d.geometry.PointCloud()
@@ -208,8 +347,8 @@ class DPDataset(Dataset):
             gt_rots = self.rotation_transform.quaternion_to_euler(gt_rots[1:]) / 180.
             gt_rots = torch.cat([gt_rots, gt_rots[-1:]], 0)
         elif self.rot_type == 'euler_disc': # 3D
-            gt_rots = [quaternion_to_discrete_euler(x, self.euler_resolution) for x in gt_rots[1:]]
-            gt_rots = torch.from_numpy(np.stack(gt_rots + gt_rots[-1:]))
+            gt_rots = quaternion_to_discrete_euler(gt_rots[1:], self.euler_resolution)
+            gt_rots = torch.cat([gt_rots, gt_rots[-1:]], 0)
         elif self.rot_type == 'euler_delta':
             gt_eulers = self.rotation_transform.quaternion_to_euler(gt_rots)
             gt_rots = (gt_eulers[1:] - gt_eulers[:-1]) % 360
@@ -224,36 +363,113 @@ class DPDataset(Dataset):
         gt_rots = gt_rots.numpy()
         return gt_rots
     
+    def _get_arm_links_info(self, data, t):
+        return get_arm_links_info(data, t, real_robot=self.real_robot)
+
+    def _load_steps(self, taskvar, data_id, data_step=None):
+        """
+        Returns the actions of the episode, its number of steps, and for the requested
+        step (all steps if data_step is None) a dict of xyz, rgb and arm_links_info.
+        The step layout only decodes the records of the requested steps, the shard layout
+        slices the mapped buffers without decoding anything.
+        """
+        if self.data_layout == 'shard':
+            shard = self.shards[taskvar]
+            actions = shard.get_actions(data_id)
+            step_ids = range(len(actions)) if data_step is None else [data_step]
+            return actions, len(actions), {t: shard.get_step(data_id, t) for t in step_ids}
+
+        txn = self._get_lmdb_txn(taskvar)
+        if self.data_layout == 'step':
+            t = 0 if data_step is None else data_step
+            data = msgpack.unpackb(txn.get(step_key(data_id, t)))
+            num_steps = data['num_steps']
+            records = {t: data}
+            if data_step is None:
+                for t in range(1, num_steps):
+                    records[t] = msgpack.unpackb(txn.get(step_key(data_id, t)))
+            steps = {
+                t: {
+                    'xyz': record['xyz'], 'rgb': record['rgb'],
+                    'arm_links_info': (record['bbox_info'], record['pose_info']),
+                } for t, record in records.items()
+            }
+            return data['action'], num_steps, steps
+
+        data = msgpack.unpackb(txn.get(data_id))
+        num_steps = len(data['xyz'])
+        step_ids = range(num_steps) if data_step is None else [data_step]
+        steps = {
+            t: {
+                'xyz': data['xyz'][t], 'rgb': data['rgb'][t],
+                'arm_links_info': self._get_arm_links_info(data, t),
+            } for t in step_ids
+        }
+        return data['action'], num_steps, steps
+
+    def _filter_points(self, xyz, rgb, arm_links_info):
+        """The deterministic removal of background points (table, robot arm, outliers)"""
+        # TODO: segmentation fault of the outlier removal in cleps with num_workers>0,
+        # prefilter the data offline instead (preprocess/prefilter_policy_data.py)
+        idxs = filter_point_idxs(xyz, arm_links_info, self.filter_config)
+        return xyz[idxs], rgb[idxs]
+
+    def _load_cached_step(self, taskvar, data_id, data_step):
+        """
+        The actions and the filtered points of a single step from the shared cache, without
+        reading the dataset, or None if they are not cached.
+        """
+        episode_key = f'{taskvar}/{data_id.decode("ascii")}'
+        points = self.step_cache.get(f'{episode_key}/{data_step}')
+        if points is None:
+            return None
+        actions = self.step_cache.get(f'{episode_key}/actions', count=False)
+        if actions is None:
+            return None
+        actions = np.array(actions['action'])
+        steps = {data_step: {'xyz': points['xyz'], 'rgb': points['rgb'], 'filtered': True}}
+        return actions, len(actions), steps
+
     def __getitem__(self, idx):
         if self.all_step_in_batch:
             taskvar, data_id = self.data_ids[idx]
+            data_step = None
         else:
             taskvar, data_id, data_step = self.data_ids[idx]
 
         task, variation = taskvar.split('+')
 
-        data = msgpack.unpackb(self.lmdb_txns[taskvar].get(data_id))
+        cached = None
+        if self.step_cache is not None and data_step is not None:
+            cached = self._load_cached_step(taskvar, data_id, data_step)
+        if cached is not None:
+            actions, num_steps, steps = cached
+        else:
+            actions, num_steps, steps = self._load_steps(taskvar, data_id, data_step)
+            if self.step_cache is not None:
+                episode_key = f'{taskvar}/{data_id.decode("ascii")}'
+                if self.step_cache.get(f'{episode_key}/actions', count=False) is None:
+                    self.step_cache.put(f'{episode_key}/actions', action=actions)
 
         outs = {
             'data_ids': [], 'pc_fts': [], 'step_ids': [],
             'pc_centroids': [], 'pc_radius': [], 'ee_poses': [], 
             'txt_embeds': [], 'gt_actions': [], 'gt_quaternion': []
         }
-        if self.pos_type == 'disc':
+        if 'disc_pos_probs' in self.targets:
             outs['disc_pos_probs'] = []
+        if self.augment_in_batch is not None:
+            outs['gt_action_quats'] = []
 
-        gt_rots = self.get_groundtruth_rotations(data['action'][:, 3:7]) 
+        gt_rots = self.get_groundtruth_rotations(actions[:, 3:7]) 
         # those are gt used for supervision, depending on the rot_type
 
-        num_steps = len(data['xyz'])
-        for t in range(num_steps):
-            if (not self.all_step_in_batch) and t != data_step:
-                continue
+        for t, step in steps.items():
             if (not self.include_last_step) and (t == (num_steps - 1)):
                 # the last step is the end observation
                 continue
 
-            xyz, rgb = data['xyz'][t], data['rgb'][t]
+            xyz, rgb = step['xyz'], step['rgb']
             # # real robot point cloud is very noisy, requiring noise point cloud removal
             # # segmentation fault if n_workers>0
             # if self.real_robot:
@@ -264,20 +480,13 @@ class DPDataset(Dataset):
             #     xyz = xyz[outlier_masks]
             #     rgb = rgb[outlier_masks]
 
-            if self.real_robot: # save in a different format
-                arm_links_info = (data['bbox_info'][0], data['pose_info'][0])
-            else:
-                arm_links_info = (
-                    {k: v[t] for k, v in data['bbox_info'].items()}, 
-                    {k: v[t] for k, v in data['pose_info'].items()}
-                )
-                # print(arm_links_info)
+            arm_links_info = step.get('arm_links_info', None)
             
             if t < num_steps - 1:
-                gt_action = copy.deepcopy(data['action'][t+1])
+                gt_action = copy.deepcopy(actions[t+1])
             else:
-                gt_action = copy.deepcopy(data['action'][-1])
-            ee_pose = copy.deepcopy(data['action'][t])
+                gt_action = copy.deepcopy(actions[-1])
+            ee_pose = copy.deepcopy(actions[t])
             gt_rot = gt_rots[t]
 
             # randomly select one instruction
@@ -285,18 +494,11 @@ class DPDataset(Dataset):
             instr_embed = self.instr_embeds[instr]
 
             # remove background points (table, robot arm)
-            if self.rm_table:
-                mask = xyz[..., 2] > self.TABLE_HEIGHT
-                xyz = xyz[mask]
-                rgb = rgb[mask]
-            if self.rm_robot.startswith('box'):
-                mask = self._get_mask_with_robot_box(xyz, arm_links_info, self.rm_robot)
-                xyz = xyz[mask]
-                rgb = rgb[mask]
-
-            # TODO: segmentation fault in cleps with num_workers>0
-            if self.rm_pc_outliers:
-                xyz, rgb = self._rm_pc_outliers(xyz, rgb)
+            if not step.get('filtered', False):
+                if not self.prefiltered:
+                    xyz, rgb = self._filter_points(xyz, rgb, arm_links_info)
+                if self.step_cache is not None:
+                    self.step_cache.put(f'{episode_key}/{t}', xyz=xyz, rgb=rgb)
 
             # sampling points
             if len(xyz) > self.num_points:
@@ -325,19 +527,17 @@ class DPDataset(Dataset):
             rgb = rgb[point_idxs]
             height = xyz[:, -1] - self.TABLE_HEIGHT
 
-            if self.pos_heatmap_no_robot:
+            if self.pos_heatmap_no_robot and 'disc_pos_probs' in self.targets:
                 robot_box = RobotBox(
                     arm_links_info=arm_links_info,
                     env_name='real' if self.real_robot else 'rlbench'
                 )
-                robot_point_idxs = np.array(
-                    list(robot_box.get_pc_overlap_ratio(xyz=xyz, return_indices=True)[1])
-                )
+                robot_point_idxs = np.nonzero(robot_box.get_pc_mask(xyz))[0]
             else:
                 robot_point_idxs = None
 
             # point cloud augmentation
-            if self.augment_pc:
+            if self.augment_pc and self.augment_in_batch is None:
                 xyz, ee_pose, gt_action, gt_rot = self._augment_pc(
                     xyz, ee_pose, gt_action, gt_rot, self.aug_max_rot
                 )
@@ -364,6 +564,7 @@ class DPDataset(Dataset):
             outs['pc_centroids'].append(centroid)
             outs['pc_radius'].append(radius)
 
+            gt_action_quat = gt_action[3:-1]
             gt_action = np.concatenate([gt_action[:3], gt_rot, gt_action[-1:]], 0)
 
             # print(gt_action[:3])
@@ -373,7 +574,7 @@ class DPDataset(Dataset):
             if self.use_height:
                 pc_ft = np.concatenate([pc_ft, height[:, None]], 1)
 
-            if self.pos_type == 'disc':
+            if 'disc_pos_probs' in self.targets:
                 # (npoints, 3, 100)
                 disc_pos_prob = get_disc_gt_pos_prob(
                     xyz, gt_action[:3], pos_bins=self.pos_bins, 
@@ -388,7 +589,9 @@ class DPDataset(Dataset):
             outs['txt_embeds'].append(torch.from_numpy(instr_embed).float())
             outs['ee_poses'].append(torch.from_numpy(ee_pose).float())
             outs['gt_actions'].append(torch.from_numpy(gt_action).float())
-            outs['gt_quaternion'].append(torch.from_numpy(data['action'][:, 3:7][t]).float())
+            outs['gt_quaternion'].append(torch.from_numpy(actions[:, 3:7][t]).float())
+            if self.augment_in_batch is not None:
+                outs['gt_action_quats'].append(torch.from_numpy(gt_action_quat).float())
             outs['step_ids'].append(t)
         
         # print(outs['data_ids'])
@@ -435,8 +638,9 @@ def ptv3_collate_fn(data):
     batch['offset'] = torch.cumsum(torch.LongTensor(npoints_in_batch), dim=0)
     batch['pc_fts'] = torch.cat(batch['pc_fts'], 0) # (#all points, 6)
 
-    for key in ['ee_poses', 'gt_actions', 'gt_quaternion']:   
-        batch[key] = torch.stack(batch[key], 0)
+    for key in ['ee_poses', 'gt_actions', 'gt_quaternion', 'gt_action_quats']:
+        if key in batch:
+            batch[key] = torch.stack(batch[key], 0)
         # print(key)
         # print(batch[key].shape)
 
@@ -7,6 +7,9 @@ Modified from Nvidia Deep Learning Examples
 (https://github.com/NVIDIA/DeepLearningExamples/tree/master/PyTorch).
 """
 import random
+import time
+import threading
+from queue import Queue, Full
 from typing import List, Dict, Tuple, Union, Iterator
 
 import torch
@@ -14,6 +17,8 @@ from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 import torch.distributed as dist
 
+from minidiffuser.train.datasets.batch_sampler import PointBudgetBatchSampler
+
 
 # class MetaLoader:
 #     """wraps multiple data loaders"""
@@ -75,56 +80,105 @@ import torch.distributed as dist
 #             yield task, batch
 
 
-# def move_to_cuda(batch: Union[List, Tuple, Dict, torch.Tensor], device: torch.device):
-#     if isinstance(batch, torch.Tensor):
-#         return batch.to(device, non_blocking=True)
-#     elif isinstance(batch, list):
-#         return [move_to_cuda(t, device) for t in batch]
-#     elif isinstance(batch, tuple):
-#         return tuple(move_to_cuda(t, device) for t in batch)
-#     elif isinstance(batch, dict):
-#         return {n: move_to_cuda(t, device) for n, t in batch.items()}
-#     return batch
-
-
-# class PrefetchLoader(object):
-#     """
-#     overlap compute and cuda data transfer
-#     """
-#     def __init__(self, loader, device: torch.device):
-#         self.loader = loader
-#         self.device = device
-
-#     def __iter__(self):
-#         loader_it = iter(self.loader)
-#         self.preload(loader_it)
-#         batch = self.next(loader_it)
-#         while batch is not None:
-#             yield batch
-#             batch = self.next(loader_it)
-
-#     def __len__(self):
-#         return len(self.loader)
-
-#     def preload(self, it):
-#         try:
-#             self.batch = next(it)
-#         except StopIteration:
-#             self.batch = None
-#             return
-#         # self.batch = move_to_cuda(self.batch, self.device)
-
-#     def next(self, it):
-#         batch = self.batch
-#         self.preload(it)
-#         return batch
-
-#     def __getattr__(self, name):
-#         method = self.loader.__getattribute__(name)
-#         return method
-
-
-def build_dataloader(dataset, collate_fn, is_train: bool, opts, batch_size=None):
+def move_to_device(batch: Dict, device: torch.device, pin_memory: bool = False):
+    """moves the tensors of a batch (not nested, as BaseModel.prepare_batch) to device"""
+    for k, v in batch.items():
+        if isinstance(v, torch.Tensor):
+            if pin_memory and not v.is_pinned():
+                v = v.pin_memory()
+            batch[k] = v.to(device, non_blocking=True)
+    return batch
+
+
+class PrefetchLoader(object):
+    """
+    overlap data loading, cuda data transfer and compute: a background thread gets the
+    next batches from the loader, adds the batch index of every point, pins them and
+    copies them to the device on a side stream, while the current step computes
+    transform: optional cpu function of the batches (e.g. BatchPointCloudAugmenter on the
+    cpu), applied in the background thread before the copy
+    """
+    def __init__(self, loader, device: torch.device, num_prefetch: int = 2, transform=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.transform = transform
+        self.data_wait_time = 0     # seconds the training loop waited for batches
+
+    def _prepare(self, batch, stream):
+        if self.transform is not None:
+            batch = self.transform(batch)
+        if 'offset' in batch and 'npoints_in_batch' in batch:
+            # the point batch indices of offset2batch, without a sync on the device
+            batch['pc_batch_ids'] = torch.repeat_interleave(
+                torch.arange(len(batch['npoints_in_batch'])),
+                torch.LongTensor(batch['npoints_in_batch'])
+            )
+        if stream is None:
+            return move_to_device(batch, self.device), None
+        with torch.cuda.stream(stream):
+            batch = move_to_device(batch, self.device, pin_memory=True)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return batch, event
+
+    @staticmethod
+    def _put(queue, item, stop_event):
+        """blocks until the item is queued or the consumer stopped, returns False if stopped"""
+        while not stop_event.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _produce(self, queue, stop_event):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.loader:
+                if not self._put(queue, self._prepare(batch, stream), stop_event):
+                    return
+        except Exception as e:
+            self._put(queue, e, stop_event)
+            return
+        self._put(queue, None, stop_event)  # end of the epoch
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.num_prefetch)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(queue, stop_event), daemon=True)
+        thread.start()
+        try:
+            while True:
+                st = time.time()
+                item = queue.get()
+                self.data_wait_time += time.time() - st
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    for v in batch.values():
+                        if isinstance(v, torch.Tensor) and v.is_cuda:
+                            # allocated on the side stream, used on this one
+                            v.record_stream(current_stream)
+                yield batch
+        finally:
+            stop_event.set()
+            thread.join()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+def build_dataloader(dataset, collate_fn, is_train: bool, opts, batch_size=None, device=None):
 
     if batch_size is None:
         batch_size = opts.TRAIN.train_batch_size if is_train else opts.TRAIN.val_batch_size
@@ -152,15 +206,31 @@ def build_dataloader(dataset, collate_fn, is_train: bool, opts, batch_size=None)
         )
         pre_epoch = sampler.set_epoch
 
+    max_points = opts.TRAIN.get('train_max_points', None) if is_train else None
+    if max_points is not None:
+        # batches of up to max_points points instead of batch_size samples
+        sampler = PointBudgetBatchSampler(
+            dataset.get_sample_npoints(), max_points, shuffle=True,
+            num_replicas=1 if opts.local_rank == -1 else dist.get_world_size(),
+            rank=0 if opts.local_rank == -1 else dist.get_rank(), seed=opts.SEED
+        )
+        pre_epoch = sampler.set_epoch
+        batch_kwargs = {'batch_sampler': sampler}
+    else:
+        batch_kwargs = {'sampler': sampler, 'batch_size': batch_size, 'drop_last': False}
+
     loader = DataLoader(
         dataset,
-        sampler=sampler,
-        batch_size=batch_size,
+        **batch_kwargs,
         num_workers=opts.TRAIN.n_workers,
         pin_memory=opts.TRAIN.pin_mem,
         collate_fn=collate_fn,
-        drop_last=False,
         prefetch_factor=2 if opts.TRAIN.n_workers > 0 else None,
+        worker_init_fn=getattr(dataset, 'worker_init_fn', None),
     )
 
+    num_prefetch = opts.TRAIN.get('prefetch_batches', 0)
+    if device is not None and num_prefetch > 0:
+        loader = PrefetchLoader(loader, device, num_prefetch=num_prefetch)
+
     return loader, pre_epoch
@@ -0,0 +1,100 @@
+"""
+Removal of the background points of the training point clouds (table, robot arm,
+outliers). The filters are deterministic per keystep, so preprocess/prefilter_policy_data.py
+can apply them once and record their options in prefilter.json next to each taskvar's data;
+DPDataset then checks that the options match its own and skips the online filters.
+"""
+import os
+import json
+
+import numpy as np
+from sklearn.neighbors import LocalOutlierFactor
+
+from minidiffuser.utils.robot_box import RobotBox
+
+
+PREFILTER_META_FILE = 'prefilter.json'
+PREFILTER_VERSION = 1
+
+
+def get_filter_config(
+        rm_table, table_height, rm_robot, rm_pc_outliers, rm_pc_outliers_neighbors, real_robot
+    ):
+    """The options that determine the filtered points, unused ones are set to None"""
+    return {
+        'version': PREFILTER_VERSION,
+        'rm_table': rm_table,
+        'table_height': table_height if rm_table else None,
+        'rm_robot': rm_robot if rm_robot.startswith('box') else 'none',
+        'rm_pc_outliers': rm_pc_outliers,
+        'rm_pc_outliers_neighbors': rm_pc_outliers_neighbors if rm_pc_outliers else None,
+        'real_robot': real_robot,
+    }
+
+
+def get_arm_links_info(data, t, real_robot=False):
+    """(bbox_info, pose_info) of keystep t of an episode record"""
+    if real_robot:  # save in a different format
+        return (data['bbox_info'][0], data['pose_info'][0])
+    return (
+        {k: v[t] for k, v in data['bbox_info'].items()},
+        {k: v[t] for k, v in data['pose_info'].items()}
+    )
+
+
+def filter_point_idxs(xyz, arm_links_info, config):
+    """Indices of the points of xyz kept by the filters of config (see get_filter_config)"""
+    idxs = np.arange(len(xyz))
+    if config['rm_table']:
+        idxs = idxs[xyz[idxs, 2] > config['table_height']]
+    if config['rm_robot'].startswith('box'):
+        robot_box = RobotBox(
+            arm_links_info, keep_gripper=config['rm_robot'] == 'box_keep_gripper',
+            env_name='real' if config['real_robot'] else 'rlbench'
+        )
+        idxs = idxs[~robot_box.get_pc_mask(xyz[idxs])]
+    if config['rm_pc_outliers']:
+        clf = LocalOutlierFactor(n_neighbors=config['rm_pc_outliers_neighbors'])
+        idxs = idxs[clf.fit_predict(xyz[idxs]) == 1]
+    return idxs
+
+
+def load_prefilter_config(data_dir):
+    """The filter config recorded in data_dir, or None if its data is not prefiltered"""
+    meta_file = os.path.join(data_dir, PREFILTER_META_FILE)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def write_prefilter_config(data_dir, config):
+    meta_file = os.path.join(data_dir, PREFILTER_META_FILE)
+    tmp_file = f'{meta_file}.tmp{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(config, f)
+    os.replace(tmp_file, meta_file)
+
+
+def check_prefilter_configs(prefilter_configs, filter_config):
+    """
+    prefilter_configs: {taskvar: recorded config or None}
+    Returns True if every taskvar was prefiltered with filter_config, False if none was.
+    Raises ValueError for a mix of raw and prefiltered data or for other filter options.
+    """
+    prefiltered = [taskvar for taskvar, config in prefilter_configs.items() if config is not None]
+    if len(prefiltered) == 0:
+        return False
+    if len(prefiltered) < len(prefilter_configs):
+        raw = sorted(set(prefilter_configs.keys()) - set(prefiltered))
+        raise ValueError(f'data of {raw} is not prefiltered, unlike that of {prefiltered}')
+    for taskvar, config in prefilter_configs.items():
+        diffs = {
+            k: (config.get(k), v) for k, v in filter_config.items() if config.get(k) != v
+        }
+        if len(diffs) > 0:
+            raise ValueError(
+                f'{taskvar} was prefiltered with other options, (data, dataset): {diffs}. '
+                'Run preprocess/prefilter_policy_data.py with the dataset options.'
+            )
+    return True
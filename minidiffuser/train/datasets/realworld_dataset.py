@@ -26,6 +26,7 @@ from minidiffuser.utils.rotation_transform import (
 from minidiffuser.utils.robot_box import RobotBox
 from minidiffuser.utils.action_position_utils import get_disc_gt_pos_prob
 from minidiffuser.train.datasets.diffusion_policy_dataset import base_collate_fn, ptv3_collate_fn
+from minidiffuser.train.datasets.shards import PointCloudShard, get_h5_rgb_scale
 
 
 class RealworldDataset(Dataset):
@@ -38,14 +39,20 @@ class RealworldDataset(Dataset):
             rm_pc_outliers=False, rm_pc_outliers_neighbors=25, euler_resolution=5,
             pos_type='cont', pos_bins=50, pos_bin_size=0.01, 
             pos_heatmap_type='plain', pos_heatmap_no_robot=False,
-            aug_max_rot=45, real_robot=True, h5_filename='1cm.h5', **kwargs
+            aug_max_rot=45, real_robot=True, h5_filename='1cm.h5', data_layout='h5',
+            h5_rgb_scale=None, targets=None, **kwargs
         ):
+        """
+        h5_rgb_scale: full intensity of the h5 rgb, None: 255 for uint8 and 1 for floats
+        (shards record theirs in meta.json)
+        """
 
         assert instr_embed_type in ['last', 'all']
         assert xyz_shift in ['none', 'center', 'gripper']
         assert pos_type in ['cont', 'disc']
         assert rot_type in ['quat', 'rot6d', 'euler', 'euler_delta', 'euler_disc']
         assert rm_robot in ['none', 'gt', 'box', 'box_keep_gripper']
+        assert data_layout in ['h5', 'shard']
         
         # Join script folder for task instructions
         if kwargs.get('project_root', None):
@@ -67,15 +74,38 @@ class RealworldDataset(Dataset):
         
         self.data_dir = data_dir
         self.h5_filename = h5_filename
+        self.data_layout = data_layout
+        self.h5_rgb_scale = h5_rgb_scale
         
         # Create data IDs for all episodes and steps across all taskvar subfolders
         self.episode_info = []
+        self.shards = {}
         
         for taskvar in self.taskvars:
             taskvar_dir = os.path.join(self.data_dir, taskvar)
             if not os.path.exists(taskvar_dir):
                 print(f"Warning: Taskvar directory not found: {taskvar_dir}")
                 continue
+
+            if data_layout == 'shard':
+                # memory-mapped buffers, see preprocess/convert_to_shards.py
+                self.shards[taskvar] = PointCloudShard(taskvar_dir)
+                for ep_id, num_steps in self.shards[taskvar].episodes():
+                    steps = list(range(num_steps))
+                    if all_step_in_batch:
+                        step_groups = [steps]
+                    elif include_last_step:
+                        step_groups = [[step] for step in steps]
+                    else:
+                        step_groups = [[step] for step in steps[:-1]]  # Exclude last step
+                    for step_group in step_groups:
+                        self.episode_info.append({
+                            'h5_path': None,
+                            'ep_id': ep_id.decode(),
+                            'steps': step_group,
+                            'taskvar': taskvar
+                        })
+                continue
                 
             h5_path = os.path.join(taskvar_dir, self.h5_filename)
             if not os.path.exists(h5_path):
@@ -145,6 +175,11 @@ class RealworldDataset(Dataset):
         self.pos_bin_size = pos_bin_size
         self.pos_heatmap_type = pos_heatmap_type
         self.pos_heatmap_no_robot = pos_heatmap_no_robot
+        # optional supervision targets, only those read by the model (see BaseModel.required_targets);
+        # None keeps all the targets of pos_type
+        if targets is None:
+            targets = ['disc_pos_probs'] if pos_type == 'disc' else []
+        self.targets = targets
         self.real_robot = real_robot
 
         # Real robot workspace parameters
@@ -157,6 +192,33 @@ class RealworldDataset(Dataset):
     def __len__(self):
         return len(self.episode_info)
     
+    def get_sample_npoints(self):
+        """
+        Upper bound of the number of points of every sample, for PointBudgetBatchSampler:
+        the raw number of points of its steps (only their shapes are read), at most
+        num_points per step.
+        """
+        sample_npoints = []
+        for episode_data in self.episode_info:
+            ep_id = episode_data['ep_id']
+            if self.data_layout == 'shard':
+                shard = self.shards[episode_data['taskvar']]
+                first_row = shard.episode_rows[ep_id.encode()]
+                npoints = [
+                    shard.steps[first_row + t]['point_end'] - shard.steps[first_row + t]['point_start']
+                    for t in episode_data['steps']
+                ]
+            else:
+                h5f = self._get_h5_file(episode_data['h5_path'])
+                episode = h5f['episodes'][ep_id] if 'episodes' in h5f else h5f[ep_id]
+                npoints = [episode[step_id]['xyz'].shape[0] for step_id in episode_data['steps']]
+            if self.same_npoints_per_example:   # sampled with replacement if fewer
+                npoints = [self.num_points] * len(npoints)
+            sample_npoints.append(sum([min(int(n), self.num_points) for n in npoints]))
+        # the files are opened again by each DataLoader worker
+        self.close()
+        return np.array(sample_npoints)
+
     def _get_h5_file(self, h5_path):
         """Get H5 file from cache or open a new one"""
         if h5_path not in self.h5_cache:
@@ -172,12 +234,7 @@ class RealworldDataset(Dataset):
             arm_links_info, keep_gripper=keep_gripper, 
             env_name='real' if self.real_robot else 'rlbench'
         )
-        _, robot_point_ids = robot_box.get_pc_overlap_ratio(xyz=xyz, return_indices=True)
-        robot_point_ids = np.array(list(robot_point_ids))
-        mask = np.ones((xyz.shape[0], ), dtype=bool)
-        if len(robot_point_ids) > 0:
-            mask[robot_point_ids] = False
-        return mask
+        return ~robot_box.get_pc_mask(xyz)
     
     def _rm_pc_outliers(self, xyz, rgb=None, return_idxs=False):
         clf = LocalOutlierFactor(n_neighbors=self.rm_pc_outliers_neighbors)
@@ -228,8 +285,8 @@ class RealworldDataset(Dataset):
             gt_rots = self.rotation_transform.quaternion_to_euler(gt_rots[1:]) / 180.
             gt_rots = torch.cat([gt_rots, gt_rots[-1:]], 0)
         elif self.rot_type == 'euler_disc': # 3D
-            gt_rots = [quaternion_to_discrete_euler(x, self.euler_resolution) for x in gt_rots[1:]]
-            gt_rots = torch.from_numpy(np.stack(gt_rots + gt_rots[-1:]))
+            gt_rots = quaternion_to_discrete_euler(gt_rots[1:], self.euler_resolution)
+            gt_rots = torch.cat([gt_rots, gt_rots[-1:]], 0)
         elif self.rot_type == 'euler_delta':
             gt_eulers = self.rotation_transform.quaternion_to_euler(gt_rots)
             gt_rots = (gt_eulers[1:] - gt_eulers[:-1]) % 360
@@ -251,31 +308,38 @@ class RealworldDataset(Dataset):
         steps = episode_data['steps']
         taskvar = episode_data['taskvar']
         
-        h5f = self._get_h5_file(h5_path)
-        episode = h5f['episodes'][ep_id] if 'episodes' in h5f else h5f[ep_id]
+        if self.data_layout == 'shard':
+            shard = self.shards[taskvar]
+            episode = None
+        else:
+            h5f = self._get_h5_file(h5_path)
+            episode = h5f['episodes'][ep_id] if 'episodes' in h5f else h5f[ep_id]
         
         outs = {
             'data_ids': [], 'pc_fts': [], 'step_ids': [],
             'pc_centroids': [], 'pc_radius': [], 'ee_poses': [], 
             'txt_embeds': [], 'gt_actions': [], 'gt_quaternion': []
         }
-        if self.pos_type == 'disc':
+        if 'disc_pos_probs' in self.targets:
             outs['disc_pos_probs'] = []
 
         # Prepare all step data for this episode
-        all_gripper_poses = []
-        for step_id in sorted([k for k in episode.keys() if k.startswith('step_')], key=lambda x: int(x.split('_')[1])):
-            step = episode[step_id]
-            gripper_pose = step['gripper'][...]
-            # if it is not 7+1 dim, add gripper state
-            if gripper_pose.shape[-1] == 7:
-                print(f"Warning: Gripper pose shape is {gripper_pose.shape}, adding gripper state")
-                gripper_state = np.array([1.0])  # Default open gripper
-                all_gripper_poses.append(np.concatenate([gripper_pose, gripper_state]))
-            else:
-                all_gripper_poses.append(gripper_pose)
+        if episode is None:
+            # gripper states are already added when converting to shards
+            all_gripper_poses = shard.get_actions(ep_id.encode())
+        else:
+            all_gripper_poses = []
+            for step_id in sorted([k for k in episode.keys() if k.startswith('step_')], key=lambda x: int(x.split('_')[1])):
+                step = episode[step_id]
+                gripper_pose = step['gripper'][...]
+                # if it is not 7+1 dim, add gripper state
+                if gripper_pose.shape[-1] == 7:
+                    print(f"Warning: Gripper pose shape is {gripper_pose.shape}, adding gripper state")
+                    gripper_state = np.array([1.0])  # Default open gripper
+                    all_gripper_poses.append(np.concatenate([gripper_pose, gripper_state]))
+                else:
+                    all_gripper_poses.append(gripper_pose)
                 
-        
         all_gripper_poses = np.array(all_gripper_poses)
         gt_rots = self.get_groundtruth_rotations(all_gripper_poses[:, 3:7])
         
@@ -305,23 +369,31 @@ class RealworldDataset(Dataset):
             
         for step_id in steps:
             t = int(step_id.split('_')[1]) if isinstance(step_id, str) else int(step_id)
-            step = episode[f'step_{t}']
-            
-            # Get point cloud and gripper data
-            xyz = step['xyz'][...]
-            rgb = step['rgb'][...]
-            
-            # Get arm links info for robot box removal
-            # For real robot data, we might not have detailed links info
-            # Using a simplified structure compatible with RobotBox
-            joint_states = step['joint_states'][...]
-            gripper_pose = step['gripper'][...]
-            # if it is not 7+1 dim, add gripper state
-            if gripper_pose.shape[-1] == 7:
-                gripper_state = np.array([1.0])
-                gripper_pose = np.concatenate([gripper_pose, gripper_state])
+            if episode is None:
+                step = shard.get_step(ep_id.encode(), t)
+                xyz, rgb = step['xyz'], step['rgb']
+                # shards written before the rgb scale was recorded are uint8 as well
+                rgb_scale = shard.meta.get('rgb_scale', 255)
+                gripper_pose = np.array(all_gripper_poses[t])
             else:
-                gripper_pose = np.array(gripper_pose)
+                step = episode[f'step_{t}']
+                
+                # Get point cloud and gripper data
+                xyz = step['xyz'][...]
+                rgb = step['rgb'][...]
+                rgb_scale = get_h5_rgb_scale(rgb, self.h5_rgb_scale)
+                
+                # Get arm links info for robot box removal
+                # For real robot data, we might not have detailed links info
+                # Using a simplified structure compatible with RobotBox
+                joint_states = step['joint_states'][...]
+                gripper_pose = step['gripper'][...]
+                # if it is not 7+1 dim, add gripper state
+                if gripper_pose.shape[-1] == 7:
+                    gripper_state = np.array([1.0])
+                    gripper_pose = np.concatenate([gripper_pose, gripper_state])
+                else:
+                    gripper_pose = np.array(gripper_pose)
             
             # Simple bounding box info for robot arm
             # This is a placeholder - you'll need to adapt based on your robot model
@@ -380,14 +452,12 @@ class RealworldDataset(Dataset):
             rgb = rgb[point_idxs]
             height = xyz[:, -1] - self.TABLE_HEIGHT
 
-            if self.pos_heatmap_no_robot:
+            if self.pos_heatmap_no_robot and 'disc_pos_probs' in self.targets:
                 robot_box = RobotBox(
                     arm_links_info=arm_links_info,
                     env_name='real' if self.real_robot else 'rlbench'
                 )
-                robot_point_idxs = np.array(
-                    list(robot_box.get_pc_overlap_ratio(xyz=xyz, return_indices=True)[1])
-                )
+                robot_point_idxs = np.nonzero(robot_box.get_pc_mask(xyz))[0]
             else:
                 robot_point_idxs = None
 
@@ -421,15 +491,14 @@ class RealworldDataset(Dataset):
             gt_action = np.concatenate([gt_action[:3], gt_rot, gt_action[-1:]], 0)
 
             # Normalize RGB to [-1, 1]
-            if rgb.max() > 1:
-                rgb = rgb / 255.
+            rgb = rgb / rgb_scale
             rgb = rgb * 2 - 1
             
             pc_ft = np.concatenate([xyz, rgb], 1)
             if self.use_height:
                 pc_ft = np.concatenate([pc_ft, height[:, None]], 1)
 
-            if self.pos_type == 'disc':
+            if 'disc_pos_probs' in self.targets:
                 # (npoints, 3, 100)
                 disc_pos_prob = get_disc_gt_pos_prob(
                     xyz, gt_action[:3], pos_bins=self.pos_bins, 
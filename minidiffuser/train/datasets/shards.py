@@ -0,0 +1,180 @@
+"""
+Memory-mapped point cloud shards: one directory per taskvar with flat buffers that the
+datasets slice without any deserialization, so the page cache is shared by all the
+DataLoader workers and DDP ranks of a node.
+
+    meta.json       version, number of points, xyz dtype, rgb scale, robot link names
+    xyz.bin         [#points, 3] float16 or float32, the keysteps concatenated
+    rgb.bin         [#points, 3] uint8, rgb_scale (255) is full intensity
+    steps.npy       one record per keystep: episode key, t, num_steps, point range,
+                    row of the first step of the episode
+    actions.npy     [#steps, 8] float64, the gripper pose of every keystep
+    bbox_<i>.npy    [#steps, ...] robot link boxes of link i (optional)
+    pose_<i>.npy    [#steps, ...] robot link poses of link i (optional)
+"""
+import os
+import json
+
+import numpy as np
+
+
+SHARD_VERSION = 1
+SHARD_META_FILE = 'meta.json'
+
+
+def get_h5_rgb_scale(rgb, rgb_scale=None):
+    """Full intensity of the rgb of an h5 file: given, or 255 for uint8 and 1 otherwise"""
+    if rgb_scale is not None:
+        return rgb_scale
+    return 255 if rgb.dtype == np.uint8 else 1
+
+
+class ShardWriter(object):
+    """Append episodes to a shard directory; the point buffers are streamed to disk."""
+    def __init__(self, shard_dir, xyz_dtype='float32', rgb_scale=255):
+        """rgb_scale: value of full intensity in the rgb given to add_episode"""
+        assert xyz_dtype in ['float16', 'float32']
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.xyz_dtype = np.dtype(xyz_dtype)
+        self.rgb_scale = rgb_scale
+        self.xyz_file = open(os.path.join(shard_dir, 'xyz.bin'), 'wb')
+        self.rgb_file = open(os.path.join(shard_dir, 'rgb.bin'), 'wb')
+        self.num_points = 0
+        self.steps, self.actions = [], []
+        self.links = None
+        self.bbox_info, self.pose_info = [], []
+
+    def add_episode(self, key, xyz, rgb, actions, bbox_info=None, pose_info=None):
+        """
+        xyz, rgb: per-keystep point clouds; actions: [T, 8]
+        bbox_info, pose_info: {link: per-keystep values}, optional
+        """
+        num_steps = len(xyz)
+        first_row = len(self.steps)
+        for t in range(num_steps):
+            t_xyz = np.ascontiguousarray(xyz[t], dtype=self.xyz_dtype).reshape(-1, 3)
+            t_rgb = np.ascontiguousarray(rgb[t], dtype=np.uint8).reshape(-1, 3)
+            assert len(t_xyz) == len(t_rgb)
+            self.xyz_file.write(t_xyz.tobytes())
+            self.rgb_file.write(t_rgb.tobytes())
+            self.steps.append(
+                (key, t, num_steps, self.num_points, self.num_points + len(t_xyz), first_row)
+            )
+            self.num_points += len(t_xyz)
+        self.actions.append(np.asarray(actions, dtype=np.float64).reshape(num_steps, -1))
+
+        if bbox_info is not None:
+            links = sorted(bbox_info.keys())
+            if self.links is None:
+                self.links = links
+            assert self.links == links, 'all episodes of a shard must have the same robot links'
+            self.bbox_info.append([np.stack(bbox_info[k][:num_steps], 0) for k in links])
+            self.pose_info.append([np.stack(pose_info[k][:num_steps], 0) for k in links])
+
+    def close(self):
+        self.xyz_file.close()
+        self.rgb_file.close()
+
+        key_len = max([len(step[0]) for step in self.steps], default=1)
+        steps = np.array(self.steps, dtype=[
+            ('key', f'S{key_len}'), ('t', np.int32), ('num_steps', np.int32),
+            ('point_start', np.int64), ('point_end', np.int64), ('first_row', np.int64),
+        ])
+        np.save(os.path.join(self.shard_dir, 'steps.npy'), steps)
+        np.save(os.path.join(self.shard_dir, 'actions.npy'), np.concatenate(self.actions, 0))
+        if self.links is not None:
+            for i in range(len(self.links)):
+                np.save(
+                    os.path.join(self.shard_dir, f'bbox_{i}.npy'),
+                    np.concatenate([x[i] for x in self.bbox_info], 0)
+                )
+                np.save(
+                    os.path.join(self.shard_dir, f'pose_{i}.npy'),
+                    np.concatenate([x[i] for x in self.pose_info], 0)
+                )
+
+        # written last: a shard without meta.json is incomplete
+        with open(os.path.join(self.shard_dir, SHARD_META_FILE), 'w') as f:
+            json.dump({
+                'version': SHARD_VERSION,
+                'num_points': self.num_points,
+                'xyz_dtype': self.xyz_dtype.name,
+                'rgb_scale': self.rgb_scale,
+                'links': self.links,
+            }, f)
+
+
+class PointCloudShard(object):
+    """
+    Read-only view of a shard directory. The buffers are mapped lazily in each process
+    (and dropped when pickled), so forked or spawned workers map the files themselves.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, SHARD_META_FILE)) as f:
+            self.meta = json.load(f)
+        assert self.meta['version'] == SHARD_VERSION
+        self.steps = np.load(os.path.join(shard_dir, 'steps.npy'))
+        first_steps = self.steps[self.steps['t'] == 0]
+        self.episode_rows = {
+            bytes(key): row for key, row in zip(first_steps['key'], first_steps['first_row'])
+        }
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            num_points = self.meta['num_points']
+            arrays = {
+                'xyz': np.memmap(
+                    os.path.join(self.shard_dir, 'xyz.bin'), dtype=self.meta['xyz_dtype'],
+                    mode='r', shape=(num_points, 3)
+                ),
+                'rgb': np.memmap(
+                    os.path.join(self.shard_dir, 'rgb.bin'), dtype=np.uint8,
+                    mode='r', shape=(num_points, 3)
+                ),
+                'actions': np.load(os.path.join(self.shard_dir, 'actions.npy'), mmap_mode='r'),
+            }
+            for i in range(len(self.meta['links'] or [])):
+                arrays[f'bbox_{i}'] = np.load(
+                    os.path.join(self.shard_dir, f'bbox_{i}.npy'), mmap_mode='r'
+                )
+                arrays[f'pose_{i}'] = np.load(
+                    os.path.join(self.shard_dir, f'pose_{i}.npy'), mmap_mode='r'
+                )
+            self._arrays = arrays
+        return self._arrays
+
+    def episodes(self):
+        """(key, num_steps) of every episode"""
+        return [
+            (key, int(self.steps[row]['num_steps'])) for key, row in self.episode_rows.items()
+        ]
+
+    def get_actions(self, key):
+        row = self.episode_rows[key]
+        return np.array(self.arrays['actions'][row: row + self.steps[row]['num_steps']])
+
+    def get_step(self, key, t):
+        """xyz, rgb (views of the mapped buffers) and the robot link infos of a keystep"""
+        row = self.episode_rows[key] + t
+        step = self.steps[row]
+        arrays = self.arrays
+        point_slice = slice(step['point_start'], step['point_end'])
+        xyz = np.asarray(arrays['xyz'][point_slice])
+        if xyz.dtype != np.float32:
+            xyz = xyz.astype(np.float32)
+        outs = {'xyz': xyz, 'rgb': np.asarray(arrays['rgb'][point_slice])}
+        if self.meta['links'] is not None:
+            outs['arm_links_info'] = (
+                {k: np.array(arrays[f'bbox_{i}'][row]) for i, k in enumerate(self.meta['links'])},
+                {k: np.array(arrays[f'pose_{i}'][row]) for i, k in enumerate(self.meta['links'])},
+            )
+        return outs
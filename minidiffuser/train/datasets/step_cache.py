@@ -0,0 +1,124 @@
+"""
+Node-local cache of pre-filtered keysteps (points left after the table/robot/outlier
+removal of DPDataset) in shared memory. Every entry is a .npy file in a tmpfs directory
+(/dev/shm by default) that readers memory-map, so all the DataLoader workers, and the
+DDP ranks of a node using the same directory, read the same pages.
+
+The directory is keyed by the data and filter configuration, entries are evicted in
+least-recently-used order (the mtime of a file is refreshed on every hit) once the
+RAM budget is exceeded.
+"""
+import os
+import json
+import hashlib
+import multiprocessing as mp
+
+import numpy as np
+
+
+class SharedStepCache(object):
+    def __init__(self, cache_root, budget_bytes, config):
+        """
+        config: dict identifying the cached content (data dir, filters), entries written
+        with another config are never read.
+        """
+        config_hash = hashlib.md5(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        self.cache_dir = os.path.join(cache_root, config_hash[:16])
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # read by the other workers and ranks of the node while they write it
+        config_file = os.path.join(self.cache_dir, 'config.json')
+        tmp_file = f'{config_file}.tmp{os.getpid()}'
+        with open(tmp_file, 'w') as f:
+            json.dump(config, f)
+        os.replace(tmp_file, config_file)
+        self.budget_bytes = budget_bytes
+
+        # shared by the DataLoader workers forked from this process
+        self.num_hits = mp.Value('q', 0)
+        self.num_misses = mp.Value('q', 0)
+        self.used_bytes = mp.Value('q', self._scan_used_bytes())
+        self.evict_lock = mp.Lock()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode()).hexdigest() + '.npy')
+
+    def _scan_entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:   # evicted by another process
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def _scan_used_bytes(self):
+        return sum([size for _, size, _ in self._scan_entries()])
+
+    def get(self, key, count=True):
+        """Memory-mapped structured array of the entry, or None"""
+        path = self._entry_path(key)
+        try:
+            value = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            value = None
+        if count:
+            counter = self.num_misses if value is None else self.num_hits
+            with counter.get_lock():
+                counter.value += 1
+        return value
+
+    def put(self, key, **arrays):
+        """Store per-point arrays with the same length as one structured array"""
+        num_points = len(next(iter(arrays.values())))
+        value = np.empty(num_points, dtype=[
+            (name, array.dtype, array.shape[1:]) for name, array in arrays.items()
+        ])
+        for name, array in arrays.items():
+            value[name] = array
+        if value.nbytes > self.budget_bytes:
+            return
+
+        path = self._entry_path(key)
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, value)
+        os.replace(tmp_path, path)
+
+        with self.used_bytes.get_lock():
+            self.used_bytes.value += os.path.getsize(path)
+            over_budget = self.used_bytes.value > self.budget_bytes
+        if over_budget:
+            self._evict()
+
+    def _evict(self):
+        """Delete the least recently used entries until 90% of the budget is used"""
+        if not self.evict_lock.acquire(block=False):
+            return  # another worker is evicting
+        try:
+            entries = sorted(self._scan_entries())
+            used_bytes = sum([size for _, size, _ in entries])
+            for _, size, path in entries:
+                if used_bytes <= 0.9 * self.budget_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                used_bytes -= size
+            with self.used_bytes.get_lock():
+                self.used_bytes.value = used_bytes
+        finally:
+            self.evict_lock.release()
+
+    def stats(self):
+        num_hits, num_misses = self.num_hits.value, self.num_misses.value
+        return {
+            'hit_rate': num_hits / max(num_hits + num_misses, 1),
+            'hits': num_hits,
+            'misses': num_misses,
+            'used_gb': self.used_bytes.value / 1024**3,
+        }
@@ -0,0 +1,165 @@
+"""
+Storage layouts of the taskvar LMDBs and the sidecar index of their episodes.
+
+- episode layout: one record per episode, with the per-keystep arrays stacked/listed.
+- step layout: one record per keystep, keyed <episode key>/<step>, holding only that
+  keystep's point cloud and robot boxes (plus the small action array of the episode),
+  so that a single-step sample reads and decodes only its own bytes.
+
+The index has one (key, num_steps, nbytes) record per episode, so that DPDataset can
+enumerate keysteps without decoding the episodes. It lives next to data.mdb and is
+rebuilt when the LMDB changes.
+"""
+import os
+import json
+
+import numpy as np
+import lmdb
+import msgpack
+import msgpack_numpy
+msgpack_numpy.patch()
+
+
+STEP_INDEX_FILE = 'step_index.npy'
+STEP_INDEX_META_FILE = 'step_index.json'
+STEP_INDEX_VERSION = 1
+DATA_LAYOUTS = ['episode', 'step']
+
+
+def step_key(episode_key, t):
+    return episode_key + b'/%03d' % t
+
+
+def episode_key_of(key):
+    return key.rsplit(b'/', 1)[0]
+
+
+def split_episode(value):
+    """
+    Split an episode record of the episode layout into the records of the step layout.
+    Yields (t, record) for every keystep.
+    """
+    num_steps = len(value['xyz'])
+    for t in range(num_steps):
+        record = {'xyz': value['xyz'][t], 'rgb': value['rgb'][t], 'num_steps': num_steps}
+        if 'sem' in value:
+            record['sem'] = value['sem'][t]
+        for info_key in ['bbox_info', 'pose_info']:
+            if info_key not in value:
+                continue
+            if isinstance(value[info_key], dict):
+                record[info_key] = {k: v[t] for k, v in value[info_key].items()}
+            else:   # real robot data keeps a single entry for the episode
+                record[info_key] = value[info_key][0]
+        for episode_key in ['action', 'key_frameids']:
+            if episode_key in value:
+                record[episode_key] = value[episode_key]
+        yield t, record
+
+
+def lmdb_signature(lmdb_dir, lmdb_env=None, layout='episode'):
+    """Entries of the LMDB plus size/mtime of its data file, to detect a stale index."""
+    data_stat = os.stat(os.path.join(lmdb_dir, 'data.mdb'))
+    if lmdb_env is None:
+        with lmdb.open(lmdb_dir, readonly=True, lock=False) as env:
+            entries = env.stat()['entries']
+    else:
+        entries = lmdb_env.stat()['entries']
+    return {
+        'version': STEP_INDEX_VERSION,
+        'layout': layout,
+        'entries': entries,
+        'data_size': data_stat.st_size,
+        'data_mtime_ns': data_stat.st_mtime_ns,
+    }
+
+
+def build_step_index(lmdb_dir, lmdb_env=None, layout='episode'):
+    """
+    Return the index as a structured array. The episode layout decodes every episode
+    once; the step layout only counts the keys of each episode.
+    """
+    assert layout in DATA_LAYOUTS
+    keys, num_steps, nbytes = [], [], []
+    env = lmdb.open(lmdb_dir, readonly=True, lock=False) if lmdb_env is None else lmdb_env
+    try:
+        with env.begin(buffers=True) as txn:
+            for key, value in txn.cursor():
+                key = bytes(key)
+                if layout == 'episode':
+                    keys.append(key)
+                    num_steps.append(len(msgpack.unpackb(value)['xyz']))
+                    nbytes.append(len(value))
+                    continue
+                key = episode_key_of(key)
+                if len(keys) == 0 or keys[-1] != key:
+                    # keys are sorted, the steps of an episode are contiguous
+                    keys.append(key)
+                    num_steps.append(0)
+                    nbytes.append(0)
+                num_steps[-1] += 1
+                nbytes[-1] += len(value)
+    finally:
+        if lmdb_env is None:
+            env.close()
+
+    key_len = max([len(key) for key in keys], default=1)
+    index = np.zeros(
+        len(keys), dtype=[('key', f'S{key_len}'), ('num_steps', np.int32), ('nbytes', np.int64)]
+    )
+    index['key'] = keys
+    index['num_steps'] = num_steps
+    index['nbytes'] = nbytes
+    return index
+
+
+def write_step_index(lmdb_dir, index=None, lmdb_env=None, layout='episode'):
+    """
+    Write the index next to the LMDB data file. The files are written to a temporary
+    path and renamed, so concurrent writers (e.g. DDP ranks) never expose a partial file.
+    """
+    if index is None:
+        index = build_step_index(lmdb_dir, lmdb_env=lmdb_env, layout=layout)
+    meta = lmdb_signature(lmdb_dir, lmdb_env=lmdb_env, layout=layout)
+    meta['num_episodes'] = len(index)
+
+    index_file = os.path.join(lmdb_dir, STEP_INDEX_FILE)
+    meta_file = os.path.join(lmdb_dir, STEP_INDEX_META_FILE)
+    tmp_suffix = f'.tmp{os.getpid()}'
+    with open(index_file + tmp_suffix, 'wb') as f:
+        np.save(f, index)
+    with open(meta_file + tmp_suffix, 'w') as f:
+        json.dump(meta, f)
+    os.replace(index_file + tmp_suffix, index_file)
+    os.replace(meta_file + tmp_suffix, meta_file)
+    return index
+
+
+def load_step_index(lmdb_dir, lmdb_env=None, layout='episode', rebuild=True):
+    """
+    Memory-map the index of lmdb_dir if it matches the current LMDB, otherwise rebuild it
+    (and try to save it, the data directory may be read-only). Returns None if the index
+    is stale or missing and rebuild is False.
+    """
+    index_file = os.path.join(lmdb_dir, STEP_INDEX_FILE)
+    meta_file = os.path.join(lmdb_dir, STEP_INDEX_META_FILE)
+    signature = lmdb_signature(lmdb_dir, lmdb_env=lmdb_env, layout=layout)
+    if os.path.exists(index_file) and os.path.exists(meta_file):
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if all(meta.get(k) == v for k, v in signature.items()):
+                index = np.load(index_file, mmap_mode='r')
+                if len(index) == meta['num_episodes']:
+                    return index
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if not rebuild:
+        return None
+    index = build_step_index(lmdb_dir, lmdb_env=lmdb_env, layout=layout)
+    try:
+        write_step_index(lmdb_dir, index=index, lmdb_env=lmdb_env, layout=layout)
+    except OSError as e:
+        print(f'cannot save the step index of {lmdb_dir}: {e}')
+    return index
@@ -110,3 +110,63 @@ class AdamW(Optimizer):
                     p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
 
         return loss
+
+
+class ForeachAdamW(AdamW):
+    """
+    AdamW with multi-tensor (torch._foreach_*) updates: the same math and state as AdamW,
+    with one kernel launch per operation for all the parameters of a group instead of one
+    per parameter. The optimizer states of both classes are interchangeable.
+    """
+
+    @torch.no_grad()
+    def step(self, closure: Callable = None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+
+            # parameters are grouped by step, which differs only for those that had no gradient
+            step_params = {}
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(p)
+                    state["exp_avg_sq"] = torch.zeros_like(p)
+                state["step"] += 1
+                step_params.setdefault(state["step"], []).append(p)
+
+            for step, params in step_params.items():
+                grads = [p.grad for p in params]
+                exp_avgs = [self.state[p]["exp_avg"] for p in params]
+                exp_avg_sqs = [self.state[p]["exp_avg_sq"] for p in params]
+
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_add_(exp_avgs, grads, alpha=1.0 - beta1)
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1.0 - beta2)
+                denoms = torch._foreach_sqrt(exp_avg_sqs)
+                torch._foreach_add_(denoms, group["eps"])
+
+                step_size = group["lr"]
+                if group["correct_bias"]:
+                    bias_correction1 = 1.0 - beta1 ** step
+                    bias_correction2 = 1.0 - beta2 ** step
+                    step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
+
+                torch._foreach_addcdiv_(params, exp_avgs, denoms, value=-step_size)
+
+                # decoupled weight decay, after the update as in AdamW
+                if group["weight_decay"] > 0.0:
+                    torch._foreach_add_(params, params, alpha=-group["lr"] * group["weight_decay"])
+
+        return loss
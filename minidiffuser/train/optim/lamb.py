@@ -189,4 +189,113 @@ class Lamb(Optimizer):
 
                 p.add_(update, alpha=-group['lr'])
 
-        return loss
\ No newline at end of file
+        return loss
+
+class ForeachLamb(Lamb):
+    """Lamb with multi-tensor (torch._foreach_*) updates: the same math and state as Lamb,
+    with one kernel launch per operation for all the parameters of a group instead of one
+    per parameter. The optimizer states of both classes are interchangeable.
+    Needs the tensor overloads of the foreach ops (torch >= 2.1).
+    """
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        group_params = []
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            for p in params:
+                if p.grad.is_sparse:
+                    raise RuntimeError('Lamb does not support sparse gradients, consider SparseAdam instad.')
+            group_params.append(params)
+
+        device = self.param_groups[0]['params'][0].device
+        one_tensor = torch.tensor(1.0, device=device)
+        # 0-dim: the tensor overload of the foreach division only takes scalar tensors
+        global_grad_norm = torch.zeros((), device=device)
+        grad_norms = [
+            torch._foreach_norm([p.grad for p in params]) for params in group_params if len(params) > 0
+        ]
+        if len(grad_norms) > 0:
+            global_grad_norm.add_(torch.stack(sum(grad_norms, [])).pow(2).sum())
+        global_grad_norm = torch.sqrt(global_grad_norm)
+        max_grad_norm = torch.tensor(self.defaults['max_grad_norm'], device=device)
+        clip_global_grad_norm = torch.where(
+            global_grad_norm > max_grad_norm,
+            global_grad_norm / max_grad_norm,
+            one_tensor)
+
+        for group, params in zip(self.param_groups, group_params):
+            bias_correction = 1 if group['bias_correction'] else 0
+            beta1, beta2 = group['betas']
+            grad_averaging = 1 if group['grad_averaging'] else 0
+            beta3 = 1 - beta1 if grad_averaging else 1.0
+
+            # one step per group, incremented even without gradients as in Lamb
+            if 'step' in group:
+                group['step'] += 1
+            else:
+                group['step'] = 1
+
+            if bias_correction:
+                bias_correction1 = 1 - beta1 ** group['step']
+                bias_correction2 = 1 - beta2 ** group['step']
+            else:
+                bias_correction1, bias_correction2 = 1.0, 1.0
+
+            if len(params) == 0:
+                continue
+
+            grads = [p.grad for p in params]
+            torch._foreach_div_(grads, clip_global_grad_norm)
+            for p in params:
+                state = self.state[p]
+                if len(state) == 0:
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+            exp_avgs = [self.state[p]['exp_avg'] for p in params]
+            exp_avg_sqs = [self.state[p]['exp_avg_sq'] for p in params]
+
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=beta3)  # m_t
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)  # v_t
+
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_div_(denoms, math.sqrt(bias_correction2))
+            torch._foreach_add_(denoms, group['eps'])
+            updates = torch._foreach_div(exp_avgs, bias_correction1)
+            torch._foreach_div_(updates, denoms)
+
+            weight_decay = group['weight_decay']
+            if weight_decay != 0:
+                torch._foreach_add_(updates, params, alpha=weight_decay)
+
+            if weight_decay != 0 or group['always_adapt']:
+                # layer-wise LR adaptation: the updates of the parameters of the same shape
+                # are stacked and scaled by their trust ratios at once
+                shape_idxs = {}
+                for i, p in enumerate(params):
+                    shape_idxs.setdefault(p.shape, []).append(i)
+                for idxs in shape_idxs.values():
+                    shape_params = [params[i] for i in idxs]
+                    shape_updates = torch.stack([updates[i] for i in idxs])
+                    w_norms = torch.stack(torch._foreach_norm(shape_params))
+                    g_norms = shape_updates.reshape(len(idxs), -1).norm(dim=1)
+                    trust_ratios = torch.where(
+                        w_norms > 0,
+                        torch.where(g_norms > 0, w_norms / g_norms, one_tensor),
+                        one_tensor,
+                    )
+                    if group['trust_clip']:
+                        trust_ratios = torch.minimum(trust_ratios, one_tensor)
+                    shape_updates.mul_(trust_ratios.view(-1, *[1] * shape_params[0].dim()))
+                    torch._foreach_add_(shape_params, list(shape_updates.unbind(0)), alpha=-group['lr'])
+            else:
+                torch._foreach_add_(params, updates, alpha=-group['lr'])
+
+        return loss
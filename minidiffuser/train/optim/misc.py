@@ -6,9 +6,9 @@ Misc lr helper
 """
 from torch.optim import Adam, Adamax
 
-from .adamw import AdamW
+from .adamw import AdamW, ForeachAdamW
 from .rangerlars import RangerLars
-from .lamb import Lamb
+from .lamb import Lamb, ForeachLamb
 
 
 def build_optimizer(model, opts):
@@ -47,10 +47,14 @@ def build_optimizer(model, opts):
         OptimCls = Adamax
     elif opts.optim == 'adamw':
         OptimCls = AdamW
+    elif opts.optim == 'adamw_foreach':
+        OptimCls = ForeachAdamW
     elif opts.optim == 'rangerlars':
         OptimCls = RangerLars
     elif opts.optim == 'lamb':
         OptimCls = Lamb
+    elif opts.optim == 'lamb_foreach':
+        OptimCls = ForeachLamb
     elif opts.optim == 'ralamb':
         from .ralamb import Ralamb
         OptimCls = Ralamb
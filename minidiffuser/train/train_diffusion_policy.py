@@ -19,15 +19,20 @@ import torch.nn.functional as F
 import torch.distributed as dist
 import numpy as np
 
-from minidiffuser.train.utils.logger import LOGGER, TB_LOGGER, RunningMeter, add_log_to_file
-from minidiffuser.train.utils.save import ModelSaver, save_training_meta
+from minidiffuser.train.utils.logger import (
+    LOGGER, TB_LOGGER, RunningMeter, DeferredMetrics, add_log_to_file
+)
+from minidiffuser.train.utils.save import ModelSaver, AsyncModelSaver, save_training_meta
+from minidiffuser.utils.profiling import StepProfiler, record_region
 from minidiffuser.train.utils.misc import NoOp, set_dropout, set_random_seed
 from minidiffuser.train.utils.distributed import set_cuda, wrap_model, all_gather
 
 from minidiffuser.train.optim import get_lr_sched, get_lr_sched_decay_rate
 from minidiffuser.train.optim.misc import build_optimizer
 
-from minidiffuser.train.datasets.loader import build_dataloader
+from minidiffuser.train.datasets.loader import build_dataloader, PrefetchLoader
+from minidiffuser.train.datasets.batch_sampler import PointBudgetBatchSampler
+from minidiffuser.train.datasets.batch_augment import BatchPointCloudAugmenter
 from minidiffuser.train.datasets.diffusion_policy_dataset import (
     DPDataset, base_collate_fn, ptv3_collate_fn
 )
@@ -81,23 +86,43 @@ def main(config):
 
     # load data training set
     dataset_class, dataset_collate_fn = DATASET_FACTORY[config.MODEL.model_class]
-    trn_dataset = dataset_class(**config.TRAIN_DATASET, taskvars_filter=config.TRAIN.taskvars_filter, project_root=config.TRAIN.project_root)
+    targets = MODEL_FACTORY[config.MODEL.model_class].required_targets(config.MODEL)
+    trn_dataset = dataset_class(**config.TRAIN_DATASET, taskvars_filter=config.TRAIN.taskvars_filter, project_root=config.TRAIN.project_root, targets=targets)
     LOGGER.info(f'#num_train: {len(trn_dataset)}')
     trn_dataloader, pre_epoch = build_dataloader(
-        trn_dataset, dataset_collate_fn, True, config
+        trn_dataset, dataset_collate_fn, True, config, device=device
     )
+    augment_in_batch = config.TRAIN_DATASET.get('augment_in_batch', None)
+    if config.TRAIN_DATASET.augment_pc and augment_in_batch is not None:
+        # the dataset leaves the augmentation to the training loop
+        batch_augmenter = BatchPointCloudAugmenter(
+            config.TRAIN_DATASET.rot_type, aug_max_rot=config.TRAIN_DATASET.aug_max_rot,
+            euler_resolution=config.TRAIN_DATASET.get('euler_resolution', 5),
+            device=device if augment_in_batch == 'device' else 'cpu'
+        )
+        if augment_in_batch == 'cpu' and isinstance(trn_dataloader, PrefetchLoader):
+            # the prefetched batches are on the device: augment them before their copy
+            trn_dataloader.transform = batch_augmenter
+            batch_augmenter = None
+    else:
+        batch_augmenter = None
 
     if config.VAL_DATASET.use_val:
-        val_dataset = dataset_class(**config.VAL_DATASET, taskvars_filter=config.TRAIN.taskvars_filter, project_root=config.TRAIN.project_root)
+        val_dataset = dataset_class(**config.VAL_DATASET, taskvars_filter=config.TRAIN.taskvars_filter, project_root=config.TRAIN.project_root, targets=targets)
         LOGGER.info(f"#num_val: {len(val_dataset)}")
         val_dataloader = torch.utils.data.DataLoader(
             val_dataset, batch_size=config.TRAIN.val_batch_size,
-            num_workers=config.TRAIN.n_workers, pin_memory=True, collate_fn=dataset_collate_fn, sampler=torch.utils.data.RandomSampler(val_dataset, replacement=True)
+            num_workers=config.TRAIN.n_workers, pin_memory=True, collate_fn=dataset_collate_fn, sampler=torch.utils.data.RandomSampler(val_dataset, replacement=True),
+            worker_init_fn=getattr(val_dataset, 'worker_init_fn', None)
         )
     else:
         val_dataloader = None
     val_loader = InfIterator(val_dataloader)  # Initial iterator
     LOGGER.info(f'#num_steps_per_epoch: {len(trn_dataloader)}')
+    if isinstance(trn_dataloader.batch_sampler, PointBudgetBatchSampler):
+        # estimated from the upper bounds of the sample sizes
+        sampler_stats = trn_dataloader.batch_sampler.stats()
+        LOGGER.info('point budget batches: ' + ', '.join(['%s:%.4g' % (k, v) for k, v in sampler_stats.items()]))
     LOGGER.info(f"Validation Dataset Size: {len(val_dataset)}")
     LOGGER.info(f"Validation Batch Size: {config.TRAIN.val_batch_size}")
 
@@ -119,7 +144,12 @@ def main(config):
             output_dir_tokens = config.output_dir.split('/')
             config.tfboard_log_dir = os.path.join(output_dir_tokens[0], 'TFBoard', *output_dir_tokens[1:])
         TB_LOGGER.create(config.tfboard_log_dir)
-        model_saver = ModelSaver(os.path.join(config.output_dir, 'ckpts'))
+        # checkpoints written in a background thread, the old ones removed by the retention
+        saver_class = AsyncModelSaver if config.TRAIN.save_async else ModelSaver
+        model_saver = saver_class(
+            os.path.join(config.output_dir, 'ckpts'), keep_last=config.TRAIN.save_keep_last,
+            keep_every_steps=config.TRAIN.save_keep_every_steps
+        )
         add_log_to_file(os.path.join(config.output_dir, 'logs', 'log.txt'))
     else:
         LOGGER.disabled = True
@@ -215,6 +245,18 @@ def main(config):
     optimizer.step()
 
     running_metrics = {}
+    # losses stay on the device until they are logged
+    step_metrics = DeferredMetrics()
+    last_log_time = time.time()
+
+    # per-phase step times and a torch.profiler trace, written in output_dir/logs
+    if config.TRAIN.profile or config.TRAIN.profile_trace_steps is not None:
+        step_profiler = StepProfiler(
+            output_dir=os.path.join(config.output_dir, 'logs') if default_gpu else None,
+            trace_steps=config.TRAIN.profile_trace_steps, device=device
+        ).activate()
+    else:
+        step_profiler = NoOp()
 
     
     for epoch_id in range(restart_epoch, config.TRAIN.num_epochs):
@@ -225,20 +267,30 @@ def main(config):
         pre_epoch(epoch_id)
         
         for step, batch in enumerate(trn_dataloader):
+            step_profiler.start_step(global_step)
+            if batch_augmenter is not None:
+                with record_region('augment'):
+                    batch = batch_augmenter(batch)
+
             # forward pass
-            _, losses = model(batch, compute_loss=True, compute_final_action=False)
+            with record_region('forward'):
+                _, losses = model(batch, compute_loss=True, compute_final_action=False)
+
+            if 'npoints_in_batch' in batch:
+                running_metrics.setdefault('batch_points', RunningMeter('batch_points'))
+                running_metrics['batch_points'](sum(batch['npoints_in_batch']))
 
             # backward pass
             if config.TRAIN.gradient_accumulation_steps > 1:  # average loss
                 losses['total'] = losses['total'] / config.TRAIN.gradient_accumulation_steps
-            losses['total'].backward()
+            with record_region('backward'):
+                losses['total'].backward()
 
             for key, value in losses.items():
-                if config.wandb_enable:
-                    wandb_dict.update({f'train_loss_{key}': value.item()})
-                TB_LOGGER.add_scalar(f'step/loss_{key}', value.item(), global_step)
-                running_metrics.setdefault(f'loss_{key}', RunningMeter(f'loss_{key}'))
-                running_metrics[f'loss_{key}'](value.item())
+                step_metrics.add(
+                    value, global_step, tb_key=f'step/loss_{key}',
+                    wandb_key=f'train_loss_{key}', meter_key=f'loss_{key}'
+                )
 
             # optimizer update and logging
             if (step + 1) % config.TRAIN.gradient_accumulation_steps == 0:
@@ -256,33 +308,63 @@ def main(config):
                 TB_LOGGER.step()
 
                 # update model params
-                if config.TRAIN.grad_norm is not None:
-                    grad_norm = torch.nn.utils.clip_grad_norm_(
-                        model.parameters(), config.TRAIN.grad_norm
-                    )
-                    TB_LOGGER.add_scalar('grad_norm', grad_norm, global_step)
-                    if config.wandb_enable:
-                        wandb_dict.update({'grad_norm': grad_norm})
-                optimizer.step()
-                optimizer.zero_grad()
+                with record_region('optimizer'):
+                    if config.TRAIN.grad_norm is not None:
+                        grad_norm = torch.nn.utils.clip_grad_norm_(
+                            model.parameters(), config.TRAIN.grad_norm
+                        )
+                        step_metrics.add(grad_norm, global_step, tb_key='grad_norm', wandb_key='grad_norm')
+                    optimizer.step()
+                    optimizer.zero_grad()
                 
             if global_step % config.TRAIN.bar_steps == 0:
                     pbar.update(config.TRAIN.bar_steps)
 
             if global_step % config.TRAIN.log_steps == 0:
                 # monitor training throughput
+                step_metrics.flush(running_metrics, wandb_dict if config.wandb_enable else None)
                 LOGGER.info(
                     f'==============Epoch {epoch_id} Step {global_step}===============')
                 LOGGER.info(', '.join(['%s:%.4f' % (lk, lv.val) for lk, lv in running_metrics.items()]))
+                phase_times = step_profiler.flush()
+                if phase_times:
+                    LOGGER.info('step time (ms): ' + ', '.join(['%s:%.2f' % (k, v) for k, v in phase_times.items()]))
+                    for k, v in phase_times.items():
+                        TB_LOGGER.add_scalar(f'time/{k}', v, global_step)
+                if hasattr(trn_dataloader, 'data_wait_time'):
+                    # time the training loop waited for the prefetched batches since the last log
+                    log_time = time.time()
+                    wait_ratio = trn_dataloader.data_wait_time / max(log_time - last_log_time, 1e-6)
+                    LOGGER.info('data wait: %.2fs (%.1f%%)' % (trn_dataloader.data_wait_time, wait_ratio * 100))
+                    TB_LOGGER.add_scalar('data/wait_ratio', wait_ratio, global_step)
+                    if config.wandb_enable:
+                        wandb_dict.update({'data_wait_ratio': wait_ratio})
+                    trn_dataloader.data_wait_time = 0
+                    last_log_time = log_time
+                if config.TRAIN.get('train_max_points', None) is not None and 'batch_points' in running_metrics:
+                    # points actually loaded, after the filters and the point sampling
+                    utilization = running_metrics['batch_points'].val / config.TRAIN.train_max_points
+                    TB_LOGGER.add_scalar('data/point_budget_utilization', utilization, global_step)
+                    if config.wandb_enable:
+                        wandb_dict.update({'point_budget_utilization': utilization})
+                if getattr(trn_dataset, 'step_cache', None) is not None:
+                    # counted over all the DataLoader workers of this rank
+                    cache_stats = trn_dataset.step_cache.stats()
+                    LOGGER.info('step cache: ' + ', '.join(['%s:%.4g' % (k, v) for k, v in cache_stats.items()]))
+                    TB_LOGGER.add_scalar('data/cache_hit_rate', cache_stats['hit_rate'], global_step)
+                    if config.wandb_enable:
+                        wandb_dict.update({f'cache_{k}': v for k, v in cache_stats.items()})
                 LOGGER.info('===============================================')
                 if config.wandb_enable:
                     wandb.log(wandb_dict)             
 
             if global_step % config.TRAIN.save_steps == 0:
-                model_saver.save(model, global_step, optimizer=optimizer, rewrite_optimizer=True)
+                with record_region('save'):
+                    model_saver.save(model, global_step, optimizer=optimizer, rewrite_optimizer=True)
 
             if (val_dataloader is not None) and (global_step % config.TRAIN.val_steps == 0):
-                val_metrics = validate(model, val_loader, config.TRAIN.val_batches)
+                with record_region('validate'):
+                    val_metrics = validate(model, val_loader, config.TRAIN.val_batches)
                 LOGGER.info(f'=================Validation=================')
                 metric_str = ', '.join(['%s: %.4f' % (lk, lv) for lk, lv in val_metrics.items()])
                 LOGGER.info(metric_str)
@@ -291,9 +373,14 @@ def main(config):
                 LOGGER.info('===============================================')
                 model.train()
 
+            step_profiler.end_step(global_step)
             if global_step >= config.TRAIN.num_train_steps:
                 break
 
+    profile_summary = step_profiler.close()
+    if profile_summary:
+        LOGGER.info('step profile:\n' + profile_summary)
+    step_metrics.flush(running_metrics, wandb_dict if config.wandb_enable else None)
     if global_step % config.TRAIN.save_steps != 0:
         LOGGER.info(
             f'==============Epoch {epoch_id} Step {global_step}===============')
@@ -307,6 +394,9 @@ def main(config):
         LOGGER.info(metric_str)
         LOGGER.info('===============================================')
 
+    # waits for the pending checkpoints
+    model_saver.close()
+
 
 
 
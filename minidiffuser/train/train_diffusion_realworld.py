@@ -19,8 +19,10 @@ import torch.nn.functional as F
 import torch.distributed as dist
 import numpy as np
 
-from minidiffuser.train.utils.logger import LOGGER, TB_LOGGER, RunningMeter, add_log_to_file
-from minidiffuser.train.utils.save import ModelSaver, save_training_meta
+from minidiffuser.train.utils.logger import (
+    LOGGER, TB_LOGGER, RunningMeter, DeferredMetrics, add_log_to_file
+)
+from minidiffuser.train.utils.save import ModelSaver, AsyncModelSaver, save_training_meta
 from minidiffuser.train.utils.misc import NoOp, set_dropout, set_random_seed
 from minidiffuser.train.utils.distributed import set_cuda, wrap_model, all_gather
 
@@ -28,6 +30,7 @@ from minidiffuser.train.optim import get_lr_sched, get_lr_sched_decay_rate
 from minidiffuser.train.optim.misc import build_optimizer
 
 from minidiffuser.train.datasets.loader import build_dataloader
+from minidiffuser.train.datasets.batch_sampler import PointBudgetBatchSampler
 from minidiffuser.train.datasets.realworld_dataset import (
     RealworldDataset, base_collate_fn, ptv3_collate_fn
 )
@@ -81,23 +84,29 @@ def main(config):
 
     # load data training set
     dataset_class, dataset_collate_fn = DATASET_FACTORY[config.MODEL.model_class]
-    trn_dataset = dataset_class(**config.TRAIN_DATASET, taskvars_filter=config.TRAIN.taskvars_filter, project_root=config.TRAIN.project_root)
+    targets = MODEL_FACTORY[config.MODEL.model_class].required_targets(config.MODEL)
+    trn_dataset = dataset_class(**config.TRAIN_DATASET, taskvars_filter=config.TRAIN.taskvars_filter, project_root=config.TRAIN.project_root, targets=targets)
     LOGGER.info(f'#num_train: {len(trn_dataset)}')
     trn_dataloader, pre_epoch = build_dataloader(
-        trn_dataset, dataset_collate_fn, True, config
+        trn_dataset, dataset_collate_fn, True, config, device=device
     )
 
     if config.VAL_DATASET.use_val:
-        val_dataset = dataset_class(**config.VAL_DATASET, taskvars_filter=config.TRAIN.taskvars_filter, project_root=config.TRAIN.project_root)
+        val_dataset = dataset_class(**config.VAL_DATASET, taskvars_filter=config.TRAIN.taskvars_filter, project_root=config.TRAIN.project_root, targets=targets)
         LOGGER.info(f"#num_val: {len(val_dataset)}")
         val_dataloader = torch.utils.data.DataLoader(
             val_dataset, batch_size=config.TRAIN.val_batch_size,
-            num_workers=config.TRAIN.n_workers, pin_memory=True, collate_fn=dataset_collate_fn, sampler=torch.utils.data.RandomSampler(val_dataset, replacement=True)
+            num_workers=config.TRAIN.n_workers, pin_memory=True, collate_fn=dataset_collate_fn, sampler=torch.utils.data.RandomSampler(val_dataset, replacement=True),
+            worker_init_fn=getattr(val_dataset, 'worker_init_fn', None)
         )
     else:
         val_dataloader = None
     val_loader = InfIterator(val_dataloader)  # Initial iterator
     LOGGER.info(f'#num_steps_per_epoch: {len(trn_dataloader)}')
+    if isinstance(trn_dataloader.batch_sampler, PointBudgetBatchSampler):
+        # estimated from the upper bounds of the sample sizes
+        sampler_stats = trn_dataloader.batch_sampler.stats()
+        LOGGER.info('point budget batches: ' + ', '.join(['%s:%.4g' % (k, v) for k, v in sampler_stats.items()]))
     LOGGER.info(f"Validation Dataset Size: {len(val_dataset)}")
     LOGGER.info(f"Validation Batch Size: {config.TRAIN.val_batch_size}")
 
@@ -119,7 +128,12 @@ def main(config):
             output_dir_tokens = config.output_dir.split('/')
             config.tfboard_log_dir = os.path.join(output_dir_tokens[0], 'TFBoard', *output_dir_tokens[1:])
         TB_LOGGER.create(config.tfboard_log_dir)
-        model_saver = ModelSaver(os.path.join(config.output_dir, 'ckpts'))
+        # checkpoints written in a background thread, the old ones removed by the retention
+        saver_class = AsyncModelSaver if config.TRAIN.save_async else ModelSaver
+        model_saver = saver_class(
+            os.path.join(config.output_dir, 'ckpts'), keep_last=config.TRAIN.save_keep_last,
+            keep_every_steps=config.TRAIN.save_keep_every_steps
+        )
         add_log_to_file(os.path.join(config.output_dir, 'logs', 'log.txt'))
     else:
         LOGGER.disabled = True
@@ -215,6 +229,9 @@ def main(config):
     optimizer.step()
 
     running_metrics = {}
+    # losses stay on the device until they are logged
+    step_metrics = DeferredMetrics()
+    last_log_time = time.time()
 
     
     for epoch_id in range(restart_epoch, config.TRAIN.num_epochs):
@@ -228,17 +245,20 @@ def main(config):
             # forward pass
             _, losses = model(batch, compute_loss=True, compute_final_action=False)
 
+            if 'npoints_in_batch' in batch:
+                running_metrics.setdefault('batch_points', RunningMeter('batch_points'))
+                running_metrics['batch_points'](sum(batch['npoints_in_batch']))
+
             # backward pass
             if config.TRAIN.gradient_accumulation_steps > 1:  # average loss
                 losses['total'] = losses['total'] / config.TRAIN.gradient_accumulation_steps
             losses['total'].backward()
 
             for key, value in losses.items():
-                if config.wandb_enable:
-                    wandb_dict.update({f'train_loss_{key}': value.item()})
-                TB_LOGGER.add_scalar(f'step/loss_{key}', value.item(), global_step)
-                running_metrics.setdefault(f'loss_{key}', RunningMeter(f'loss_{key}'))
-                running_metrics[f'loss_{key}'](value.item())
+                step_metrics.add(
+                    value, global_step, tb_key=f'step/loss_{key}',
+                    wandb_key=f'train_loss_{key}', meter_key=f'loss_{key}'
+                )
 
             # optimizer update and logging
             if (step + 1) % config.TRAIN.gradient_accumulation_steps == 0:
@@ -260,9 +280,7 @@ def main(config):
                     grad_norm = torch.nn.utils.clip_grad_norm_(
                         model.parameters(), config.TRAIN.grad_norm
                     )
-                    TB_LOGGER.add_scalar('grad_norm', grad_norm, global_step)
-                    if config.wandb_enable:
-                        wandb_dict.update({'grad_norm': grad_norm})
+                    step_metrics.add(grad_norm, global_step, tb_key='grad_norm', wandb_key='grad_norm')
                 optimizer.step()
                 optimizer.zero_grad()
                 
@@ -271,9 +289,26 @@ def main(config):
 
             if global_step % config.TRAIN.log_steps == 0:
                 # monitor training throughput
+                step_metrics.flush(running_metrics, wandb_dict if config.wandb_enable else None)
                 LOGGER.info(
                     f'==============Epoch {epoch_id} Step {global_step}===============')
                 LOGGER.info(', '.join(['%s:%.4f' % (lk, lv.val) for lk, lv in running_metrics.items()]))
+                if hasattr(trn_dataloader, 'data_wait_time'):
+                    # time the training loop waited for the prefetched batches since the last log
+                    log_time = time.time()
+                    wait_ratio = trn_dataloader.data_wait_time / max(log_time - last_log_time, 1e-6)
+                    LOGGER.info('data wait: %.2fs (%.1f%%)' % (trn_dataloader.data_wait_time, wait_ratio * 100))
+                    TB_LOGGER.add_scalar('data/wait_ratio', wait_ratio, global_step)
+                    if config.wandb_enable:
+                        wandb_dict.update({'data_wait_ratio': wait_ratio})
+                    trn_dataloader.data_wait_time = 0
+                    last_log_time = log_time
+                if config.TRAIN.get('train_max_points', None) is not None and 'batch_points' in running_metrics:
+                    # points actually loaded, after the filters and the point sampling
+                    utilization = running_metrics['batch_points'].val / config.TRAIN.train_max_points
+                    TB_LOGGER.add_scalar('data/point_budget_utilization', utilization, global_step)
+                    if config.wandb_enable:
+                        wandb_dict.update({'point_budget_utilization': utilization})
                 LOGGER.info('===============================================')
                 if config.wandb_enable:
                     wandb.log(wandb_dict)             
@@ -294,6 +329,7 @@ def main(config):
             if global_step >= config.TRAIN.num_train_steps:
                 break
 
+    step_metrics.flush(running_metrics, wandb_dict if config.wandb_enable else None)
     if global_step % config.TRAIN.save_steps != 0:
         LOGGER.info(
             f'==============Epoch {epoch_id} Step {global_step}===============')
@@ -307,6 +343,9 @@ def main(config):
         LOGGER.info(metric_str)
         LOGGER.info('===============================================')
 
+    # waits for the pending checkpoints
+    model_saver.close()
+
 
 
 
@@ -8,6 +8,7 @@ NOTE: loggers are global objects use with caution
 import logging
 import math
 
+import torch
 import tensorboardX
 
 
@@ -92,3 +93,45 @@ class RunningMeter(object):
     @property
     def name(self):
         return self._name
+
+
+class DeferredMetrics(object):
+    """ per-step scalars kept as detached tensors on their device and copied to the host
+        in one transfer at flush(), instead of a synchronizing .item() per value
+    """
+    def __init__(self):
+        self._records = []  # (value, step, tb_key, wandb_key, meter_key)
+
+    def add(self, value, step, tb_key=None, wandb_key=None, meter_key=None):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+        self._records.append((value, step, tb_key, wandb_key, meter_key))
+
+    def _to_host(self):
+        values = [record[0] for record in self._records]
+        tensor_idxs = {}    # device: indices of its values
+        for i, value in enumerate(values):
+            if isinstance(value, torch.Tensor):
+                tensor_idxs.setdefault(value.device, []).append(i)
+        for idxs in tensor_idxs.values():
+            host_values = torch.stack(
+                [values[i].float().reshape(()) for i in idxs]
+            ).cpu().tolist()
+            for i, value in zip(idxs, host_values):
+                values[i] = value
+        return values
+
+    def flush(self, running_metrics, wandb_dict=None):
+        """ log the buffered values in order: every step to tensorboard, the running
+            meters, and the last value of each key to wandb_dict
+        """
+        values = self._to_host()
+        for value, (_, step, tb_key, wandb_key, meter_key) in zip(values, self._records):
+            if tb_key is not None:
+                TB_LOGGER.add_scalar(tb_key, value, step)
+            if meter_key is not None:
+                running_metrics.setdefault(meter_key, RunningMeter(meter_key))
+                running_metrics[meter_key](value)
+            if wandb_key is not None and wandb_dict is not None:
+                wandb_dict[wandb_key] = value
+        self._records = []
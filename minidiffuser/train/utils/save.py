@@ -6,6 +6,10 @@ saving utilities
 """
 import json
 import os
+import re
+import queue
+import threading
+
 import torch
 from omegaconf import OmegaConf
 
@@ -18,31 +22,141 @@ def save_training_meta(args):
         args_str = OmegaConf.to_yaml(args)
         print(args_str, file=writer)
 
+def _to_cpu(obj):
+    """Copy of the tensors of a (nested) state dict on the cpu, detached from the training"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_torch_save(obj, output_file):
+    """torch.save to a temporary file renamed at the end: a crash never leaves a partial file"""
+    tmp_file = f'{output_file}.tmp{os.getpid()}'
+    torch.save(obj, tmp_file)
+    os.replace(tmp_file, output_file)
+
+
 class ModelSaver(object):
-    def __init__(self, output_dir, prefix='model_step', suffix='pt'):
+    def __init__(
+            self, output_dir, prefix='model_step', suffix='pt', keep_last=None, keep_every_steps=None
+        ):
+        """
+        keep_last: number of the latest checkpoints kept, None: all of them
+        keep_every_steps: checkpoints of the steps divisible by it are also kept
+        """
+        assert keep_last is None or keep_last >= 1, 'the latest checkpoint is needed to resume'
         self.output_dir = output_dir
         self.prefix = prefix
         self.suffix = suffix
+        self.keep_last = keep_last
+        self.keep_every_steps = keep_every_steps
 
-    def save(self, model, step, optimizer=None, rewrite_optimizer=False):
-        output_model_file = os.path.join(self.output_dir,
-                                 f"{self.prefix}_{step}.{self.suffix}")
+    def _get_state(self, model, step, optimizer=None, copy=False):
+        """copy: the returned tensors never share memory with the model and optimizer"""
         state_dict = {}
         for k, v in model.state_dict().items():
             if k.startswith('module.'):
                 k = k[7:]
             if isinstance(v, torch.Tensor):
-                state_dict[k] = v.cpu()
+                state_dict[k] = v.detach().to('cpu', copy=True) if copy else v.cpu()
             else:
                 state_dict[k] = v
-        torch.save(state_dict, output_model_file)
-        if optimizer is not None:
-            dump = {'step': step, 'optimizer': optimizer.state_dict()}
-            if hasattr(optimizer, '_amp_stash'):
-                pass  # TODO fp16 optimizer
+        if optimizer is None:
+            return state_dict, None
+        dump = {'step': step, 'optimizer': optimizer.state_dict()}
+        if hasattr(optimizer, '_amp_stash'):
+            pass  # TODO fp16 optimizer
+        if copy:
+            # the optimizer state dict references the live state tensors
+            dump = _to_cpu(dump)
+        return state_dict, dump
+
+    def _write(self, step, state_dict, dump, rewrite_optimizer):
+        atomic_torch_save(
+            state_dict, os.path.join(self.output_dir, f"{self.prefix}_{step}.{self.suffix}")
+        )
+        # after the model, which train_state_latest.pt refers to when resuming
+        if dump is not None:
             if rewrite_optimizer:
-                torch.save(dump, f'{self.output_dir}/train_state_latest.pt')
+                atomic_torch_save(dump, f'{self.output_dir}/train_state_latest.pt')
             else:
-                torch.save(dump, f'{self.output_dir}/train_state_{step}.pt')
+                atomic_torch_save(dump, f'{self.output_dir}/train_state_{step}.pt')
+        self._remove_old_checkpoints()
+
+    def _remove_old_checkpoints(self):
+        if self.keep_last is None:
+            return
+        pattern = re.compile(rf'{re.escape(self.prefix)}_(\d+)\.{re.escape(self.suffix)}$')
+        steps = sorted(
+            int(match.group(1)) for match in map(pattern.match, os.listdir(self.output_dir))
+            if match is not None
+        )
+        for step in steps[:-self.keep_last]:
+            if self.keep_every_steps is not None and step % self.keep_every_steps == 0:
+                continue
+            for filename in [f'{self.prefix}_{step}.{self.suffix}', f'train_state_{step}.pt']:
+                if os.path.exists(os.path.join(self.output_dir, filename)):
+                    os.remove(os.path.join(self.output_dir, filename))
+
+    def save(self, model, step, optimizer=None, rewrite_optimizer=False):
+        state_dict, dump = self._get_state(model, step, optimizer=optimizer)
+        self._write(step, state_dict, dump, rewrite_optimizer)
+
+    def close(self):
+        pass
+
+
+class AsyncModelSaver(ModelSaver):
+    """
+    ModelSaver that only copies the model and optimizer states to the cpu in the training loop;
+    a background thread serializes and writes them. A save first waits for the previous one
+    to be written, so a single snapshot is held in memory.
+    """
+    def __init__(self, output_dir, **kwargs):
+        super().__init__(output_dir, **kwargs)
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                # the snapshot is released before wait() returns
+                item = None
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def save(self, model, step, optimizer=None, rewrite_optimizer=False):
+        # before the snapshot, so the previous one is released
+        self.wait()
+        # snapshot of the states, the training goes on while they are written
+        state_dict, dump = self._get_state(model, step, optimizer=optimizer, copy=True)
+        self._queue.put((step, state_dict, dump, rewrite_optimizer))
 
+    def wait(self):
+        """Blocks until the pending checkpoints are written"""
+        self._queue.join()
+        self._raise_error()
 
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
@@ -0,0 +1,152 @@
+"""
+Per-phase timing of the training steps, and torch.profiler traces of a window of steps.
+
+The training loop and the model mark named regions with record_region(name). Without an
+active StepProfiler these are shared null contexts. With one, every region is timed with
+CUDA events (host timers on the cpu) and labelled in the torch.profiler trace. The events
+are only read in StepProfiler.flush, so the timing adds no synchronization to the steps.
+"""
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+_ACTIVE_PROFILER = None
+_NULL_CONTEXT = nullcontext()
+
+
+def record_region(name):
+    """Times the enclosed code as region `name` of the current step, if profiling"""
+    if _ACTIVE_PROFILER is None:
+        return _NULL_CONTEXT
+    return _ACTIVE_PROFILER.region(name)
+
+
+class StepProfiler(object):
+    def __init__(self, output_dir=None, trace_steps=None, device=None):
+        """
+        output_dir: where close() writes the summary table and the trace, None: not written
+        trace_steps: [start, end] global steps captured by torch.profiler, None: no trace
+        """
+        self.output_dir = output_dir
+        self.trace_steps = trace_steps
+        self.use_cuda = device is not None and torch.device(device).type == 'cuda'
+
+        self._step_events = []      # (name, start, end) of the current step
+        self._events = []           # of the completed steps since the last flush
+        self._num_flush_steps = 0
+        self._step_start = None
+        self._last_step_end = None
+        self.total_times = defaultdict(float)  # ms
+        self.total_calls = defaultdict(int)
+        self.num_steps = 0
+
+        self._trace = None
+        self._trace_done = False
+
+    def activate(self):
+        global _ACTIVE_PROFILER
+        _ACTIVE_PROFILER = self
+        return self
+
+    def _timer(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @staticmethod
+    def _elapsed(start, end):
+        if isinstance(start, float):
+            return (end - start) * 1000
+        return start.elapsed_time(end)
+
+    @contextmanager
+    def region(self, name):
+        with torch.profiler.record_function(name):
+            start = self._timer()
+            try:
+                yield
+            finally:
+                self._step_events.append((name, start, self._timer()))
+
+    def start_step(self, global_step):
+        """Called when the batch of the step is loaded: the time since the last step is data wait"""
+        now = time.perf_counter()
+        if self._last_step_end is not None:
+            self._step_events.append(('data_wait', self._last_step_end, now))
+        if self.trace_steps is not None and self._trace is None and not self._trace_done \
+                and global_step + 1 >= self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(activities=activities)
+            self._trace.start()
+        self._step_start = self._timer()
+
+    def end_step(self, global_step):
+        self._step_events.append(('step', self._step_start, self._timer()))
+        self._events.extend(self._step_events)
+        self._step_events = []
+        self._num_flush_steps += 1
+        self._last_step_end = time.perf_counter()
+        if self._trace is not None and global_step >= self.trace_steps[1]:
+            self._stop_trace()
+
+    def flush(self):
+        """Reads the events of the steps since the last flush, returns their ms per step"""
+        if self._num_flush_steps == 0:
+            return {}
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        times = defaultdict(float)
+        for name, start, end in self._events:
+            times[name] += self._elapsed(start, end)
+            self.total_calls[name] += 1
+        for name, value in times.items():
+            self.total_times[name] += value
+        step_times = {name: value / self._num_flush_steps for name, value in times.items()}
+        self.num_steps += self._num_flush_steps
+        self._events, self._num_flush_steps = [], 0
+        return step_times
+
+    def summary(self):
+        """Table of the regions by total time"""
+        step_time = self.total_times.get('step', 0) / max(self.num_steps, 1)
+        lines = [
+            f'{self.num_steps} steps, data wait excluded from the step time',
+            '%-20s %10s %12s %10s' % ('region', 'calls/step', 'ms/step', '% of step'),
+        ]
+        for name, total in sorted(self.total_times.items(), key=lambda x: -x[1]):
+            ms = total / max(self.num_steps, 1)
+            lines.append('%-20s %10.1f %12.2f %10.1f' % (
+                name, self.total_calls[name] / max(self.num_steps, 1), ms,
+                ms / max(step_time, 1e-6) * 100
+            ))
+        return '\n'.join(lines)
+
+    def _stop_trace(self):
+        self._trace.stop()
+        if self.output_dir is not None:
+            self._trace.export_chrome_trace(os.path.join(self.output_dir, 'profile_trace.json'))
+            sort_by = 'cuda_time_total' if self.use_cuda else 'cpu_time_total'
+            with open(os.path.join(self.output_dir, 'profile_trace_ops.txt'), 'w') as f:
+                f.write(self._trace.key_averages().table(sort_by=sort_by, row_limit=50))
+        self._trace, self._trace_done = None, True
+
+    def close(self):
+        """Stops the trace, writes the summary table and deactivates the regions"""
+        global _ACTIVE_PROFILER
+        if self._trace is not None:
+            self._stop_trace()
+        self.flush()
+        if self.output_dir is not None:
+            with open(os.path.join(self.output_dir, 'profile_summary.txt'), 'w') as f:
+                f.write(self.summary() + '\n')
+        if _ACTIVE_PROFILER is self:
+            _ACTIVE_PROFILER = None
+        return self.summary()
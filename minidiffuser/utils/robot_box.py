@@ -1,13 +1,34 @@
 import numpy as np
+import torch
 from scipy.spatial.transform import Rotation as R
-import open3d as o3d
+
+
+def points_in_boxes(xyz, centers, rotations, half_extents):
+    """
+    Mask of the points inside any of the oriented boxes, with the same (inclusive) test
+    as open3d OrientedBoundingBox.get_point_indices_within_bounding_box.
+    The points are moved to all the box frames with a single batched matmul.
+    Works for numpy arrays and torch tensors, with optional leading batch dims:
+        xyz: (..., npoints, 3)
+        centers: (..., nboxes, 3), rotations: (..., nboxes, 3, 3), half_extents: (..., nboxes, 3)
+    Returns: (..., npoints) bool
+    """
+    # (..., nboxes, npoints, 3) coordinates in the box frames: R^T (p - c)
+    local_xyz = (xyz[..., None, :, :] - centers[..., :, None, :]) @ rotations
+    if isinstance(local_xyz, torch.Tensor):
+        inside = (local_xyz.abs() <= half_extents[..., :, None, :]).all(-1)
+        return inside.any(-2)
+    inside = np.all(np.abs(local_xyz) <= half_extents[..., :, None, :], -1)
+    return np.any(inside, -2)
+
 
 class RobotBox(object):
 
     def __init__(self, arm_links_info, env_name='rlbench', keep_gripper=False):
         bbox_info, pose_info = arm_links_info
 
-        self.robot_obboxes = []
+        # one oriented box per removed link: center, rotation (columns are the box axes), extent
+        centers, rotations, extents = [], [], []
 
         if env_name == 'rlbench':
             arm_links = ["Panda_link0", "Panda_link1", "Panda_link2", "Panda_link3", "Panda_link4", "Panda_link5", "Panda_link6", "Panda_link7"]
@@ -22,12 +43,9 @@ class RobotBox(object):
                     link_bbox = bbox_info[f"{arm_link}_respondable_bbox"]
                     link_pose = pose_info[f"{arm_link}_respondable_pose"]
 
-                link_rot = R.from_quat(link_pose[3:]).as_matrix()   # xyzw
-                obbox = o3d.geometry.OrientedBoundingBox(
-                    link_pose[:3], link_rot, link_bbox[1::2] - link_bbox[::2]
-                )
-
-                self.robot_obboxes.append(obbox)
+                centers.append(link_pose[:3])
+                rotations.append(link_pose[3:])
+                extents.append(link_bbox[1::2] - link_bbox[::2])
 
         elif env_name == 'real':
             rm_links = [
@@ -43,27 +61,54 @@ class RobotBox(object):
             for arm_link, link_bbox in bbox_info.items():
                 if arm_link in rm_links:
                     link_pose = pose_info[arm_link.replace('_bbox', '_pose')]
-                    link_rot = R.from_quat(link_pose[3:]).as_matrix()   # xyzw
-                    obbox = o3d.geometry.OrientedBoundingBox(
-                        link_pose[:3], link_rot, np.array(link_bbox[1::2]) - np.array(link_bbox[::2])
-                    )
-                    self.robot_obboxes.append(obbox)
+                    centers.append(link_pose[:3])
+                    rotations.append(link_pose[3:])
+                    extents.append(np.array(link_bbox[1::2]) - np.array(link_bbox[::2]))
+
+        self.centers = np.array(centers, dtype=np.float64).reshape(-1, 3)
+        if len(rotations) > 0:
+            self.rotations = R.from_quat(np.array(rotations)).as_matrix()   # xyzw
+        else:
+            self.rotations = np.zeros((0, 3, 3))
+        self.half_extents = np.array(extents, dtype=np.float64).reshape(-1, 3) / 2
+
+    def get_pc_mask(self, xyz):
+        """xyz: (..., npoints, 3) numpy array or tensor, True for the points on the robot"""
+        centers, rotations, half_extents = self.centers, self.rotations, self.half_extents
+        if isinstance(xyz, torch.Tensor):
+            centers, rotations, half_extents = [
+                torch.from_numpy(x).to(device=xyz.device, dtype=xyz.dtype)
+                for x in [centers, rotations, half_extents]
+            ]
+        return points_in_boxes(xyz, centers, rotations, half_extents)
+
+    @staticmethod
+    def get_batch_pc_mask(xyz, robot_boxes):
+        """
+        Masks of a batch of clouds with the robot boxes of each cloud, in one call.
+        xyz: (batch, npoints, 3); robot_boxes: list of RobotBox with the same number of links
+        """
+        centers = np.stack([x.centers for x in robot_boxes], 0)
+        rotations = np.stack([x.rotations for x in robot_boxes], 0)
+        half_extents = np.stack([x.half_extents for x in robot_boxes], 0)
+        if isinstance(xyz, torch.Tensor):
+            centers, rotations, half_extents = [
+                torch.from_numpy(x).to(device=xyz.device, dtype=xyz.dtype)
+                for x in [centers, rotations, half_extents]
+            ]
+        return points_in_boxes(xyz, centers, rotations, half_extents)
 
     def get_pc_overlap_ratio(self, xyz=None, pcd=None, return_indices=False):
         if xyz is None:
             assert pcd is not None
-            points = pcd.points
-        else:
-            points = o3d.utility.Vector3dVector(xyz)
+            xyz = np.asarray(pcd.points)
 
-        num_points = max(len(points), 1)
-        overlap_point_ids = set()
-        for obbox in self.robot_obboxes:
-            tmp = obbox.get_point_indices_within_bounding_box(points)
-            overlap_point_ids = overlap_point_ids.union(set(tmp))
-        overlap_ratio = len(overlap_point_ids) / num_points
+        mask = self.get_pc_mask(xyz)
+        overlap_ratio = mask.sum().item() / max(len(mask), 1)
 
         if return_indices:
-            return overlap_ratio, overlap_point_ids
+            if isinstance(mask, torch.Tensor):
+                mask = mask.cpu().numpy()
+            return overlap_ratio, set(np.nonzero(mask)[0].tolist())
         
         return overlap_ratio
\ No newline at end of file
@@ -1,81 +1,81 @@
 import torch
-
-from scipy.spatial.transform import Rotation as R
 import numpy as np
 
 
+# All the conversions below are batched torch ops on the device of the inputs.
+# Quaternions are xyzw (scalar-last) and euler angles are extrinsic 'xyz' in degrees,
+# the same conventions as scipy.spatial.transform.Rotation.
+# numpy inputs are computed in float64 and returned as numpy arrays.
+
+def _as_tensor(x):
+    if isinstance(x, torch.Tensor):
+        return x, False
+    return torch.from_numpy(np.asarray(x, dtype=np.float64)), True
+
+def _as_output(x, is_numpy):
+    return x.numpy() if is_numpy else x
+
+
 class RotationMatrixTransform():
     # https://github.com/papagina/RotationContinuity/blob/758b0ce551c06372cab7022d4c0bdf331c89c696/shapenet/code/tools.py
-    
+
     @staticmethod
     def normalize_vector(v):
         '''
         Args:
-            v: torch.Tensor, (batch, n)
+            v: torch.Tensor, (..., n)
         Returns:
-            normalized v: torch.Tensor, (batch, n)
+            normalized v: torch.Tensor, (..., n)
         '''
-        device = v.device
-        batch = v.shape[0]
-        v_mag = torch.sqrt(v.pow(2).sum(1))# batch
-        v_mag = torch.max(v_mag, torch.autograd.Variable(torch.FloatTensor([1e-8]).to(device)))
-        v_mag = v_mag.view(batch, 1).expand(batch, v.shape[1])
-        v = v / v_mag
-        return v
+        v_mag = torch.sqrt(v.pow(2).sum(-1, keepdim=True)).clamp(min=1e-8)
+        return v / v_mag
 
     @staticmethod
     def cross_product(u, v):
         '''
         Args:
-            u: torch.Tensor, (batch, 3)
-            v: torch.Tensor, (batch, 3)
+            u: torch.Tensor, (..., 3)
+            v: torch.Tensor, (..., 3)
         Returns:
-            u x v: torch.Tensor, (batch, 3)
+            u x v: torch.Tensor, (..., 3)
         '''
-        batch = u.shape[0]
-        i = u[:, 1] * v[:, 2] - u[:, 2] * v[:, 1]
-        j = u[:, 2] * v[:, 0] - u[:, 0] * v[:, 2]
-        k = u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
-            
-        out = torch.cat((i.view(batch, 1), j.view(batch, 1), k.view(batch, 1)), 1)    
-        return out
+        i = u[..., 1] * v[..., 2] - u[..., 2] * v[..., 1]
+        j = u[..., 2] * v[..., 0] - u[..., 0] * v[..., 2]
+        k = u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+        return torch.stack((i, j, k), -1)
 
     @staticmethod
     def compute_rotation_matrix_from_ortho6d(poses):
         '''
         Args:
-            poses: torch.Tensor, (batch, 6)
+            poses: torch.Tensor, (..., 6)
         Returns:
-            matrix: torch.Tensor, (batch, 3, 3)
-        '''
-        x_raw = poses[:, 0:3]    # (batch, 3)
-        y_raw = poses[:, 3:6]    # (batch, 3)
-            
-        x = RotationMatrixTransform.normalize_vector(x_raw) # (batch, 3)
-        z = RotationMatrixTransform.cross_product(x, y_raw) # (batch, 3)
-        z = RotationMatrixTransform.normalize_vector(z)     # (batch, 3)
-        y = RotationMatrixTransform.cross_product(z, x)     # (batch, 3)
-            
-        x = x.view(-1, 3, 1)
-        y = y.view(-1, 3, 1)
-        z = z.view(-1, 3, 1)
-        
-        matrix = torch.cat((x, y, z), 2) # (batch, 3)
+            matrix: torch.Tensor, (..., 3, 3)
+        '''
+        x_raw = poses[..., 0:3]    # (..., 3)
+        y_raw = poses[..., 3:6]    # (..., 3)
+
+        x = RotationMatrixTransform.normalize_vector(x_raw) # (..., 3)
+        z = RotationMatrixTransform.cross_product(x, y_raw) # (..., 3)
+        z = RotationMatrixTransform.normalize_vector(z)     # (..., 3)
+        y = RotationMatrixTransform.cross_product(z, x)     # (..., 3)
+
+        matrix = torch.stack((x, y, z), -1) # (..., 3, 3), x, y, z as columns
         return matrix
 
     @staticmethod
     def get_ortho6d_from_rotation_matrix(matrix):
         '''
         Args:
-            matrix: torch.Tensor, (batch, 3, 3)
+            matrix: torch.Tensor, (..., 3, 3)
         Returns:
-            vector: torch.Tensor, (batch, 6)
+            vector: torch.Tensor, (..., 6)
         '''
         # The orhto6d represents the first two column vectors a1 and a2 of the
         # rotation matrix: [ | , |,  | ]
         #                  [ a1, a2, a3]
         #                  [ | , |,  | ]
-        ortho6d = matrix[:, :, :2].permute(0, 2, 1).flatten(-2)
+        ortho6d = matrix[..., :, :2].transpose(-1, -2).flatten(-2)
         return ortho6d
 
     @staticmethod
@@ -86,11 +86,15 @@ class RotationMatrixTransform():
         Returns:
             matrix: (batch, 3, 3)
         '''
-        mats = [R.from_quat(q).as_matrix() for q in quats]
-        mats = np.stack(mats, 0)
-        if isinstance(quats, torch.Tensor):
-            mats = torch.from_numpy(mats).to(quats.device)
-        return mats
+        quats, is_numpy = _as_tensor(quats)
+        quats = quats / quats.norm(dim=-1, keepdim=True)
+        x, y, z, w = quats.unbind(-1)
+        mats = torch.stack([
+            1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w),
+            2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w),
+            2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y),
+        ], -1).view(quats.shape[:-1] + (3, 3))
+        return _as_output(mats, is_numpy)
 
     @staticmethod
     def matrix_to_quaternion(mats):
@@ -100,24 +104,41 @@ class RotationMatrixTransform():
         Returns:
             quats: (batch, 4), xyzw (scalar-last convention)
         '''
-        quats = [R.from_matrix(m).as_quat() for m in mats]
-        quats = np.stack(quats, 0)
-        if isinstance(mats, torch.Tensor):
-            quats = torch.from_numpy(quats).to(mats.device)
-        return quats
-    
+        mats, is_numpy = _as_tensor(mats)
+        m = mats.flatten(-2).unbind(-1)
+        m00, m01, m02, m10, m11, m12, m20, m21, m22 = m
+        trace = m00 + m11 + m22
+
+        # the same branches as scipy: build from the largest of diag(m) and trace
+        cands = torch.stack([
+            torch.stack([1 + 2 * m00 - trace, m10 + m01, m20 + m02, m21 - m12], -1),
+            torch.stack([m01 + m10, 1 + 2 * m11 - trace, m21 + m12, m02 - m20], -1),
+            torch.stack([m02 + m20, m12 + m21, 1 + 2 * m22 - trace, m10 - m01], -1),
+            torch.stack([m21 - m12, m02 - m20, m10 - m01, 1 + trace], -1),
+        ], -2) # (..., 4, 4)
+        choice = torch.stack([m00, m11, m22, trace], -1).argmax(-1)
+        quats = torch.gather(
+            cands, -2, choice[..., None, None].expand(choice.shape + (1, 4))
+        ).squeeze(-2)
+        quats = quats / quats.norm(dim=-1, keepdim=True)
+        return _as_output(quats, is_numpy)
+
     @staticmethod
     def quaternion_to_ortho6d(quats):
-        return RotationMatrixTransform.get_ortho6d_from_rotation_matrix(
+        quats, is_numpy = _as_tensor(quats)
+        ortho6d = RotationMatrixTransform.get_ortho6d_from_rotation_matrix(
             RotationMatrixTransform.quaternion_to_matrix(quats)
         )
-    
+        return _as_output(ortho6d, is_numpy)
+
     @staticmethod
     def ortho6d_to_quaternion(ortho6d):
-        return RotationMatrixTransform.matrix_to_quaternion(
+        ortho6d, is_numpy = _as_tensor(ortho6d)
+        quats = RotationMatrixTransform.matrix_to_quaternion(
             RotationMatrixTransform.compute_rotation_matrix_from_ortho6d(ortho6d)
         )
-    
+        return _as_output(quats, is_numpy)
+
     @staticmethod
     def quaternion_to_euler(quats):
         '''
@@ -126,12 +147,25 @@ class RotationMatrixTransform():
         Returns:
             eulers: (batch, 3), [-180, 180]
         '''
-        eulers = [R.from_quat(q).as_euler('xyz', degrees=True) for q in quats]
-        eulers = np.stack(eulers, 0)
-        if isinstance(quats, torch.Tensor):
-            eulers = torch.from_numpy(eulers).to(quats.device)
-        return eulers
-    
+        quats, is_numpy = _as_tensor(quats)
+        dtype = quats.dtype
+        # float64 to resolve the gimbal lock as scipy does
+        mats = RotationMatrixTransform.quaternion_to_matrix(quats.double())
+        m00, m01, m10, m11 = mats[..., 0, 0], mats[..., 0, 1], mats[..., 1, 0], mats[..., 1, 1]
+        m20, m21, m22 = mats[..., 2, 0], mats[..., 2, 1], mats[..., 2, 2]
+
+        cos_y = torch.sqrt(m00 * m00 + m10 * m10)
+        ey = torch.atan2(-m20, cos_y)
+        ex = torch.atan2(m21, m22)
+        ez = torch.atan2(m10, m00)
+        # gimbal lock at y=+-90: scipy sets the z angle to 0
+        lock = cos_y < 1e-7
+        ex = torch.where(lock, torch.atan2(-torch.sign(m20) * m01, m11), ex)
+        ez = torch.where(lock, torch.zeros_like(ez), ez)
+
+        eulers = torch.rad2deg(torch.stack([ex, ey, ez], -1)).to(dtype)
+        return _as_output(eulers, is_numpy)
+
     @staticmethod
     def euler_to_quaternion(eulers):
         '''
@@ -140,34 +174,45 @@ class RotationMatrixTransform():
         Returns:
             quats: (batch, 4), xyzw (scalar-last convention)
         '''
-        quats = [R.from_euler('xyz', e, degrees=True).as_quat() for e in eulers]
-        quats = np.stack(quats, 0)
-        quats = torch.from_numpy(quats).to(eulers.device)
-        return quats
-    
+        eulers, is_numpy = _as_tensor(eulers)
+        half = torch.deg2rad(eulers) / 2
+        cx, cy, cz = torch.cos(half).unbind(-1)
+        sx, sy, sz = torch.sin(half).unbind(-1)
+        # extrinsic xyz: q = qz * qy * qx
+        quats = torch.stack([
+            sx * cy * cz - cx * sy * sz,
+            cx * sy * cz + sx * cy * sz,
+            cx * cy * sz - sx * sy * cz,
+            cx * cy * cz + sx * sy * sz,
+        ], -1)
+        return _as_output(quats, is_numpy)
+
 
 ################# functions from RVT-2 #################
 
 def sensitive_gimble_fix(euler):
     """
-    :param euler: euler angles in degree as np.ndarray in shape either [3] or
+    :param euler: euler angles in degree as np.ndarray/torch.Tensor in shape either [3] or
     [b, 3]
     """
+    euler, is_numpy = _as_tensor(euler)
+    euler = euler.clone().double() # float64 to hit the gimbal lock exactly
     # selecting sensitive angle
     select1 = (89 < euler[..., 1]) & (euler[..., 1] < 91)
-    euler[select1, 1] = 90
+    euler[..., 1][select1] = 90
     # selecting sensitive angle
     select2 = (-91 < euler[..., 1]) & (euler[..., 1] < -89)
-    euler[select2, 1] = -90
+    euler[..., 1][select2] = -90
 
     # recalulating the euler angles, see assert
-    r = R.from_euler("xyz", euler, degrees=True)
-    euler = r.as_euler("xyz", degrees=True)
+    euler = RotationMatrixTransform.quaternion_to_euler(
+        RotationMatrixTransform.euler_to_quaternion(euler)
+    )
 
     select = select1 | select2
     assert (euler[select][..., 2] == 0).all(), euler
 
-    return euler
+    return _as_output(euler, is_numpy)
 
 def quaternion_to_discrete_euler(quaternion, resolution, gimble_fix=True):
     """
@@ -176,19 +221,23 @@ def quaternion_to_discrete_euler(quaternion, resolution, gimble_fix=True):
         which could be hard for a network to learn. When gimble_fix is true, around
         y=90, we change the mode towards x=0, potentially making it easy for the
         network to learn.
+    :param quaternion: [4] or [b, 4]
     """
-    r = R.from_quat(quaternion)
+    quaternion, is_numpy = _as_tensor(quaternion)
 
-    euler = r.as_euler("xyz", degrees=True)
+    euler = RotationMatrixTransform.quaternion_to_euler(quaternion.double())
     if gimble_fix:
         euler = sensitive_gimble_fix(euler)
 
-    euler += 180
-    assert np.min(euler) >= 0 and np.max(euler) <= 360
-    disc = np.around((euler / resolution)).astype(int)
+    euler = euler + 180
+    disc = torch.round(euler / resolution).long()
     disc[disc == int(360 / resolution)] = 0
-    return disc
+    return _as_output(disc, is_numpy)
 
 def discrete_euler_to_quaternion(discrete_euler, resolution):
-    euler = (discrete_euler * resolution) - 180
-    return R.from_euler("xyz", euler, degrees=True).as_quat()
\ No newline at end of file
+    """
+    :param discrete_euler: [3] or [b, 3]
+    """
+    discrete_euler, is_numpy = _as_tensor(discrete_euler)
+    euler = (discrete_euler * float(resolution)) - 180
+    return _as_output(RotationMatrixTransform.euler_to_quaternion(euler), is_numpy)
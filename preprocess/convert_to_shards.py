@@ -0,0 +1,116 @@
+"""
+Convert the training data to memory-mapped shards (minidiffuser/train/datasets/shards.py),
+read with data_layout=shard by DPDataset and RealworldDataset.
+
+python preprocess/convert_to_shards.py --source lmdb --input_dir <voxel1cm> --output_dir <voxel1cm_shards>
+python preprocess/convert_to_shards.py --source h5 --input_dir <realworld_dataset> --output_dir <realworld_shards>
+"""
+import os
+import json
+from tqdm import tqdm
+import argparse
+
+import numpy as np
+import lmdb
+import msgpack
+import msgpack_numpy
+msgpack_numpy.patch()
+
+from minidiffuser.train.datasets.shards import ShardWriter, SHARD_META_FILE, get_h5_rgb_scale
+from minidiffuser.train.datasets.prefilter import load_prefilter_config, write_prefilter_config
+
+
+def add_lmdb_episodes(writer, lmdb_dir):
+    """Episodes of a taskvar LMDB written by gen_simple_policy_data.py (episode layout)."""
+    with lmdb.open(lmdb_dir, readonly=True, lock=False) as lmdb_env:
+        with lmdb_env.begin() as txn:
+            for key, value in txn.cursor():
+                value = msgpack.unpackb(value)
+                num_steps = len(value['xyz'])
+                arm_links_info = []
+                for info_key in ['bbox_info', 'pose_info']:
+                    info = value.get(info_key, None)
+                    if info is not None and not isinstance(info, dict):
+                        # real robot data keeps a single entry for the episode
+                        info = {k: [v] * num_steps for k, v in info[0].items()}
+                    arm_links_info.append(info)
+                writer.add_episode(
+                    bytes(key), value['xyz'], value['rgb'], value['action'],
+                    bbox_info=arm_links_info[0], pose_info=arm_links_info[1]
+                )
+
+
+def add_h5_episodes(writer, h5_path, rgb_scale=None):
+    """Episodes of a realworld h5 file, as read by RealworldDataset, with uint8 rgb."""
+    import h5py
+    with h5py.File(h5_path, 'r') as h5f:
+        episodes = h5f['episodes'] if 'episodes' in h5f else h5f
+        for ep_id in episodes.keys():
+            episode = episodes[ep_id]
+            steps = sorted(
+                [k for k in episode.keys() if k.startswith('step_')],
+                key=lambda x: int(x.split('_')[1])
+            )
+            xyz, rgb, actions = [], [], []
+            for step_id in steps:
+                step = episode[step_id]
+                xyz.append(step['xyz'][...])
+                t_rgb = step['rgb'][...]
+                t_rgb_scale = get_h5_rgb_scale(t_rgb, rgb_scale)
+                if t_rgb_scale != 255:
+                    t_rgb = np.clip(np.round(t_rgb * (255. / t_rgb_scale)), 0, 255)
+                rgb.append(t_rgb)
+                gripper_pose = step['gripper'][...]
+                # if it is not 7+1 dim, add gripper state
+                if gripper_pose.shape[-1] == 7:
+                    gripper_pose = np.concatenate([gripper_pose, np.array([1.0])])
+                actions.append(gripper_pose)
+            writer.add_episode(ep_id.encode(), xyz, rgb, np.stack(actions, 0))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', choices=['lmdb', 'h5'], default='lmdb')
+    parser.add_argument('--input_dir')
+    parser.add_argument('--output_dir')
+    parser.add_argument('--taskvar_file', default=None)
+    parser.add_argument('--h5_filename', default='1cm.h5')
+    parser.add_argument('--xyz_dtype', choices=['float16', 'float32'], default='float32')
+    parser.add_argument(
+        '--h5_rgb_scale', type=float, default=None,
+        help='full intensity of the h5 rgb, default: 255 for uint8 and 1 for floats'
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.taskvar_file is not None:
+        taskvars = json.load(open(args.taskvar_file))
+    else:
+        taskvars = os.listdir(args.input_dir)
+
+    for taskvar in tqdm(taskvars):
+        input_dir = os.path.join(args.input_dir, taskvar)
+        if args.source == 'h5':
+            input_dir = os.path.join(input_dir, args.h5_filename)
+        if not os.path.exists(input_dir):
+            print(taskvar, 'not exists')
+            continue
+        shard_dir = os.path.join(args.output_dir, taskvar)
+        if os.path.exists(os.path.join(shard_dir, SHARD_META_FILE)):
+            continue
+
+        writer = ShardWriter(shard_dir, xyz_dtype=args.xyz_dtype)
+        if args.source == 'h5':
+            add_h5_episodes(writer, input_dir, rgb_scale=args.h5_rgb_scale)
+        else:
+            add_lmdb_episodes(writer, input_dir)
+            # keep the filter options of data written by prefilter_policy_data.py
+            prefilter_config = load_prefilter_config(input_dir)
+            if prefilter_config is not None:
+                write_prefilter_config(shard_dir, prefilter_config)
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
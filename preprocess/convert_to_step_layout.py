@@ -0,0 +1,64 @@
+"""
+Convert taskvar LMDBs of the episode layout (written by gen_simple_policy_data.py) to the
+step layout, where every keystep is its own record.
+
+python preprocess/convert_to_step_layout.py --input_dir <voxel1cm> --output_dir <voxel1cm_steps>
+"""
+import os
+import json
+from tqdm import tqdm
+import argparse
+
+import lmdb
+import msgpack
+import msgpack_numpy
+msgpack_numpy.patch()
+
+from minidiffuser.train.datasets.step_index import (
+    split_episode, step_key, write_step_index
+)
+from minidiffuser.train.datasets.prefilter import load_prefilter_config, write_prefilter_config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir')
+    parser.add_argument('--output_dir')
+    parser.add_argument('--taskvar_file', default=None)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.taskvar_file is not None:
+        taskvars = json.load(open(args.taskvar_file))
+    else:
+        taskvars = os.listdir(args.input_dir)
+
+    for taskvar in tqdm(taskvars):
+        input_lmdb_dir = os.path.join(args.input_dir, taskvar)
+        if not os.path.exists(os.path.join(input_lmdb_dir, 'data.mdb')):
+            print(taskvar, 'not exists')
+            continue
+        output_lmdb_dir = os.path.join(args.output_dir, taskvar)
+        if os.path.exists(output_lmdb_dir):
+            continue
+
+        out_lmdb_env = lmdb.open(output_lmdb_dir, map_size=int(1024**4))
+        with lmdb.open(input_lmdb_dir, readonly=True, lock=False) as lmdb_env:
+            with lmdb_env.begin() as txn:
+                for key, value in txn.cursor():
+                    value = msgpack.unpackb(value)
+                    out_txn = out_lmdb_env.begin(write=True)
+                    for t, record in split_episode(value):
+                        out_txn.put(step_key(key, t), msgpack.packb(record))
+                    out_txn.commit()
+        out_lmdb_env.close()
+        write_step_index(output_lmdb_dir, layout='step')
+        # keep the filter options of data written by prefilter_policy_data.py
+        prefilter_config = load_prefilter_config(input_lmdb_dir)
+        if prefilter_config is not None:
+            write_prefilter_config(output_lmdb_dir, prefilter_config)
+
+
+if __name__ == '__main__':
+    main()
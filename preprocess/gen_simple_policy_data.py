@@ -13,6 +13,9 @@ import open3d as o3d
 
 from minidiffuser.configs.rlbench.constants import get_robot_workspace
 from minidiffuser.utils.point_cloud import voxelize_pcd
+from minidiffuser.train.datasets.step_index import (
+    DATA_LAYOUTS, split_episode, step_key, write_step_index
+)
 
 
 def main():
@@ -25,6 +28,10 @@ def main():
     parser.add_argument('--voxel_size', type=float, default=0.01, help='meters')
     parser.add_argument('--real_robot', default=False, action='store_true')
     parser.add_argument('--num_cameras', default=None, type=int, help='use all by default')
+    parser.add_argument(
+        '--layout', default='episode', choices=DATA_LAYOUTS,
+        help='one record per episode, or per keystep (see minidiffuser/train/datasets/step_index.py)'
+    )
     args = parser.parse_args()
     
     os.makedirs(args.output_dir, exist_ok=True)
@@ -107,10 +114,16 @@ def main():
                         del outs['sem']
 
                     out_txn = out_lmdb_env.begin(write=True)
-                    out_txn.put(key, msgpack.packb(outs))
+                    if args.layout == 'step':
+                        for t, record in split_episode(outs):
+                            out_txn.put(step_key(key, t), msgpack.packb(record))
+                    else:
+                        out_txn.put(key, msgpack.packb(outs))
                     out_txn.commit()
                         
         out_lmdb_env.close()
+        # index of the episode step counts, loaded by DPDataset
+        write_step_index(os.path.join(args.output_dir, taskvar), layout=args.layout)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,133 @@
+"""
+Apply the deterministic point filters of DPDataset (table, robot arm boxes, outliers) once
+to the taskvar LMDBs written by gen_simple_policy_data.py, with the dataset options of a
+training config. The filter options are recorded in prefilter.json of every taskvar, and
+DPDataset skips its online filters on this data (or refuses it if its options differ).
+
+python preprocess/prefilter_policy_data.py --config minidiffuser/train/diffusion_ptv3.yaml \
+    --input_dir <voxel1cm> --output_dir <voxel1cm_prefiltered> --num_workers 16
+"""
+import os
+import json
+from tqdm import tqdm
+import argparse
+import multiprocessing as mp
+
+import lmdb
+import msgpack
+import msgpack_numpy
+msgpack_numpy.patch()
+
+from omegaconf import OmegaConf
+
+from minidiffuser.configs.rlbench.constants import get_robot_workspace
+from minidiffuser.train.datasets.step_index import DATA_LAYOUTS, write_step_index
+from minidiffuser.train.datasets.prefilter import (
+    PREFILTER_META_FILE, get_filter_config, get_arm_links_info, filter_point_idxs,
+    write_prefilter_config
+)
+
+
+# per-point arrays of a record
+POINT_KEYS = ['xyz', 'rgb', 'sem']
+
+# set in every worker by init_worker
+worker_state = {}
+
+
+def init_worker(lmdb_dir, filter_config):
+    worker_state['lmdb_env'] = lmdb.open(lmdb_dir, readonly=True, lock=False, readahead=False)
+    worker_state['filter_config'] = filter_config
+
+
+def filter_episode(args):
+    """Read and filter the record of an LMDB key, returns the key and the packed record"""
+    key, layout = args
+    filter_config = worker_state['filter_config']
+    with worker_state['lmdb_env'].begin() as txn:
+        value = msgpack.unpackb(txn.get(key))
+
+    if layout == 'step':
+        arm_links_info = (value.get('bbox_info', None), value.get('pose_info', None))
+        idxs = filter_point_idxs(value['xyz'], arm_links_info, filter_config)
+        for point_key in POINT_KEYS:
+            if point_key in value:
+                value[point_key] = value[point_key][idxs]
+        return key, msgpack.packb(value)
+
+    for point_key in POINT_KEYS:
+        if point_key in value:
+            value[point_key] = list(value[point_key])
+    for t in range(len(value['xyz'])):
+        if 'bbox_info' in value:
+            arm_links_info = get_arm_links_info(value, t, real_robot=filter_config['real_robot'])
+        else:
+            arm_links_info = None
+        idxs = filter_point_idxs(value['xyz'][t], arm_links_info, filter_config)
+        for point_key in POINT_KEYS:
+            if point_key in value:
+                value[point_key][t] = value[point_key][t][idxs]
+    return key, msgpack.packb(value)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='minidiffuser/train/diffusion_ptv3.yaml')
+    parser.add_argument('--input_dir')
+    parser.add_argument('--output_dir')
+    parser.add_argument('--taskvar_file', default=None)
+    parser.add_argument(
+        '--layout', default='episode', choices=DATA_LAYOUTS,
+        help='layout of the input LMDBs, kept in the output'
+    )
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # the same filter options as the TRAIN_DATASET of the config
+    data_config = OmegaConf.load(args.config).TRAIN_DATASET
+    real_robot = data_config.get('real_robot', False)
+    filter_config = get_filter_config(
+        data_config.rm_table, get_robot_workspace(real_robot=real_robot)['TABLE_HEIGHT'],
+        data_config.rm_robot, data_config.rm_pc_outliers,
+        data_config.rm_pc_outliers_neighbors, real_robot
+    )
+    print('filter config:', filter_config)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.taskvar_file is not None:
+        taskvars = json.load(open(args.taskvar_file))
+    else:
+        taskvars = os.listdir(args.input_dir)
+
+    for taskvar in tqdm(taskvars):
+        input_lmdb_dir = os.path.join(args.input_dir, taskvar)
+        if not os.path.exists(os.path.join(input_lmdb_dir, 'data.mdb')):
+            print(taskvar, 'not exists')
+            continue
+        output_lmdb_dir = os.path.join(args.output_dir, taskvar)
+        if os.path.exists(os.path.join(output_lmdb_dir, PREFILTER_META_FILE)):
+            continue
+
+        with lmdb.open(input_lmdb_dir, readonly=True, lock=False) as lmdb_env:
+            with lmdb_env.begin() as txn:
+                keys = list(txn.cursor().iternext(values=False))
+
+        # the records are read and filtered by the workers, written by this process
+        out_lmdb_env = lmdb.open(output_lmdb_dir, map_size=int(1024**4))
+        with mp.Pool(
+            args.num_workers, initializer=init_worker, initargs=(input_lmdb_dir, filter_config)
+        ) as pool:
+            for key, value in pool.imap(filter_episode, [(key, args.layout) for key in keys]):
+                out_txn = out_lmdb_env.begin(write=True)
+                out_txn.put(key, value)
+                out_txn.commit()
+        out_lmdb_env.close()
+
+        write_step_index(output_lmdb_dir, layout=args.layout)
+        # written last: a taskvar without prefilter.json is incomplete
+        write_prefilter_config(output_lmdb_dir, filter_config)
+
+
+if __name__ == '__main__':
+    main()
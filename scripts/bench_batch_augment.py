@@ -0,0 +1,146 @@
+"""
+Per-sample point cloud augmentation (DPDataset._augment_pc, numpy + scipy) vs. the batched
+augmentation of collated batches (minidiffuser/train/datasets/batch_augment.py), on random
+point clouds. Also checks that both give the same rotated points and actions without noise.
+
+python scripts/bench_batch_augment.py --batch_size 100 --num_points 4000 --device cuda
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from scipy.spatial.transform import Rotation as R
+
+from minidiffuser.train.datasets.common import random_rotate_z
+from minidiffuser.train.datasets.batch_augment import BatchPointCloudAugmenter
+from minidiffuser.utils.rotation_transform import quaternion_to_discrete_euler
+
+
+def make_samples(batch_size, num_points, rot_type, euler_resolution):
+    samples = []
+    for _ in range(batch_size):
+        xyz = np.random.uniform(-0.5, 0.5, size=(num_points, 3)) + [0.3, 0, 1]
+        ee_pose = np.concatenate([np.random.uniform(-0.5, 0.5, 3), R.random().as_quat(), [1]])
+        gt_action = np.concatenate([np.random.uniform(-0.5, 0.5, 3), R.random().as_quat(), [0]])
+        gt_rot = gt_action[3:-1] if rot_type == 'quat' else \
+            quaternion_to_discrete_euler(gt_action[3:-1], euler_resolution)
+        samples.append((xyz, ee_pose, gt_action, gt_rot))
+    return samples
+
+
+def augment_sample(xyz, ee_pose, gt_action, angle, rot_type, euler_resolution, noise=0.002):
+    """DPDataset._augment_pc, then the normalization by the center"""
+    xyz = random_rotate_z(xyz, angle=angle)
+    ee_pose, gt_action = ee_pose.copy(), gt_action.copy()
+    ee_pose[:3] = random_rotate_z(ee_pose[:3], angle=angle)
+    gt_action[:3] = random_rotate_z(gt_action[:3], angle=angle)
+    rot = R.from_euler('z', angle, degrees=False)
+    ee_pose[3:-1] = (rot * R.from_quat(ee_pose[3:-1])).as_quat()
+    gt_action[3:-1] = (rot * R.from_quat(gt_action[3:-1])).as_quat()
+    if rot_type == 'quat':
+        gt_rot = gt_action[3:-1]
+    else:
+        gt_rot = quaternion_to_discrete_euler(gt_action[3:-1], euler_resolution)
+    pc_noises = np.random.uniform(0, noise, size=xyz.shape)
+    xyz = xyz + pc_noises
+    centroid = np.mean(xyz, 0)
+    ee_pose[:3] -= centroid
+    gt_action[:3] -= centroid
+    return xyz - centroid, ee_pose, gt_action, gt_rot
+
+
+def collate(samples):
+    """Normalized (xyz_shift=center, no xyz_norm) samples as ptv3_collate_fn batches them"""
+    pc_fts, ee_poses, gt_actions, gt_action_quats, centroids = [], [], [], [], []
+    for xyz, ee_pose, gt_action, gt_rot in samples:
+        centroid = np.mean(xyz, 0)
+        pc_fts.append(torch.from_numpy(np.concatenate([xyz - centroid, np.zeros_like(xyz)], 1)))
+        ee_poses.append(torch.from_numpy(np.concatenate([ee_pose[:3] - centroid, ee_pose[3:]])))
+        gt_actions.append(torch.from_numpy(np.concatenate(
+            [gt_action[:3] - centroid, np.asarray(gt_rot, dtype=np.float64), gt_action[-1:]]
+        )))
+        gt_action_quats.append(torch.from_numpy(gt_action[3:-1]))
+        centroids.append(centroid)
+    return {
+        'pc_fts': torch.cat(pc_fts, 0).float(),
+        'npoints_in_batch': [len(x[0]) for x in samples],
+        'ee_poses': torch.stack(ee_poses, 0).float(),
+        'gt_actions': torch.stack(gt_actions, 0).float(),
+        'gt_action_quats': torch.stack(gt_action_quats, 0).float(),
+        'pc_centroids': np.stack(centroids, 0),
+        'pc_radius': [1.] * len(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--num_points', type=int, default=4000)
+    parser.add_argument('--rot_type', choices=['quat', 'euler_disc'], default='euler_disc')
+    parser.add_argument('--euler_resolution', type=int, default=5)
+    parser.add_argument('--num_iters', type=int, default=20)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    samples = make_samples(args.batch_size, args.num_points, args.rot_type, args.euler_resolution)
+    max_rot = np.deg2rad(45)
+
+    st = time.time()
+    for _ in range(args.num_iters):
+        for xyz, ee_pose, gt_action, _ in samples:
+            augment_sample(
+                xyz, ee_pose, gt_action, np.random.uniform(-1, 1) * max_rot,
+                args.rot_type, args.euler_resolution
+            )
+    per_sample_time = (time.time() - st) / args.num_iters
+
+    for device in sorted(set(['cpu', args.device])):
+        augmenter = BatchPointCloudAugmenter(
+            args.rot_type, euler_resolution=args.euler_resolution, device=device
+        )
+        batches = [collate(samples) for _ in range(args.num_iters + 1)]
+        augmenter(batches[0])   # warmup
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        st = time.time()
+        for batch in batches[1:]:
+            augmenter(batch)
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        batch_time = (time.time() - st) / args.num_iters
+        print('per sample: %.2fms/batch, batched on %s: %.2fms/batch' % (
+            per_sample_time * 1000, device, batch_time * 1000
+        ))
+
+    # the same rotation without noise
+    augmenter = BatchPointCloudAugmenter(
+        args.rot_type, euler_resolution=args.euler_resolution, noise=0
+    )
+    torch.manual_seed(0)
+    batch = augmenter(collate(samples))
+    torch.manual_seed(0)
+    angles = ((torch.rand(len(samples), dtype=torch.float64) * 2 - 1) * max_rot).numpy()
+    offsets = np.cumsum([0] + batch['npoints_in_batch'])
+    max_diffs = {'xyz': 0, 'ee_pose': 0, 'gt_pos': 0, 'gt_rot': 0}
+    for i, (xyz, ee_pose, gt_action, _) in enumerate(samples):
+        ref_xyz, ref_ee_pose, ref_gt_action, ref_gt_rot = augment_sample(
+            xyz, ee_pose, gt_action, angles[i], args.rot_type, args.euler_resolution, noise=0
+        )
+        ref_gt_rot = np.asarray(ref_gt_rot, dtype=np.float64)
+        gt_rot = batch['gt_actions'][i, 3:-1].numpy()
+        diffs = {
+            'xyz': batch['pc_fts'][offsets[i]:offsets[i + 1], :3].numpy() - ref_xyz,
+            'ee_pose': batch['ee_poses'][i, :3].numpy() - ref_ee_pose[:3],
+            'gt_pos': batch['gt_actions'][i, :3].numpy() - ref_gt_action[:3],
+            # q and -q are the same rotation
+            'gt_rot': np.minimum(np.abs(gt_rot - ref_gt_rot), np.abs(gt_rot + ref_gt_rot))
+                if args.rot_type == 'quat' else gt_rot - ref_gt_rot,
+        }
+        for k, v in diffs.items():
+            max_diffs[k] = max(max_diffs[k], np.abs(v).max())
+    print('max abs diff to the per-sample augmentation:', max_diffs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Loader throughput of DPDataset on the episode layout vs. the step layout and the
+memory-mapped shards of the same data (see preprocess/convert_to_step_layout.py and
+preprocess/convert_to_shards.py), with the TRAIN_DATASET options of a config.
+
+python scripts/bench_dataset_layout.py --config minidiffuser/train/diffusion_ptv3.yaml \
+    --episode_dir <voxel1cm> --step_dir <voxel1cm_steps> --shard_dir <voxel1cm_shards> --num_workers 0 4
+"""
+import argparse
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from minidiffuser.train.utils.misc import set_random_seed
+from minidiffuser.train.datasets.diffusion_policy_dataset import DPDataset, ptv3_collate_fn
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='minidiffuser/train/diffusion_ptv3.yaml')
+    parser.add_argument('--episode_dir', required=True)
+    parser.add_argument('--step_dir', default=None)
+    parser.add_argument('--shard_dir', default=None)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--seed', type=int, default=2024)
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    dataset_config = OmegaConf.to_container(config.TRAIN_DATASET, resolve=True)
+
+    for layout, data_dir in [
+        ('episode', args.episode_dir), ('step', args.step_dir), ('shard', args.shard_dir)
+    ]:
+        if data_dir is None:
+            continue
+        dataset_config.update(data_dir=data_dir, data_layout=layout)
+        st = time.time()
+        dataset = DPDataset(
+            **dataset_config, taskvars_filter=config.TRAIN.taskvars_filter,
+            project_root=config.TRAIN.project_root
+        )
+        init_time = time.time() - st
+
+        for num_workers in args.num_workers:
+            set_random_seed(args.seed)
+            dataloader = torch.utils.data.DataLoader(
+                dataset, batch_size=args.batch_size, shuffle=True,
+                num_workers=num_workers, collate_fn=ptv3_collate_fn
+            )
+            data_iter = iter(dataloader)
+            next(data_iter)     # warmup, includes the worker startup
+            st = time.time()
+            num_samples = 0
+            for _ in range(args.num_batches):
+                num_samples += len(next(data_iter)['step_ids'])
+            duration = time.time() - st
+            print('%-8s #data %7d init %6.2fs workers %2d: %8.1f samples/s' % (
+                layout, len(dataset), init_time, num_workers, num_samples / duration
+            ))
+
+
+if __name__ == '__main__':
+    main()
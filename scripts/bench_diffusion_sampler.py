@@ -0,0 +1,111 @@
+"""
+Compare position accuracy and latency of the inference samplers of DiffPolicyPTV3
+on the same validation batches.
+
+python scripts/bench_diffusion_sampler.py \
+    --exp_config data/experiments/minidi/logs/training_config.yaml \
+    --checkpoint data/experiments/minidi/ckpts/model_step_100000.pt \
+    --samplers ddpm:100 ddim:20 ddim:10 dpmsolver:10 dpmsolver:5
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from minidiffuser.train.utils.misc import set_random_seed
+from minidiffuser.train.train_diffusion_policy import MODEL_FACTORY, DATASET_FACTORY
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def to_world(pos, batch):
+    """Positions normalized by the dataset back to meters, as in eval_simple_policy.py"""
+    radius = torch.as_tensor(np.asarray(batch['pc_radius']), dtype=pos.dtype).view(-1, 1)
+    centroids = torch.as_tensor(np.asarray(batch['pc_centroids']), dtype=pos.dtype)
+    return pos * radius + centroids
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--exp_config', required=True)
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--batch_size', type=int, default=1, help='1 matches closed-loop inference')
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--num_warmup', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument(
+        '--samplers', nargs='+', default=['ddpm:100', 'ddim:20', 'ddim:10', 'dpmsolver:10', 'dpmsolver:5'],
+        help='sampler:num_inference_steps, the first one is the reference'
+    )
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    config = OmegaConf.load(args.exp_config)
+
+    model = MODEL_FACTORY[config.MODEL.model_class](config.MODEL)
+    checkpoint = torch.load(args.checkpoint, map_location=lambda storage, loc: storage)
+    model.load_state_dict(checkpoint, strict=True)
+    model.to(device)
+    model.eval()
+
+    set_random_seed(args.seed)
+    dataset_class, collate_fn = DATASET_FACTORY[config.MODEL.model_class]
+    dataset = dataset_class(
+        **config.VAL_DATASET, taskvars_filter=config.TRAIN.taskvars_filter,
+        project_root=config.TRAIN.project_root
+    )
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=True, num_workers=0, collate_fn=collate_fn
+    )
+    # the same batches are fed to every sampler
+    batches, data_iter = [], iter(dataloader)
+    for _ in range(args.num_warmup + args.num_batches):
+        batches.append(next(data_iter))
+
+    results = []
+    for spec in args.samplers:
+        sampler, num_steps = spec.split(':')
+        num_steps = int(num_steps)
+
+        set_random_seed(args.seed)
+        pos_errs, latencies = [], []
+        for i, batch in enumerate(batches):
+            gt_pos = to_world(batch['gt_actions'][:, :3].clone(), batch)
+            synchronize(device)
+            st = time.time()
+            pred_actions = model.forward_n_steps(
+                dict(batch), sampler=sampler, num_inference_steps=num_steps
+            )
+            synchronize(device)
+            if i < args.num_warmup:
+                continue
+            latencies.append(time.time() - st)
+            # in meters, the normalized positions are scaled by the radius of each sample
+            pos_errs.append((to_world(pred_actions[:, :3].float().cpu(), batch) - gt_pos).norm(dim=-1))
+
+        pos_errs = torch.cat(pos_errs).numpy()
+        results.append({
+            'sampler': spec,
+            'pos_l2_err': np.mean(pos_errs),
+            'pos_acc_0.01': np.mean(pos_errs < 0.01),
+            'latency_ms': np.mean(latencies) * 1000,
+            'latency_std_ms': np.std(latencies) * 1000,
+        })
+
+    ref_latency = results[0]['latency_ms']
+    print('%-16s %12s %12s %14s %10s' % ('sampler', 'pos_l2_err', 'pos_acc@1cm', 'latency(ms)', 'speedup'))
+    for res in results:
+        print('%-16s %12.4f %12.4f %8.1f+-%-5.1f %9.2fx' % (
+            res['sampler'], res['pos_l2_err'], res['pos_acc_0.01'],
+            res['latency_ms'], res['latency_std_ms'], ref_latency / res['latency_ms']
+        ))
+
+
+if __name__ == '__main__':
+    main()
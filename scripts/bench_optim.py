@@ -0,0 +1,104 @@
+"""
+Per-parameter optimizers (AdamW, Lamb in minidiffuser/train/optim) vs. their multi-tensor
+variants (ForeachAdamW, ForeachLamb), on a stack of small linear and LayerNorm layers with
+the parameter groups of build_optimizer. Checks that both give the same parameters and
+optimizer states after a few steps with the same gradients, then times optimizer.step().
+
+python scripts/bench_optim.py --num_layers 48 --hidden_size 256 --device cuda
+"""
+import argparse
+import copy
+import time
+
+import torch
+from torch import nn
+from easydict import EasyDict
+
+from minidiffuser.train.optim.misc import build_optimizer
+
+
+class Block(nn.Module):
+    def __init__(self, hidden_size):
+        super().__init__()
+        self.linear = nn.Linear(hidden_size, hidden_size)
+        self.LayerNorm = nn.LayerNorm(hidden_size)
+
+
+def make_model(num_layers, hidden_size, device):
+    return nn.Sequential(*[Block(hidden_size) for _ in range(num_layers)]).to(device)
+
+
+def set_grads(models, step):
+    generator = torch.Generator().manual_seed(step)
+    for params in zip(*[model.parameters() for model in models]):
+        grad = torch.randn(params[0].shape, generator=generator)
+        for p in params:
+            # Lamb clips the gradients in place
+            p.grad = grad.to(p.device, copy=True)
+
+
+def max_diffs(model, ref_model, optimizer, ref_optimizer):
+    diffs = {'params': 0, 'exp_avg': 0, 'exp_avg_sq': 0}
+    for p, ref_p in zip(model.parameters(), ref_model.parameters()):
+        diffs['params'] = max(diffs['params'], (p - ref_p).abs().max().item())
+        for k in ['exp_avg', 'exp_avg_sq']:
+            diff = optimizer.state[p][k] - ref_optimizer.state[ref_p][k]
+            diffs[k] = max(diffs[k], diff.abs().max().item())
+    return diffs
+
+
+def time_steps(model, optimizer, num_iters, device):
+    set_grads([model], 0)
+    optimizer.step()    # warmup and state initialization
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    st = time.time()
+    for _ in range(num_iters):
+        optimizer.step()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.time() - st) / num_iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_layers', type=int, default=48)
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--weight_decay', type=float, default=0.05)
+    parser.add_argument('--num_check_steps', type=int, default=10)
+    parser.add_argument('--num_iters', type=int, default=100)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    for optim in ['adamw', 'lamb']:
+        opts = EasyDict(
+            optim=optim, learning_rate=1e-3, betas=[0.9, 0.98], weight_decay=args.weight_decay
+        )
+        model = make_model(args.num_layers, args.hidden_size, args.device)
+        foreach_model = copy.deepcopy(model)
+        optimizer, _ = build_optimizer(model, opts)
+        foreach_optimizer, _ = build_optimizer(
+            foreach_model, EasyDict(opts, optim=f'{optim}_foreach')
+        )
+        num_params = sum(len(group['params']) for group in optimizer.param_groups)
+
+        for step in range(args.num_check_steps):
+            set_grads([model, foreach_model], step)
+            optimizer.step()
+            foreach_optimizer.step()
+        print('%s: max abs diff after %d steps: %s' % (
+            optim, args.num_check_steps,
+            max_diffs(foreach_model, model, foreach_optimizer, optimizer)
+        ))
+
+        step_time = time_steps(model, optimizer, args.num_iters, args.device)
+        foreach_step_time = time_steps(
+            foreach_model, foreach_optimizer, args.num_iters, args.device
+        )
+        print('%s (%d tensors on %s): per parameter %.2fms/step, foreach %.2fms/step' % (
+            optim, num_params, args.device, step_time * 1000, foreach_step_time * 1000
+        ))
+
+
+if __name__ == '__main__':
+    main()
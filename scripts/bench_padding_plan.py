@@ -0,0 +1,93 @@
+"""
+Per-sample loop vs. vectorized construction of the serialized attention padding plan
+(SerializedAttention.get_padding_and_inverse) at the training batch sizes.
+
+python scripts/bench_padding_plan.py --device cuda --batch_sizes 1 16 64 100 128 256
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from minidiffuser.models.PointTransformerV3.model_with_neck import (
+    get_padding_plan, offset2bincount
+)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def loop_padding_plan(offset, patch_size):
+    # the previous implementation, for reference
+    bincount = offset2bincount(offset)
+    bincount_pad = (
+        torch.div(bincount + patch_size - 1, patch_size, rounding_mode="trunc") * patch_size
+    )
+    mask_pad = bincount > patch_size
+    bincount_pad = ~mask_pad * bincount + mask_pad * bincount_pad
+    _offset = nn.functional.pad(offset, (1, 0))
+    _offset_pad = nn.functional.pad(torch.cumsum(bincount_pad, dim=0), (1, 0))
+    pad = torch.arange(_offset_pad[-1], device=offset.device)
+    unpad = torch.arange(_offset[-1], device=offset.device)
+    cu_seqlens = []
+    for i in range(len(offset)):
+        unpad[_offset[i] : _offset[i + 1]] += _offset_pad[i] - _offset[i]
+        if bincount[i] != bincount_pad[i]:
+            pad[
+                _offset_pad[i + 1] - patch_size + (bincount[i] % patch_size) : _offset_pad[i + 1]
+            ] = pad[
+                _offset_pad[i + 1] - 2 * patch_size + (bincount[i] % patch_size) : _offset_pad[i + 1] - patch_size
+            ]
+        pad[_offset_pad[i] : _offset_pad[i + 1]] -= _offset_pad[i] - _offset[i]
+        cu_seqlens.append(
+            torch.arange(
+                _offset_pad[i], _offset_pad[i + 1], step=patch_size,
+                dtype=torch.int32, device=offset.device,
+            )
+        )
+    cu_seqlens = nn.functional.pad(torch.concat(cu_seqlens), (0, 1), value=_offset_pad[-1])
+    return pad, unpad, cu_seqlens
+
+
+def timeit(fn, inputs, device, num_repeats):
+    fn(*inputs)
+    times = []
+    for _ in range(num_repeats):
+        synchronize(device)
+        st = time.time()
+        fn(*inputs)
+        synchronize(device)
+        times.append(time.time() - st)
+    return min(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 64, 100, 128, 256])
+    parser.add_argument('--npoints', type=int, default=4096, help='max points per sample')
+    parser.add_argument('--patch_size', type=int, default=120)
+    parser.add_argument('--num_repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    print('%6s %12s %15s %9s' % ('batch', 'loop(ms)', 'vectorized(ms)', 'speedup'))
+    for batch_size in args.batch_sizes:
+        npoints = torch.randint(args.npoints // 4, args.npoints + 1, (batch_size, ))
+        offset = torch.cumsum(npoints, 0).to(device)
+
+        for ref, out in zip(loop_padding_plan(offset, args.patch_size), get_padding_plan(offset, args.patch_size)):
+            assert torch.equal(ref.long(), out.long()), 'padding plans are different'
+
+        ref_time = timeit(loop_padding_plan, (offset, args.patch_size), device, args.num_repeats)
+        vec_time = timeit(get_padding_plan, (offset, args.patch_size), device, args.num_repeats)
+        print('%6d %12.3f %15.3f %8.2fx' % (batch_size, ref_time, vec_time, ref_time / vec_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Robot link box removal: one open3d OrientedBoundingBox query per link (previous
+RobotBox.get_pc_overlap_ratio) vs. the batched point-in-box test of RobotBox.get_pc_mask,
+on random clouds and link poses.
+
+python scripts/bench_robot_box.py --num_points 20000 --num_repeats 20
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+import open3d as o3d
+from scipy.spatial.transform import Rotation as R
+
+from minidiffuser.utils.robot_box import RobotBox
+
+
+def random_arm_links_info(rng):
+    links = [
+        "Panda_link0_visual", "Panda_link1_respondable", "Panda_link2_respondable",
+        "Panda_link3_respondable", "Panda_link4_respondable", "Panda_link5_respondable",
+        "Panda_link6_respondable", "Panda_link7_respondable", "Panda_rightfinger_visual",
+        "Panda_leftfinger_visual", "Panda_gripper_visual",
+    ]
+    bbox_info, pose_info = {}, {}
+    for link in links:
+        half = rng.uniform(0.02, 0.15, size=3)
+        bbox_info[f'{link}_bbox'] = np.stack([-half, half], 1).reshape(-1)
+        pose_info[f'{link}_pose'] = np.concatenate(
+            [rng.uniform(-0.3, 0.3, size=3), R.random(random_state=rng).as_quat()]
+        )
+    return bbox_info, pose_info
+
+
+def o3d_mask(robot_box, xyz):
+    points = o3d.utility.Vector3dVector(xyz)
+    overlap_point_ids = set()
+    for center, rot, half_extent in zip(
+        robot_box.centers, robot_box.rotations, robot_box.half_extents
+    ):
+        obbox = o3d.geometry.OrientedBoundingBox(center, rot, half_extent * 2)
+        overlap_point_ids = overlap_point_ids.union(
+            set(obbox.get_point_indices_within_bounding_box(points))
+        )
+    mask = np.zeros((len(xyz), ), dtype=bool)
+    mask[list(overlap_point_ids)] = True
+    return mask
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_points', type=int, default=20000)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    robot_boxes = [
+        RobotBox(random_arm_links_info(rng), keep_gripper=False) for _ in range(args.batch_size)
+    ]
+    xyz = rng.uniform(-0.5, 0.5, size=(args.batch_size, args.num_points, 3))
+
+    num_diffs = sum(
+        (o3d_mask(box, x) != box.get_pc_mask(x)).sum() for box, x in zip(robot_boxes, xyz)
+    )
+    batch_mask = RobotBox.get_batch_pc_mask(torch.from_numpy(xyz), robot_boxes).numpy()
+    num_diffs += sum((batch_mask[i] != robot_boxes[i].get_pc_mask(xyz[i])).sum() for i in range(len(xyz)))
+    print('#points with a different mask:', num_diffs)
+
+    runs = [
+        ('open3d per link', lambda: [o3d_mask(box, x) for box, x in zip(robot_boxes, xyz)]),
+        ('numpy per cloud', lambda: [box.get_pc_mask(x) for box, x in zip(robot_boxes, xyz)]),
+        ('numpy batched', lambda: RobotBox.get_batch_pc_mask(xyz, robot_boxes)),
+    ]
+    for name, fn in runs:
+        fn()    # warmup
+        st = time.time()
+        for _ in range(args.num_repeats):
+            fn()
+        latency = (time.time() - st) / args.num_repeats / args.batch_size * 1000
+        print('%-16s %8.3f ms/cloud' % (name, latency))
+
+
+if __name__ == '__main__':
+    main()
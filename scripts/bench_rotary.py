@@ -0,0 +1,77 @@
+"""
+Query rotary embedding of the neck (QuerySupportAttention) over one denoising step:
+the tables recomputed at every neck level + embed_rotary vs. the table cached on the
+anchor Point + the fused complex apply_rotary.
+
+python scripts/bench_rotary.py --device cuda --batch_size 1 --num_anchors 100 --num_levels 4
+"""
+import argparse
+import time
+
+import torch
+
+from minidiffuser.models.PointTransformerV3.model_with_neck import (
+    RotaryPositionEncoding3D, embed_rotary, apply_rotary
+)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_anchors', type=int, default=100, help='per sample')
+    parser.add_argument('--num_levels', type=int, default=4, help='neck levels per step')
+    parser.add_argument('--num_heads', type=int, default=8)
+    parser.add_argument('--head_dim', type=int, default=48)
+    parser.add_argument('--num_steps', type=int, default=100, help='denoising steps per observation')
+    parser.add_argument('--num_repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    roper = RotaryPositionEncoding3D(args.head_dim).to(device)
+    num_anchors = args.batch_size * args.num_anchors
+    coords = torch.rand(args.num_steps, num_anchors, 3, device=device)
+    q = torch.randn(num_anchors, args.num_heads, args.head_dim, device=device)
+
+    cos, sin = roper(coords[0])
+    ref = embed_rotary(q, cos, sin)
+    out = apply_rotary(q, roper.rotation(coords[0]))
+    print('max diff: %.2e' % (ref - out).abs().max().item())
+
+    def run_baseline():
+        for step in range(args.num_steps):
+            for _ in range(args.num_levels):
+                cos, sin = roper(coords[step])
+                embed_rotary(q, cos, sin)
+
+    def run_cached():
+        for step in range(args.num_steps):
+            rotation = roper.rotation(coords[step])
+            for _ in range(args.num_levels):
+                apply_rotary(q, rotation)
+
+    latencies = {}
+    for name, fn in [('recompute+embed_rotary', run_baseline), ('cached+apply_rotary', run_cached)]:
+        fn()    # warmup
+        times = []
+        for _ in range(args.num_repeats):
+            synchronize(device)
+            st = time.time()
+            fn()
+            synchronize(device)
+            times.append(time.time() - st)
+        latencies[name] = min(times) / args.num_steps * 1000
+    ref_latency = latencies['recompute+embed_rotary']
+    for name, latency in latencies.items():
+        print('%-24s %8.3f ms/step %8.2fx' % (name, latency, ref_latency / latency))
+
+
+if __name__ == '__main__':
+    main()
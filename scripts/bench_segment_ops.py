@@ -0,0 +1,115 @@
+"""
+Per-sample python loops vs. segment ops (torch_scatter) for the text attention pooling,
+the point max-pooling of the rotation head and the context concat of DiffPolicyPTV3,
+forward + backward at the training batch sizes.
+
+python scripts/bench_segment_ops.py --device cuda --batch_sizes 1 16 64 100 128 256
+"""
+import argparse
+import time
+
+import torch
+
+from minidiffuser.models.batch_diffuse_ptv3 import (
+    segment_attention_pool, segment_max, concat_by_segment
+)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+# the previous implementations, for reference
+def loop_attention_pool(embeds, logits, lens):
+    txt_weights = torch.split(logits, lens)
+    txt_embeds = torch.split(embeds, lens)
+    ctx_embeds = []
+    for txt_weight, txt_embed in zip(txt_weights, txt_embeds):
+        txt_weight = torch.softmax(txt_weight, 0)
+        ctx_embeds.append(torch.sum(txt_weight * txt_embed, 0))
+    return torch.stack(ctx_embeds, 0)
+
+
+def loop_max(feats, lens):
+    return torch.stack([torch.max(x, 0)[0] for x in torch.split(feats, lens)], 0)
+
+
+def loop_concat(txt_embeds, pose_embeds, step_embeds, lens):
+    ctx_embeds = torch.split(txt_embeds, lens)
+    ctx_embeds = [torch.cat([c, e.unsqueeze(0)], dim=0) for c, e in zip(ctx_embeds, pose_embeds)]
+    ctx_embeds = [torch.cat([c, e.unsqueeze(0)], dim=0) for c, e in zip(ctx_embeds, step_embeds)]
+    return torch.cat(ctx_embeds, 0)
+
+
+def segment_concat(txt_embeds, pose_embeds, step_embeds, lens):
+    lens = torch.as_tensor(lens, device=txt_embeds.device)
+    sample_ids = torch.arange(lens.size(0), device=txt_embeds.device)
+    txt_ids = torch.repeat_interleave(sample_ids, lens, output_size=txt_embeds.size(0))
+    return concat_by_segment([txt_embeds, pose_embeds, step_embeds], [txt_ids, sample_ids, sample_ids])
+
+
+def timeit(fn, inputs, device, num_repeats):
+    def run():
+        out = fn(*inputs)
+        out.sum().backward()
+    run()
+    times = []
+    for _ in range(num_repeats):
+        synchronize(device)
+        st = time.time()
+        run()
+        synchronize(device)
+        times.append(time.time() - st)
+    return min(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 64, 100, 128, 256])
+    parser.add_argument('--max_txt_len', type=int, default=77)
+    parser.add_argument('--npoints', type=int, default=4096, help='points per sample')
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--num_repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    print('%-16s %6s %12s %12s %9s %10s' % ('op', 'batch', 'loop(ms)', 'segment(ms)', 'speedup', 'max_diff'))
+    for batch_size in args.batch_sizes:
+        txt_lens = torch.randint(1, args.max_txt_len + 1, (batch_size, )).tolist()
+        npoints = torch.randint(args.npoints // 2, args.npoints + 1, (batch_size, )).tolist()
+        txt_embeds = torch.randn(sum(txt_lens), args.dim, device=device, requires_grad=True)
+        txt_logits = torch.randn(sum(txt_lens), 1, device=device, requires_grad=True)
+        point_embeds = torch.randn(sum(npoints), args.dim, device=device, requires_grad=True)
+        pose_embeds = torch.randn(batch_size, args.dim, device=device, requires_grad=True)
+        step_embeds = torch.randn(batch_size, args.dim, device=device, requires_grad=True)
+
+        benchmarks = [
+            (
+                'txt_attn_pool', loop_attention_pool, (txt_embeds, txt_logits, txt_lens),
+                segment_attention_pool, (txt_embeds, txt_logits, torch.as_tensor(txt_lens, device=device))
+            ),
+            (
+                'point_max_pool', loop_max, (point_embeds, npoints),
+                segment_max, (point_embeds, torch.as_tensor(npoints, device=device))
+            ),
+            (
+                'context_concat', loop_concat, (txt_embeds, pose_embeds, step_embeds, txt_lens),
+                segment_concat, (txt_embeds, pose_embeds, step_embeds, txt_lens)
+            ),
+        ]
+        for name, ref_fn, ref_inputs, seg_fn, seg_inputs in benchmarks:
+            with torch.no_grad():
+                max_diff = (ref_fn(*ref_inputs) - seg_fn(*seg_inputs)).abs().max().item()
+            ref_time = timeit(ref_fn, ref_inputs, device, args.num_repeats)
+            seg_time = timeit(seg_fn, seg_inputs, device, args.num_repeats)
+            print('%-16s %6d %12.3f %12.3f %8.2fx %10.2e' % (
+                name, batch_size, ref_time, seg_time, ref_time / seg_time, max_diff
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Attention backends of PTv3withNeck on packed variable-length sequences: the previous
+pad-to-batch-max einsum vs. sdpa (and flash_attn when available), for the shapes of the
+text cross attention, the neck query-support attention and the serialized patches.
+Reports the latency, the peak memory of a call (CUDA only) and the size of the largest
+attention score tensor that a backend materializes (fp32, without a fused kernel).
+
+python scripts/bench_varlen_attention.py --device cuda --batch_sizes 1 16 64 100
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from minidiffuser.models.PointTransformerV3.model_with_neck import (
+    ATTENTION_BACKENDS, flash_attn, get_padding_plan
+)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def padded_attention(
+    q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, dropout_p=0.0, softmax_scale=None
+):
+    # the previous implementation, for reference
+    lens_q = (cu_seqlens_q[1:] - cu_seqlens_q[:-1]).tolist()
+    lens_k = (cu_seqlens_k[1:] - cu_seqlens_k[:-1]).tolist()
+    q_pad = torch.nn.utils.rnn.pad_sequence(torch.split(q, lens_q), batch_first=True)
+    k_pad = torch.nn.utils.rnn.pad_sequence(torch.split(k, lens_k), batch_first=True)
+    v_pad = torch.nn.utils.rnn.pad_sequence(torch.split(v, lens_k), batch_first=True)
+    masks = torch.arange(k_pad.size(1), device=q.device)[None] >= torch.as_tensor(lens_k, device=q.device)[:, None]
+    logits = torch.einsum('bqhd,bkhd->bqkh', q_pad, k_pad) * softmax_scale
+    logits.masked_fill_(masks.unsqueeze(1).unsqueeze(-1), -1e4)
+    attn_probs = torch.softmax(logits, dim=2)
+    feat = torch.einsum('bqkh,bkhd->bqhd', attn_probs, v_pad)
+    return torch.cat([ft[:lens_q[i]] for i, ft in enumerate(feat)], 0)
+
+
+def timeit(fn, inputs, device, num_repeats):
+    fn(*inputs)
+    times = []
+    for _ in range(num_repeats):
+        synchronize(device)
+        st = time.time()
+        fn(*inputs)
+        synchronize(device)
+        times.append(time.time() - st)
+    return min(times) * 1000
+
+
+def peak_memory_mb(fn, inputs, device):
+    """Peak memory allocated by a call on top of its inputs, None on cpu"""
+    if device.type != 'cuda':
+        return None
+    synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    fn(*inputs)
+    synchronize(device)
+    return (torch.cuda.max_memory_allocated(device) - base) / 1024**2
+
+
+def score_memory_mb(backend, lens_q, lens_k, num_heads):
+    """Largest (#seqs, #heads, len_q, len_k) score tensor of a backend, None for flash"""
+    if backend == 'padded':
+        return len(lens_q) * num_heads * max(lens_q) * max(lens_k) * 4 / 1024**2
+    if backend == 'sdpa':
+        groups = {}
+        for len_q, len_k in zip(lens_q, lens_k):
+            groups[(len_q, len_k)] = groups.get((len_q, len_k), 0) + 1
+        return max(n * num_heads * lq * lk for (lq, lk), n in groups.items()) * 4 / 1024**2
+    return None
+
+
+def format_mb(value):
+    return '%10s' % 'n/a' if value is None else '%10.1f' % value
+
+
+def packed_inputs(lens_q, lens_k, num_heads, head_dim, device):
+    cu_seqlens_q = F.pad(torch.cumsum(torch.as_tensor(lens_q), 0), (1, 0)).int().to(device)
+    cu_seqlens_k = F.pad(torch.cumsum(torch.as_tensor(lens_k), 0), (1, 0)).int().to(device)
+    q = torch.randn(sum(lens_q), num_heads, head_dim, device=device)
+    k = torch.randn(sum(lens_k), num_heads, head_dim, device=device)
+    v = torch.randn(sum(lens_k), num_heads, head_dim, device=device)
+    return q, k, v, cu_seqlens_q, cu_seqlens_k, max(lens_q), max(lens_k), 0.0, head_dim ** -0.5
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 64, 100])
+    parser.add_argument('--npoints', type=int, default=4096, help='max points per sample')
+    parser.add_argument('--num_anchors', type=int, default=100, help='queries per sample of the neck')
+    parser.add_argument('--max_txt_len', type=int, default=77)
+    parser.add_argument('--patch_size', type=int, default=120)
+    parser.add_argument('--num_heads', type=int, default=8)
+    parser.add_argument('--head_dim', type=int, default=32)
+    parser.add_argument('--num_repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    backends = [('padded', padded_attention), ('sdpa', ATTENTION_BACKENDS['sdpa'])]
+    if flash_attn is not None and device.type == 'cuda':
+        backends.append(('flash', ATTENTION_BACKENDS['flash']))
+
+    print('%-12s %6s %-8s %12s %9s %10s %10s %10s' % (
+        'attention', 'batch', 'backend', 'time(ms)', 'speedup', 'max_diff', 'peak(MB)', 'scores(MB)'
+    ))
+    for batch_size in args.batch_sizes:
+        npoints = torch.randint(args.npoints // 4, args.npoints + 1, (batch_size, ))
+        txt_lens = torch.randint(1, args.max_txt_len + 1, (batch_size, )).tolist()
+        _, _, cu_seqlens = get_padding_plan(torch.cumsum(npoints, 0).to(device), args.patch_size)
+        patch_lens = (cu_seqlens[1:] - cu_seqlens[:-1]).tolist()
+
+        workloads = [
+            ('cross', npoints.tolist(), txt_lens),
+            ('neck', [args.num_anchors] * batch_size, npoints.tolist()),
+            ('serialized', patch_lens, patch_lens),
+        ]
+        for name, lens_q, lens_k in workloads:
+            inputs = packed_inputs(lens_q, lens_k, args.num_heads, args.head_dim, device)
+            with torch.no_grad():
+                ref = padded_attention(*inputs)
+                ref_time = None
+                for backend, fn in backends:
+                    max_diff = (fn(*inputs).float() - ref).abs().max().item()
+                    latency = timeit(fn, inputs, device, args.num_repeats)
+                    ref_time = ref_time or latency
+                    print('%-12s %6d %-8s %12.3f %8.2fx %10.2e %s %s' % (
+                        name, batch_size, backend, latency, ref_time / latency, max_diff,
+                        format_mb(peak_memory_mb(fn, inputs, device)),
+                        format_mb(score_memory_mb(backend, lens_q, lens_k, args.num_heads)),
+                    ))
+
+
+if __name__ == '__main__':
+    main()
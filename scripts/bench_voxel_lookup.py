@@ -0,0 +1,89 @@
+"""
+Microbenchmark of the local conv feature lookup in PTv3withNeck.neck_inference:
+retrieve_aligned_features (rebuilt every denoising step) vs. VoxelHashIndex
+(built once per observation, queried every step).
+
+python scripts/bench_voxel_lookup.py --device cuda --num_voxels 20000 --num_queries 1024
+"""
+import argparse
+import time
+
+import torch
+
+from minidiffuser.models.PointTransformerV3.model_with_neck import (
+    retrieve_aligned_features, VoxelHashIndex
+)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def random_voxels(batch_size, num_voxels, spatial_shape, device):
+    indices = []
+    for b in range(batch_size):
+        grid = torch.stack([torch.randint(0, s, (num_voxels, )) for s in spatial_shape], dim=1)
+        grid = torch.unique(grid, dim=0)
+        indices.append(torch.cat([torch.full((grid.size(0), 1), b), grid], dim=1))
+    return torch.cat(indices, dim=0).int().to(device)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_voxels', type=int, default=20000, help='per sample')
+    parser.add_argument('--num_queries', type=int, default=1024, help='per sample')
+    parser.add_argument('--feat_dim', type=int, default=64)
+    parser.add_argument('--spatial_shape', type=int, nargs=3, default=[128, 128, 128])
+    parser.add_argument('--num_steps', type=int, default=100, help='denoising steps per observation')
+    parser.add_argument('--num_repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    indices = random_voxels(args.batch_size, args.num_voxels, args.spatial_shape, device)
+    features = torch.randn(indices.size(0), args.feat_dim, device=device)
+    # half of the queries hit a support voxel, the rest are random (possibly out of bound)
+    num_queries = args.batch_size * args.num_queries
+    hits = indices[torch.randint(0, indices.size(0), (num_queries // 2, ), device=device)]
+    misses = torch.cat([
+        torch.randint(0, args.batch_size, (num_queries - hits.size(0), 1), device=device),
+        torch.randint(-4, max(args.spatial_shape) + 4, (num_queries - hits.size(0), 3), device=device)
+    ], dim=1).int()
+    queries = torch.cat([hits, misses], dim=0)
+
+    ref = retrieve_aligned_features(indices, features, queries, args.spatial_shape)
+    out = VoxelHashIndex(indices, features, args.spatial_shape).query(queries)
+    assert torch.equal(ref, out), 'VoxelHashIndex does not match retrieve_aligned_features'
+
+    def run_baseline():
+        for _ in range(args.num_steps):
+            retrieve_aligned_features(indices, features, queries, args.spatial_shape)
+
+    def run_index():
+        index = VoxelHashIndex(indices, features, args.spatial_shape)
+        for _ in range(args.num_steps):
+            index.query(queries)
+
+    print('#support voxels: %d, #queries: %d, #steps: %d' % (indices.size(0), num_queries, args.num_steps))
+    latencies = {}
+    for name, fn in [('retrieve_aligned_features', run_baseline), ('VoxelHashIndex', run_index)]:
+        fn()    # warmup
+        times = []
+        for _ in range(args.num_repeats):
+            synchronize(device)
+            st = time.time()
+            fn()
+            synchronize(device)
+            times.append(time.time() - st)
+        latencies[name] = min(times) / args.num_steps * 1000
+    ref_latency = latencies['retrieve_aligned_features']
+    for name, latency in latencies.items():
+        print('%-28s %8.3f ms/step %8.2fx' % (name, latency, ref_latency / latency))
+
+
+if __name__ == '__main__':
+    main()